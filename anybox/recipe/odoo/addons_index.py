@@ -0,0 +1,493 @@
+"""Index of the Odoo modules found in the addons paths of a part.
+
+The index is built by the recipe right after the addons paths have been
+finalized, and stored as a JSON file next to the Odoo configuration file.
+For each module, it records the path of its directory and of the
+addons path it's been found in, a few values from its manifest
+(``version``, ``depends``, ``installable``), together with the
+modification time and SHA1 checksum of the manifest.
+
+Rebuilding the index is incremental: manifests whose size and
+modification time didn't change are not read again.
+
+At runtime, :class:`IndexedDiscovery` resolves modules from the index
+instead of walking the filesystem, as long as the index is consistent
+with the actual addons paths (see :func:`anybox.recipe.odoo.runtime.
+patch_odoo.patch_module_discovery`).
+
+This module also provides helpers about module contents and dependencies,
+used to compute minimal sets of modules to update.
+"""
+import os
+import ast
+import json
+import logging
+import hashlib
+import tempfile
+from collections import OrderedDict
+try:
+    from os import scandir  # Python >= 3.5
+except ImportError:
+    try:
+        from scandir import scandir  # backport, if available
+    except ImportError:
+        scandir = None
+from .utils import call_in_threads
+from .utils import reraise
+
+logger = logging.getLogger(__name__)
+
+INDEX_FORMAT = 2
+
+SCAN_JOBS = 8
+"""Number of addons paths scanned concurrently."""
+
+INDEX_SUFFIX = '.addons-index.json'
+
+MANIFEST_NAMES = ('__manifest__.py', '__openerp__.py')
+"""Manifest file names, in Odoo's order of precedence."""
+
+
+def index_path(config_path):
+    """Return the path of the index for the given Odoo configuration file.
+
+    >>> index_path('/srv/buildout/etc/odoo.cfg')
+    '/srv/buildout/etc/odoo.addons-index.json'
+    """
+    return os.path.splitext(config_path)[0] + INDEX_SUFFIX
+
+
+def normalize_path(path):
+    """Normalize an addons path the same way Odoo does."""
+    return os.path.abspath(path.strip())
+
+
+def find_manifest(module_dir):
+    """Return the name of the manifest file in module_dir, or ``None``."""
+    for name in MANIFEST_NAMES:
+        if os.path.isfile(os.path.join(module_dir, name)):
+            return name
+
+
+def list_modules(addons_path):
+    """Return the modules directly in addons_path.
+
+    Only subdirectories are checked for a manifest file. With
+    :func:`os.scandir` (or its backport), telling them apart from regular
+    files does not cost a system call.
+
+    :returns: a list of ``(name, manifest_name)`` pairs, sorted by name.
+              Empty if addons_path does not exist.
+    """
+    if scandir is None:
+        try:
+            names = os.listdir(addons_path)
+        except OSError:
+            return []
+        candidates = [n for n in names
+                      if os.path.isdir(os.path.join(addons_path, n))]
+    else:
+        try:
+            candidates = [entry.name for entry in scandir(addons_path)
+                          if entry.is_dir()]
+        except OSError:
+            return []
+    modules = []
+    for name in sorted(candidates):
+        manifest_name = find_manifest(os.path.join(addons_path, name))
+        if manifest_name is not None:
+            modules.append((name, manifest_name))
+    return modules
+
+
+def scan_addons_paths(addons_paths, jobs=SCAN_JOBS):
+    """List the modules of all addons_paths, in a single concurrent pass.
+
+    :returns: an ordered ``dict`` mapping module names to the list of their
+              ``(module_dir, manifest_name)`` occurrences, in the order of
+              addons_paths. The first occurrence is the one Odoo uses,
+              the other ones are shadowed.
+    """
+    paths = []
+    for path in addons_paths:
+        path = normalize_path(path)
+        if path not in paths:
+            paths.append(path)
+
+    scan = OrderedDict()
+    for path, (modules, exc_info) in zip(
+            paths, call_in_threads(list_modules, [(p,) for p in paths],
+                                   jobs)):
+        if exc_info is not None:
+            reraise(exc_info)
+        for name, manifest_name in modules:
+            scan.setdefault(name, []).append(
+                (os.path.join(path, name), manifest_name))
+    return scan
+
+
+def shadowed_modules(scan):
+    """Return the modules that appear in several addons paths.
+
+    :param scan: as returned by :func:`scan_addons_paths`
+    :returns: a list of ``(name, module_dirs, identical)`` triples, sorted
+              by name, where ``module_dirs`` are in the order of
+              precedence, and ``identical`` tells whether all the
+              occurrences have the same manifest (duplicates), as opposed
+              to different ones (actual shadowing).
+    """
+    shadowed = []
+    for name in sorted(scan):
+        occurrences = scan[name]
+        if len(occurrences) < 2:
+            continue
+        sha1s = set()
+        for module_dir, manifest_name in occurrences:
+            with open(os.path.join(module_dir, manifest_name), 'rb') as f:
+                sha1s.add(hashlib.sha1(f.read()).hexdigest())
+        shadowed.append((name, [occ[0] for occ in occurrences],
+                         len(sha1s) == 1))
+    return shadowed
+
+
+def read_manifest(path):
+    """Read the manifest file at path.
+
+    :returns: a pair made of the manifest ``dict`` (``None`` if it could not
+              be evaluated as a Python literal) and the SHA1 checksum of the
+              file.
+    """
+    with open(path, 'rb') as f:
+        content = f.read()
+    sha1 = hashlib.sha1(content).hexdigest()
+    try:
+        manifest = ast.literal_eval(content.decode('utf-8'))
+    except (SyntaxError, ValueError, UnicodeDecodeError):
+        logger.warn("Could not evaluate manifest %s, only its presence "
+                    "is indexed", path)
+        return None, sha1
+    if not isinstance(manifest, dict):
+        return None, sha1
+    return manifest, sha1
+
+
+def module_entry(module_dir, manifest_name, previous=None):
+    """Return the index entry for the module at module_dir.
+
+    :param previous: the entry of the previous index for the same module,
+                     reused as-is if the manifest didn't change.
+    """
+    manifest_path = os.path.join(module_dir, manifest_name)
+    st = os.stat(manifest_path)
+    if (previous is not None and
+            previous.get('path') == module_dir and
+            previous.get('manifest') == manifest_name and
+            previous.get('mtime') == st.st_mtime and
+            previous.get('size') == st.st_size):
+        return previous
+
+    manifest, sha1 = read_manifest(manifest_path)
+    entry = dict(path=module_dir, addons_path=os.path.dirname(module_dir),
+                 manifest=manifest_name,
+                 mtime=st.st_mtime, size=st.st_size, sha1=sha1,
+                 version=None, depends=[], installable=True)
+    if manifest is not None:
+        entry.update(version=manifest.get('version'),
+                     depends=list(manifest.get('depends', ())),
+                     installable=bool(manifest.get('installable', True)))
+    return entry
+
+
+def build_index(addons_paths, previous=None, scan=None):
+    """Build the index of the modules in addons_paths.
+
+    As in Odoo, the first module of a given name found in addons_paths
+    wins.
+
+    :param previous: a previously built index, whose entries are reused
+                     for unchanged manifests.
+    :param scan: the result of :func:`scan_addons_paths` for addons_paths,
+                 if already available.
+    :returns: the index, as a ``dict``. Its ``stats`` key gives the numbers
+              of manifests that have been ``read`` and ``reused``.
+    """
+    previous_modules = {}
+    if previous is not None and previous.get('format') == INDEX_FORMAT:
+        previous_modules = previous.get('modules', {})
+
+    paths = []
+    paths_mtimes = {}
+    for path in addons_paths:
+        path = normalize_path(path)
+        if path not in paths:
+            paths.append(path)
+            paths_mtimes[path] = os.stat(path).st_mtime
+    if scan is None:
+        scan = scan_addons_paths(paths)
+
+    modules = {}
+    stats = dict(read=0, reused=0)
+    for name, occurrences in scan.items():
+        module_dir, manifest_name = occurrences[0]
+        previous_entry = previous_modules.get(name)
+        entry = module_entry(module_dir, manifest_name,
+                             previous=previous_entry)
+        stats['reused' if entry is previous_entry else 'read'] += 1
+        modules[name] = entry
+
+    return dict(format=INDEX_FORMAT, addons_paths=paths,
+                paths_mtimes=paths_mtimes, modules=modules, stats=stats)
+
+
+def load_index(path):
+    """Load the index stored at path.
+
+    :returns: ``None`` if there is no such file, or if it is not readable
+              as an index.
+    """
+    try:
+        with open(path) as f:
+            index = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if not isinstance(index, dict) or index.get('format') != INDEX_FORMAT:
+        return None
+    return index
+
+
+def write_index(index, path):
+    """Store the index at path, atomically replacing any previous one."""
+    index = dict((k, v) for k, v in index.items() if k != 'stats')
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix='.addons-index-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.rename(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def update_index(path, addons_paths, scan=None):
+    """Build the index of addons_paths, incrementally, and store it at path.
+
+    :param scan: see :func:`build_index`
+    :returns: the index
+    """
+    index = build_index(addons_paths, previous=load_index(path), scan=scan)
+    write_index(index, path)
+    return index
+
+
+def stale_paths(index):
+    """Return the indexed addons paths that changed since the index build.
+
+    Adding, removing or renaming a module directory changes the
+    modification time of its addons path.
+    """
+    stale = []
+    for path in index['addons_paths']:
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime != index['paths_mtimes'].get(path):
+            stale.append(path)
+    return stale
+
+
+class IndexedDiscovery(object):
+    """Replacements for Odoo's module discovery functions, using an index.
+
+    :param index: the index, as returned by :func:`load_index`
+    :param get_ad_paths: callable returning the current addons paths of
+                         Odoo, in its order of precedence
+    :param get_modules: Odoo's original ``get_modules`` function
+    :param get_module_path: Odoo's original ``get_module_path`` function
+
+    The index is used only if all its addons paths are among Odoo's ones,
+    in the same order, and didn't change since it's been built. Otherwise,
+    the original functions are called. Addons paths that are not indexed,
+    such as the one for downloaded modules in Odoo's data directory, are
+    looked into directly.
+    """
+
+    def __init__(self, index, get_ad_paths, get_modules, get_module_path):
+        self.index = index
+        self.indexed_paths = index['addons_paths']
+        self.modules = index['modules']
+        self.get_ad_paths = get_ad_paths
+        self.orig_get_modules = get_modules
+        self.orig_get_module_path = get_module_path
+        self._paths_cache = None
+        self.stale = stale_paths(index)
+        if self.stale:
+            logger.warn("Addons paths %s changed since the addons index has "
+                        "been built. Not using it, please rerun buildout.",
+                        ', '.join(self.stale))
+
+    def current_paths(self):
+        """Return Odoo's current addons paths if the index applies to them.
+
+        :returns: ``None`` if the index does not apply.
+        """
+        if self.stale:
+            return None
+        raw_paths = tuple(self.get_ad_paths())
+        if self._paths_cache is not None and self._paths_cache[0] == raw_paths:
+            return self._paths_cache[1]
+        paths = [normalize_path(p) for p in raw_paths]
+        indexed = set(self.indexed_paths)
+        if [p for p in paths if p in indexed] != self.indexed_paths:
+            paths = None
+        self._paths_cache = (raw_paths, paths)
+        return paths
+
+    def get_modules(self):
+        paths = self.current_paths()
+        if paths is None:
+            return self.orig_get_modules()
+        names = set(self.modules)
+        indexed = set(self.indexed_paths)
+        for path in paths:
+            if path not in indexed:
+                names.update(name for name, _ in list_modules(path))
+        return list(names)
+
+    def get_module_path(self, module, *args, **kwargs):
+        paths = self.current_paths()
+        if paths is None:
+            return self.orig_get_module_path(module, *args, **kwargs)
+        indexed = set(self.indexed_paths)
+        entry = self.modules.get(module)
+        for path in paths:
+            if path in indexed:
+                if (entry is not None and entry['addons_path'] == path and
+                        os.path.isdir(entry['path'])):
+                    return entry['path']
+            else:
+                module_path = os.path.join(path, module)
+                if (os.path.exists(module_path) or
+                        os.path.exists(module_path + '.zip')):
+                    return module_path
+        # let Odoo handle the 'downloaded' option and the warnings
+        return self.orig_get_module_path(module, *args, **kwargs)
+
+
+def module_content_hash(module_dir):
+    """Return a SHA1 checksum of the contents of the module at module_dir.
+
+    It covers the relative paths and contents of all files, except object
+    files and hidden files or directories, so that it changes with any
+    change of the module code or data, but not with its byte-compilation.
+    """
+    sha1 = hashlib.sha1()
+    for dirpath, dirnames, filenames in os.walk(module_dir):
+        dirnames[:] = sorted(d for d in dirnames
+                             if not d.startswith('.') and d != '__pycache__')
+        for name in sorted(filenames):
+            if name.startswith('.') or name.endswith(('.pyc', '.pyo')):
+                continue
+            path = os.path.join(dirpath, name)
+            rel_path = os.path.relpath(path, module_dir)
+            sha1.update(rel_path.replace(os.sep, '/').encode('utf-8'))
+            sha1.update(b'\0')
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 16), b''):
+                    sha1.update(chunk)
+            sha1.update(b'\0')
+    return sha1.hexdigest()
+
+
+def module_content_hashes(module_dirs, jobs=SCAN_JOBS):
+    """Compute :func:`module_content_hash` for several modules concurrently.
+
+    :param module_dirs: a ``dict`` mapping module names to their directories
+    :returns: a ``dict`` mapping module names to their hashes
+    """
+    names = sorted(module_dirs)
+    results = call_in_threads(module_content_hash,
+                              [(module_dirs[n],) for n in names], jobs)
+    hashes = {}
+    for name, (result, exc_info) in zip(names, results):
+        if exc_info is not None:
+            reraise(exc_info)
+        hashes[name] = result
+    return hashes
+
+
+def reverse_dependencies(modules, dependencies):
+    """Return modules, together with all the modules that depend on them.
+
+    :param modules: iterable of module names
+    :param dependencies: a ``dict`` mapping module names to the names of
+                         the modules they directly depend upon.
+    :returns: a ``set`` of module names
+
+    >>> deps = dict(base=[], sale=['base'], sale_stock=['sale', 'stock'],
+    ...             stock=['base'], crm=['base'])
+    >>> sorted(reverse_dependencies(['sale'], deps))
+    ['sale', 'sale_stock']
+    >>> sorted(reverse_dependencies(['base'], deps))
+    ['base', 'crm', 'sale', 'sale_stock', 'stock']
+    """
+    dependents = {}
+    for name, depends in dependencies.items():
+        for dep in depends:
+            dependents.setdefault(dep, set()).add(name)
+
+    result = set()
+    todo = list(modules)
+    while todo:
+        name = todo.pop()
+        if name in result:
+            continue
+        result.add(name)
+        todo.extend(dependents.get(name, ()))
+    return result
+
+
+def changed_modules(hashes, stored, dependencies):
+    """Return the modules to update, given their current and stored hashes.
+
+    :param hashes: current hashes of the installed modules
+    :param stored: hashes recorded by the latest upgrade
+    :param dependencies: direct dependencies of the installed modules
+    :returns: the sorted list of installed modules whose hash changed,
+              together with the installed modules depending on them.
+
+    >>> changed_modules(dict(base='a', sale='b', crm='c'),
+    ...                 dict(base='a', sale='x', crm='c'),
+    ...                 dict(base=[], sale=['base'], crm=['sale']))
+    ['crm', 'sale']
+    """
+    changed = [name for name, h in hashes.items() if stored.get(name) != h]
+    to_update = reverse_dependencies(changed, dependencies)
+    return sorted(to_update.intersection(dependencies))
+
+
+def hashes_to_record(hashes, stored, applied):
+    """Return the module hashes to record after an upgrade.
+
+    The current hash is recorded for the modules that have been updated or
+    installed. For the other ones, the stored hash is kept, so that those
+    that have changed are still considered as such by the next upgrade.
+
+    :param hashes: current hashes of the installed modules
+    :param stored: hashes recorded by the previous upgrade
+    :param applied: names of the modules that have been updated or
+                    installed, ``None`` meaning all of them.
+
+    >>> sorted(hashes_to_record(dict(base='a', sale='b', crm='c'),
+    ...                         dict(base='x', sale='y'),
+    ...                         applied=['sale']).items())
+    [('base', 'x'), ('sale', 'b')]
+    """
+    result = {}
+    for name, h in hashes.items():
+        if applied is None or name in applied:
+            result[name] = h
+        elif name in stored:
+            result[name] = stored[name]
+    return result
@@ -3,12 +3,15 @@ from os.path import join, basename
 import os
 import sys
 import re
-import tarfile
 import setuptools
 import logging
 import stat
 import imp
 import shutil
+import tempfile
+import json
+import hashlib
+from multiprocessing import cpu_count
 try:
     from ConfigParser import ConfigParser, RawConfigParser  # Python 2
 except ImportError:
@@ -27,21 +30,17 @@ from zc.buildout.easy_install import Installer
 from zc.buildout.easy_install import IncompatibleConstraintError
 
 import zc.recipe.egg
-try:
-    import httplib  # Python 2
-except ImportError:
-    from http import client as httplib  # Python 3
-from email import utils as email_utils
-try:
-    from urllib import urlretrieve  # Python 2
-except ImportError:
-    from urllib.request import urlretrieve  # Python 3
 try:
     from urlparse import urlparse  # Python 2
 except ImportError:
     from urllib.parse import urlparse  # Python 3
 from . import vcs
 from . import utils
+from . import download
+from . import tarball
+from . import addons_index
+from .download import get_content_type  # noqa
+from .download import rfc822_time  # noqa
 from .utils import option_splitlines, option_strip, conf_ensure_section
 
 logger = logging.getLogger(__name__)
@@ -52,21 +51,6 @@ else:
     from .utils import next
 
 
-def rfc822_time(h):
-    """Parse RFC 2822-formatted http header and return a time int."""
-    email_utils.mktime_tz(email_utils.parsedate_tz(h))
-
-
-def get_content_type(msg):
-    """Return the mimetype of the HTTP message.
-    This is a helper to support Python 2 and 3.
-    """
-    try:
-        return msg.type
-    except AttributeError:
-        return msg.get_content_type()
-
-
 class MainSoftware(object):
     """Placeholder to represent the main software instead of an addon location.
 
@@ -89,6 +73,28 @@ GP_DEVELOP_DIR = 'develop-dir'
 
 WITH_ODOO_REQUIREMENTS_FILE_OPTION = 'apply-requirements-file'
 
+MAIN_SOFTWARE_SHA256_OPTION = 'main-software-sha256'
+
+BUILD_STATE_MANIFEST_OPTION = 'build-state-manifest'
+
+MAIN_SOFTWARE_SPARSE_DIRS = ('odoo', 'openerp', 'setup')
+"""Directories of the main software that sparse checkouts always include
+(addons being selected by the ``sparse`` option)."""
+
+FREEZE_STATUS_JOBS = 8
+"""Maximum number of repositories whose status is queried concurrently."""
+
+ADDONS_INDEX_OPTION = 'addons-index'
+
+SHADOWED_ADDONS_OPTION = 'shadowed-addons'
+
+BYTE_COMPILE_OPTION = 'byte-compile'
+SHADOWED_ADDONS_VALUES = ('warn', 'fail', 'ignore')
+
+EXTRACT_MANIFEST = '.extracted-trees.json'
+"""Name of the file recording, in an extraction target directory, the
+tree identifiers of exported VCS sources, to skip them if unchanged."""
+
 
 def pip_version():
     import pip
@@ -178,7 +184,8 @@ class BaseRecipe(object):
     addons_paths = ()
 
     # Caching logic for the main Odoo part (e.g, without addons)
-    # Can be 'filename' or 'http-head'
+    # Can be 'filename' or 'http-head' (the latter now being implemented
+    # with conditional requests)
     main_http_caching = 'filename'
 
     is_git_layout = False
@@ -203,6 +210,27 @@ class BaseRecipe(object):
         options = self.b_options if is_global else self.options
         return options.get(name, '').lower() == 'true'
 
+    def int_opt_get(self, name, default, minimum=1):
+        """Retrieve an option and interpret it as a positive integer.
+
+        :param default: value to return if the option is not set
+        :param minimum: lowest acceptable value
+        :raises: :class:`UserError` if the value is not an integer or is
+                 too low.
+        """
+        value = option_strip(self.options.get(name))
+        if not value:
+            return default
+        try:
+            value = int(value)
+        except ValueError:
+            value = None
+        if value is None or value < minimum:
+            raise UserError("Invalid value %r for option %r in part %r "
+                            "(expecting an integer, at least %d)" % (
+                                self.options[name], name, self.name, minimum))
+        return value
+
     def __init__(self, buildout, name, options):
         self.requirements = list(self.requirements)
         self.recipe_requirements_path = []
@@ -218,6 +246,7 @@ class BaseRecipe(object):
         self.vcs_clear_locks = clear_locks == 'true'
         clear_retry = options.get('vcs-clear-retry', '').lower()
         self.clear_retry = clear_retry == 'true'
+        self.vcs_parallel_jobs = self.int_opt_get('vcs-parallel-jobs', 1)
 
         if self.bool_opt_get(WITH_ODOO_REQUIREMENTS_FILE_OPTION):
             logger.debug("%s option: adding 'pip' to the recipe requirements",
@@ -235,12 +264,18 @@ class BaseRecipe(object):
 
         self.downloads_dir = self.make_absolute(
             self.b_options.get('odoo-downloads-directory', 'downloads'))
+        self.extract_cache_dir = self.b_options.get(
+            'odoo-extract-cache-directory')
+        if self.extract_cache_dir is not None:
+            self.extract_cache_dir = self.make_absolute(
+                os.path.expanduser(self.extract_cache_dir))
         self.version_wanted = None  # from the buildout
         self.version_detected = None  # string from the odoo setup.py
         self.parts = self.buildout['buildout']['parts-directory']
         self.odoo_dir = None
         self.archive_filename = None
         self.archive_path = None  # downloaded tar.gz
+        self.main_software_sha256 = None  # expected checksum of the tar.gz
 
         if options.get('scripts') is None:
             options['scripts'] = ''
@@ -263,6 +298,10 @@ class BaseRecipe(object):
             if not os.path.exists(d):
                 logger.info('Created %s/ directory' % basename(d))
                 os.mkdir(d)
+        if (self.extract_cache_dir is not None and
+                not os.path.exists(self.extract_cache_dir)):
+            logger.info('Created %s/ directory', self.extract_cache_dir)
+            os.makedirs(self.extract_cache_dir)
 
         self.sources = OrderedDict()
         self.merges = OrderedDict()
@@ -281,6 +320,8 @@ class BaseRecipe(object):
         self.preinstall_version_check()
 
         version_split = self.version_wanted.split()
+        if version_split[0] in ('url', 'nightly'):
+            version_split = self.parse_main_software_sha256(version_split)
 
         if len(version_split) == 1:
             # version can be a simple version name, such as 6.1-1
@@ -305,6 +346,7 @@ class BaseRecipe(object):
         # in all other cases, the first token is the type of version
         type_spec = version_split[0]
         if type_spec in ('local', 'path'):
+            self.check_no_main_software_sha256()
             self.odoo_dir = join(self.buildout_dir, version_split[1])
             self.sources[main_software] = ('local', None)
         elif type_spec == 'url':
@@ -333,12 +375,47 @@ class BaseRecipe(object):
                 None)
         else:
             # VCS types
+            self.check_no_main_software_sha256()
             type_spec, url, repo_dir, self.version_wanted = version_split[0:4]
             options = dict(opt.split('=') for opt in version_split[4:])
+            if 'sparse' in options:
+                self.check_sparse(type_spec, options,
+                                  ' '.join(version_split))
             self.odoo_dir = join(self.parts, repo_dir)
             self.sources[main_software] = (type_spec,
                                            (url, self.version_wanted), options)
 
+    def parse_main_software_sha256(self, version_split):
+        """Extract the expected checksum of the main software archive.
+
+        It can be specified as a last ``sha256=`` token of the ``version``
+        option, or with the :data:`MAIN_SOFTWARE_SHA256_OPTION` option.
+
+        :returns: ``version_split``, without the checksum token
+        """
+        sha256 = option_strip(self.options.get(MAIN_SOFTWARE_SHA256_OPTION))
+        if version_split[-1].startswith('sha256='):
+            suffix = version_split[-1].split('=', 1)[1]
+            if sha256 and sha256.lower() != suffix.lower():
+                raise UserError(
+                    "Conflicting sha256 checksums in 'version' and %r "
+                    "options of part %r" % (MAIN_SOFTWARE_SHA256_OPTION,
+                                            self.name))
+            sha256 = suffix
+            version_split = version_split[:-1]
+        if sha256:
+            if re.match(r'[0-9a-fA-F]{64}$', sha256) is None:
+                raise UserError("Invalid sha256 checksum %r for the main "
+                                "software of part %r" % (sha256, self.name))
+            self.main_software_sha256 = sha256.lower()
+        return version_split
+
+    def check_no_main_software_sha256(self):
+        if self.options.get(MAIN_SOFTWARE_SHA256_OPTION):
+            raise UserError("The %r option of part %r applies to "
+                            "downloaded main software only" % (
+                                MAIN_SOFTWARE_SHA256_OPTION, self.name))
+
     def preinstall_version_check(self):
         """Perform version checks before any attempt to install.
 
@@ -708,28 +785,6 @@ class BaseRecipe(object):
             return path
         return join(self.buildout_dir, path)
 
-    def sandboxed_tar_extract(self, sandbox, tarfile, first=None):
-        """Extract those members that are below the tarfile path 'sandbox'.
-
-        The tarfile module official doc warns against attacks with .. in tar.
-
-        The option to start with a first member is useful for this case, since
-        the recipe consumes a first member in the tar file to get the odoo
-        main directory in parts.
-        It is taken for granted that this first member has already been
-        checked.
-        """
-
-        if first is not None:
-            tarfile.extract(first)
-
-        for tinfo in tarfile:
-            if tinfo.name.startswith(sandbox + '/'):
-                tarfile.extract(tinfo)
-            else:
-                logger.warn('Tarball member %r is outside of %r. Ignored.',
-                            tinfo, sandbox)
-
     def develop(self, src_directory):
         """Develop the specified source distribution.
 
@@ -797,8 +852,41 @@ class BaseRecipe(object):
             if group:
                 split = os.path.split(addons_dir)
                 addons_dir = os.path.join(split[0], group, split[1])
+            if 'sparse' in options:
+                self.check_sparse(loc_type, options, line)
             self.sources[addons_dir] = (loc_type, location_spec, options)
 
+    def check_sparse(self, loc_type, options, line):
+        """Check that the ``sparse`` option of a source line makes sense."""
+        if loc_type != 'git':
+            raise UserError("In line %r: the 'sparse' option is supported "
+                            "for Git sources only" % line)
+        if options.get('group'):
+            raise UserError("In line %r: the 'sparse' option can't be used "
+                            "together with 'group', since the repository "
+                            "is a single addon then" % line)
+
+    def sparse_checkout_dirs(self, options, main=False):
+        """Return the directories to check out for the ``sparse`` option.
+
+        The ``sparse`` option lists addons, which are located in the
+        ``subdir`` if there is one. For the main software, they are in
+        the ``addons`` directory, and the :data:`MAIN_SOFTWARE_SPARSE_DIRS`
+        are added, since they are needed for the installation.
+
+        :returns: a comma separated string, as the option of
+                  :class:`vcs.git.GitRepo`
+        """
+        addons = [a.strip() for a in options['sparse'].split(',')
+                  if a.strip()]
+        if main:
+            return ','.join(list(MAIN_SOFTWARE_SPARSE_DIRS) +
+                            [join('addons', a) for a in addons])
+        subdir = options.get('subdir')
+        if subdir:
+            addons = [join(subdir, a) for a in addons]
+        return ','.join(addons)
+
     def parse_merges(self, options):
         """Parse the merge options into :attr:`merges`.
 
@@ -867,8 +955,14 @@ class BaseRecipe(object):
         """Peform all lookup and downloads specified in :attr:`sources`.
 
         See :class:`BaseRecipe` for the structure of :attr:`sources`.
+
+        If the ``vcs-parallel-jobs`` option is greater than one, the VCS
+        sources are fetched concurrently, but the outcome (errors included)
+        is processed in the declared order, and therefore so is the
+        resulting :attr:`addons_paths`.
         """
         self.addons_paths = []
+        addons_specs = []
         for local_dir, source_spec in self.sources.items():
             if local_dir is main_software:
                 continue
@@ -880,6 +974,8 @@ class BaseRecipe(object):
             if loc_type == 'git':
                 options['depth'] = self.options.get('git-depth')
             options.update(addons_options)
+            if 'sparse' in addons_options:
+                options['sparse'] = self.sparse_checkout_dirs(addons_options)
 
             group = addons_options.get('group')
             group_dir = None
@@ -898,17 +994,36 @@ class BaseRecipe(object):
                 group_dir = os.path.dirname(local_dir)
                 if not os.path.exists(group_dir):
                     os.makedirs(group_dir)
+
+            vcs_args = None
             if loc_type != 'local':
                 for k, v in self.options.items():
                     if k.startswith(loc_type + '-'):
                         options[k] = v
 
                 repo_url, repo_rev = loc_spec
-                vcs.get_update(loc_type, local_dir, repo_url, repo_rev,
-                               clear_retry=self.clear_retry,
+                options['clear_retry'] = self.clear_retry
+                vcs_args = (loc_type, local_dir, repo_url, repo_rev, options)
+            addons_specs.append((local_dir, addons_options, group_dir,
+                                 vcs_args))
+
+        fetched = {}
+        if self.vcs_parallel_jobs > 1:
+            fetched = self.parallel_vcs_get_updates(
+                spec[3] for spec in addons_specs if spec[3] is not None)
+
+        for local_dir, addons_options, group_dir, vcs_args in addons_specs:
+            if vcs_args is None:
+                if self.clean:
+                    utils.clean_object_files(local_dir)
+            elif local_dir in fetched:
+                exc_info = fetched[local_dir]
+                if exc_info is not None:
+                    utils.reraise(exc_info)
+            else:
+                vcs_type, _, repo_url, repo_rev, options = vcs_args
+                vcs.get_update(vcs_type, local_dir, repo_url, repo_rev,
                                **options)
-            elif self.clean:
-                utils.clean_object_files(local_dir)
 
             subdir = addons_options.get('subdir')
             if group_dir:
@@ -931,6 +1046,38 @@ class BaseRecipe(object):
             if addons_dir not in self.addons_paths:
                 self.addons_paths.append(addons_dir)
 
+    def parallel_vcs_get_updates(self, vcs_args):
+        """Run :func:`vcs.get_update` concurrently for the given arguments.
+
+        The number of concurrent updates is bounded by the
+        ``vcs-parallel-jobs`` option.
+
+        :param vcs_args: iterable of ``(vcs_type, target_dir, url, revision,
+                         options)`` tuples
+        :returns: a ``dict`` mapping target directories to ``None`` for
+                  successful updates, or to the corresponding
+                  :func:`sys.exc_info` value for failed ones.
+                  Failures are logged in the order of ``vcs_args``.
+        """
+        vcs_args = list(vcs_args)
+        logger.info("Fetching %d VCS sources with at most %d parallel jobs",
+                    len(vcs_args), self.vcs_parallel_jobs)
+
+        def get_update(vcs_type, target_dir, url, revision, options):
+            vcs.get_update(vcs_type, target_dir, url, revision, **options)
+
+        outcome = utils.call_in_threads(get_update, vcs_args,
+                                        self.vcs_parallel_jobs)
+        fetched = {}
+        for args, (_, exc_info) in zip(vcs_args, outcome):
+            target_dir = args[1]
+            fetched[target_dir] = exc_info
+            if exc_info is not None:
+                logger.error("Retrieval of %s (%s %s, revision %r) failed",
+                             target_dir, args[0], args[2], args[3],
+                             exc_info=exc_info)
+        return fetched
+
     def revert_sources(self):
         """Revert all sources to the revisions specified in :attr:`sources`.
         """
@@ -974,8 +1121,13 @@ class BaseRecipe(object):
                                clear_retry=self.clear_retry,
                                **options)
 
-    def main_download(self):
+    def main_download(self, conditional=False):
         """HTTP download for main part of the software to self.archive_path.
+
+        :param conditional: if ``True``, the download is done only if the
+                            remote archive changed since the previous one
+                            (see :func:`download.download`)
+        :returns: ``True`` if the archive has been downloaded
         """
         if self.offline:
             raise IOError("%s not found, and offline "
@@ -984,56 +1136,13 @@ class BaseRecipe(object):
         logger.info("Downloading %s ..." % url)
 
         try:
-            msg = urlretrieve(url, self.archive_path)
-            if get_content_type(msg[1]) == 'text/html':
-                os.unlink(self.archive_path)
-                raise LookupError(
-                    'Wanted version %r not found on server (tried %s)' % (
-                        self.version_wanted, url))
-
-        except (tarfile.TarError, IOError):
-            # GR: ContentTooShortError subclasses IOError
-            os.unlink(self.archive_path)
-            raise IOError('The archive does not seem valid: ' +
-                          repr(self.archive_path))
-
-    def is_stale_http_head(self):
-        """Tell if the download is stale by doing a HEAD request.
-
-        Assumes the correct date had been written upon download.
-        This is the same system as in GNU Wget 1.12. It works even if
-        the server does not implement conditional responses such as 304
-        """
-        archivestat = os.stat(self.archive_path)
-        length, modified = archivestat.st_size, archivestat.st_mtime
-
-        url = self.sources[main_software][1]
-        logger.info("Checking if %s if fresh wrt %s",
-                    self.archive_path, url)
-        parsed = urlparse(url)
-        if parsed.scheme == 'https':
-            cnx_cls = httplib.HTTPSConnection
-        else:
-            cnx_cls = httplib.HTTPConnection
-        try:
-            cnx = cnx_cls(parsed.netloc)
-            cnx.request('HEAD', parsed.path)  # TODO query ? fragment ?
-            res = cnx.getresponse()
-        except IOError:
-            return True
-
-        if res.status != 200:
-            return True
-
-        if int(res.getheader('Content-Length')) != length:
-            return True
-
-        head_modified = res.getheader('Last-Modified')
-        logger.debug("Last-modified from HEAD request: %s", head_modified)
-        if rfc822_time(head_modified) > modified:
-            return True
-
-        logger.info("No need to re-download %s", self.archive_path)
+            return download.download(url, self.archive_path,
+                                     sha256=self.main_software_sha256,
+                                     conditional=conditional)
+        except LookupError:
+            raise LookupError(
+                'Wanted version %r not found on server (tried %s)' % (
+                    self.version_wanted, url))
 
     def retrieve_main_software(self):
         """Lookup or fetch the main software.
@@ -1050,31 +1159,30 @@ class BaseRecipe(object):
                 utils.clean_object_files(self.odoo_dir)
         elif type_spec == 'downloadable':
             # download if needed
-            if ((self.archive_path and
-                 not os.path.exists(self.archive_path)) or
-                (self.main_http_caching == 'http-head' and
-                 self.is_stale_http_head())):
+            downloaded = False
+            if self.archive_path and not os.path.exists(self.archive_path):
+                downloaded = self.main_download()
+            elif self.main_http_caching == 'http-head' and not self.offline:
+                downloaded = self.main_download(conditional=True)
+            if (not downloaded and self.main_software_sha256 is not None and
+                    download.file_sha256(self.archive_path) !=
+                    self.main_software_sha256):
+                logger.warn("Checksum of %s does not match the expected "
+                            "one. Downloading it again.", self.archive_path)
+                os.unlink(self.archive_path)
                 self.main_download()
 
-            logger.info(u'Inspecting %s ...' % self.archive_path)
-            tar = tarfile.open(self.archive_path)
-            first = tar.members[0]
-            # Everything that follows assumes all tarball members
-            # are inside a directory with an expected name such
-            # as odoo-6.1-1
-            assert(first.isdir())
-            extracted_name = first.name.split('/')[0]
-            self.odoo_dir = join(self.parts, extracted_name)
-            # protection against malicious tarballs
-            assert(not os.path.isabs(extracted_name))
-            assert(self.odoo_dir.startswith(self.parts))
-
-            logger.info("Cleaning existing %s", self.odoo_dir)
-            if os.path.exists(self.odoo_dir):
-                shutil.rmtree(self.odoo_dir)
             logger.info(u'Extracting %s ...' % self.archive_path)
-            self.sandboxed_tar_extract(extracted_name, tar, first=first)
-            tar.close()
+            if self.extract_cache_dir is None:
+                extracted_name = tarball.extract_tarball(self.archive_path,
+                                                         self.parts)
+            else:
+                extracted_name = tarball.cached_extract(
+                    self.archive_path,
+                    (self.main_software_sha256 or
+                     download.file_sha256(self.archive_path)),
+                    self.extract_cache_dir, self.parts)
+            self.odoo_dir = join(self.parts, extracted_name)
         else:
             url, rev = source[1]
             options = dict((k, v) for k, v in self.options.items()
@@ -1083,6 +1191,9 @@ class BaseRecipe(object):
                 options['depth'] = options.pop('git-depth', None)
 
             options.update(source[2])
+            if 'sparse' in source[2]:
+                options['sparse'] = self.sparse_checkout_dirs(source[2],
+                                                              main=True)
             if self.clean:
                 options['clean'] = True
             vcs.get_update(type_spec, self.odoo_dir, url, rev,
@@ -1115,10 +1226,30 @@ class BaseRecipe(object):
             freeze_to = os.path.join(extract_downloads_to,
                                      'extracted_from.cfg')
 
+        with_build_state = (self.bool_opt_get(BUILD_STATE_MANIFEST_OPTION) and
+                            freeze_to is None)
+        if with_build_state:
+            recipe_options = dict(self.options.items())
+
         self.retrieve_main_software()
         self.retrieve_addons()
         self.retrieve_merges()
 
+        if with_build_state:
+            build_inputs = self.build_state_inputs(recipe_options)
+            installed = self.unchanged_build_state(build_inputs)
+            if installed is not None:
+                logger.info("Part %r: sources, options and requirements "
+                            "unchanged since last build, skipping it.",
+                            self.name)
+                self.odoo_installed = installed
+                # local addons are not part of the build inputs
+                self.finalize_addons_paths()
+                self.scan_addons()
+                self.byte_compile()
+                self._register_extra_paths()
+                return self.odoo_installed
+
         self.install_recipe_requirements()
         os.chdir(self.odoo_dir)  # GR probably not needed any more
         self.read_odoo_setup()
@@ -1131,6 +1262,8 @@ class BaseRecipe(object):
                         "version = " + self.dump_nightly_latest_version())
 
         self.finalize_addons_paths()
+        self.scan_addons()
+        self.byte_compile()
         self._register_extra_paths()
 
         if self.version_detected is None:
@@ -1159,12 +1292,108 @@ class BaseRecipe(object):
         with open(self.config_path, 'w') as configfile:
             config.write(configfile)
 
+        if with_build_state:
+            self.write_build_state(build_inputs)
         if extract_downloads_to:
             self.extract_downloads_to(extract_downloads_to)
         if freeze_to:
             self.freeze_to(freeze_to)
         return self.odoo_installed
 
+    @property
+    def build_state_path(self):
+        """Path to the manifest of the last build of this part."""
+        return join(self.parts, self.name + '.build-state.json')
+
+    def build_state_inputs(self, recipe_options):
+        """Return hashes of everything the build stages depend upon.
+
+        The build stages are those that follow the retrieval of sources:
+        reading of Odoo's ``setup.py``, develop, installation of
+        requirements, generation of scripts and configuration file.
+
+        :param recipe_options: the options of the part, as they were before
+                               any of these stages
+        :returns: a ``dict`` of hexadecimal digests
+        """
+        def digest(obj):
+            return hashlib.sha256(
+                json.dumps(obj, sort_keys=True).encode('utf-8')).hexdigest()
+
+        def file_digest(path):
+            if not os.path.isfile(path):
+                return None
+            with open(path, 'rb') as f:
+                return hashlib.sha256(f.read()).hexdigest()
+
+        revisions = []
+        for local_path, source in self.sources.items():
+            source_type = source[0]
+            if local_path is main_software:
+                abspath = self.odoo_dir
+            else:
+                abspath = self.make_absolute(local_path)
+            if source_type == 'local':
+                continue
+            elif source_type == 'downloadable':
+                archive_stat = os.stat(self.archive_path)
+                revisions.append((self.archive_path, archive_stat.st_size,
+                                  archive_stat.st_mtime))
+            else:
+                repo = vcs.repo(source_type, abspath, '')
+                revisions.append((abspath, [unicode(p) for p in
+                                            repo.parents()]))
+
+        try:
+            recipe_version = pkg_resources.get_distribution(
+                'anybox.recipe.odoo').version
+        except pkg_resources.DistributionNotFound:
+            recipe_version = None
+
+        return dict(
+            options=digest(recipe_options),
+            versions=digest(Installer._versions),
+            python=digest((sys.executable, sys.version, recipe_version)),
+            sources=digest(revisions),
+            setup=file_digest(join(self.odoo_dir, 'setup.py')),
+            requirements=file_digest(join(self.odoo_dir, 'requirements.txt')),
+        )
+
+    def unchanged_build_state(self, inputs):
+        """Compare given build inputs with those of the last build.
+
+        :returns: the list of files installed by the last build if its
+                  inputs were the same and these files still exist,
+                  ``None`` otherwise.
+        """
+        try:
+            with open(self.build_state_path) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        previous = state.get('inputs', {})
+        changed = sorted(k for k in set(inputs) | set(previous)
+                         if inputs.get(k) != previous.get(k))
+        if changed:
+            logger.info("Part %r: build inputs changed since last build: %s",
+                        self.name, ', '.join(changed))
+            return None
+
+        installed = state.get('installed', [])
+        for path in installed + [self.config_path]:
+            if not os.path.exists(path):
+                logger.info("Part %r: %r disappeared since last build",
+                            self.name, path)
+                return None
+        return installed
+
+    def write_build_state(self, inputs):
+        """Record given build inputs and the installed files."""
+        with open(self.build_state_path, 'w') as f:
+            json.dump(dict(inputs=inputs, installed=self.odoo_installed), f,
+                      indent=2, sort_keys=True)
+
     def dump_nightly_latest_version(self):
         """After download/analysis of 'nightly latest', give equivalent spec.
         """
@@ -1195,6 +1424,7 @@ class BaseRecipe(object):
         conf_ensure_section(out_conf, self.name)
         addons_option = []
         self.local_modifications = []
+        to_freeze = []
         for local_path, source in self.sources.items():
             source_type = source[0]
             if source_type == 'local':
@@ -1212,9 +1442,17 @@ class BaseRecipe(object):
             if source_type == 'downloadable':
                 continue
 
-            required_rev = source[1][1]
+            to_freeze.append((local_path, source_type, abspath,
+                              source[1][1]))
+
+        statuses = self.vcs_freeze_statuses(
+            (vcs_type, abspath, required_rev)
+            for _, vcs_type, abspath, required_rev in to_freeze)
+
+        for local_path, source_type, abspath, required_rev in to_freeze:
             revision = self._freeze_vcs_source(
-                source_type, abspath, required_rev)
+                source_type, abspath, required_rev,
+                status=statuses[abspath])
 
             # here it would be tempting not to repeat the freeze if
             # the resulting revision is equal to revision_rev, BUT
@@ -1362,9 +1600,37 @@ class BaseRecipe(object):
             if pick_opt in self.b_options:
                 conf.set('buildout', pick_opt, 'false')
 
+    def vcs_freeze_statuses(self, vcs_args):
+        """Query the freeze statuses of several repositories concurrently.
+
+        These are local queries only, hence their concurrency does not
+        depend on the ``vcs-parallel-jobs`` option, but is bounded by
+        :data:`FREEZE_STATUS_JOBS`.
+
+        :param vcs_args: iterable of ``(vcs_type, abspath, revspec)`` triples
+        :returns: a ``dict`` mapping the ``abspath`` values to the results of
+                  :meth:`vcs.base.BaseRepo.freeze_status`.
+        :raises: the first exception, in the order of ``vcs_args``
+        """
+        vcs_args = list(vcs_args)
+
+        def freeze_status(vcs_type, abspath, revspec):
+            repo = vcs.repo(vcs_type, abspath, '')  # no need of remote URL
+            return repo.freeze_status(revspec=revspec)
+
+        statuses = {}
+        for args, (status, exc_info) in zip(
+                vcs_args, utils.call_in_threads(freeze_status, vcs_args,
+                                                FREEZE_STATUS_JOBS)):
+            if exc_info is not None:
+                utils.reraise(exc_info)
+            statuses[args[1]] = status
+        return statuses
+
     def _freeze_vcs_source(self, vcs_type, abspath, revspec,
                            pip_compatible=False,
-                           allow_local_modification=False):
+                           allow_local_modification=False,
+                           status=None):
 
         """Return the frozen revision for the state of that VCS source.
 
@@ -1375,18 +1641,24 @@ class BaseRecipe(object):
                         than what we can produce)
         :param pip_compatible: if ``True``, a pip compatible revision number
                                is issued. This depends on the precise vcs.
+        :param status: the result of
+                       :meth:`vcs.base.BaseRepo.freeze_status`, if already
+                       queried (see :meth:`vcs_freeze_statuses`).
         :returns: ``None`` if ``revspec`` is already a frozen and reproducible
                   specification.
         """
-
-        repo = vcs.repo(vcs_type, abspath, '')  # no need of remote URL
-
-        if not allow_local_modification and repo.uncommitted_changes():
+        if status is None:
+            repo = vcs.repo(vcs_type, abspath, '')  # no need of remote URL
+            status = repo.freeze_status(
+                revspec=revspec, pip_compatible=pip_compatible,
+                check_changes=not allow_local_modification)
+        dirty, parents, fixed = status
+
+        if not allow_local_modification and dirty:
             self.local_modifications.append(abspath)
 
-        if revspec is not None and repo.is_local_fixed_revision(revspec):
+        if fixed:
             return revspec
-        parents = repo.parents(pip_compatible=pip_compatible)
         if len(parents) > 1:
             self.local_modifications.append(abspath)
 
@@ -1466,6 +1738,8 @@ class BaseRecipe(object):
             # and actually harming for extracted buildout conf
             options = source[2]
             group = options.pop('group', None)
+            # the extracted directory contains only what was checked out
+            options.pop('sparse', None)
             if group:
                 target_local_path = os.path.dirname(local_path)
                 if group != os.path.basename(target_local_path):
@@ -1483,8 +1757,8 @@ class BaseRecipe(object):
 
             abspath = self.make_absolute(local_path)
             if source_type == 'downloadable':
-                shutil.copytree(abspath,
-                                os.path.join(target_dir, local_path))
+                self._copy_downloaded(abspath,
+                                      os.path.join(target_dir, local_path))
             elif source_type != 'local':  # vcs
                 self._extract_vcs_source(source_type, abspath, target_dir,
                                          local_path, extracted)
@@ -1521,9 +1795,48 @@ class BaseRecipe(object):
             return
 
         repo = vcs.repo(vcs_type, repo_path, '')  # no need of remote URL
-        repo.archive(target_path)
+        tree_id = repo.archive_tree_id()
+        manifest = self.read_extract_manifest(target_dir)
+        if (tree_id is not None and manifest.get(local_path) == tree_id and
+                os.listdir(target_path)):
+            logger.info("%s already extracted to %s with identical tree %s, "
+                        "skipping", repo_path, target_path, tree_id)
+        else:
+            repo.archive(target_path)
+            if tree_id is not None:
+                manifest[local_path] = tree_id
+                self.write_extract_manifest(target_dir, manifest)
         extracted.add(target_path)
 
+    def read_extract_manifest(self, target_dir):
+        """Return the tree identifiers previously extracted to target_dir.
+
+        :returns: a ``dict`` whose keys are the local paths of the sources.
+        """
+        try:
+            with open(join(target_dir, EXTRACT_MANIFEST)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def write_extract_manifest(self, target_dir, manifest):
+        with open(join(target_dir, EXTRACT_MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+
+    def _copy_downloaded(self, src, target_path):
+        """Copy a downloaded (non VCS) tree, replacing existing target."""
+        parent_dir = os.path.dirname(target_path)
+        if not os.path.exists(parent_dir):
+            os.makedirs(parent_dir)
+        tmp_dir = tempfile.mkdtemp(dir=parent_dir, prefix='.extracting-')
+        name = os.path.basename(target_path)
+        try:
+            tarball.copy_tree(src, join(tmp_dir, name))
+        except BaseException:
+            shutil.rmtree(tmp_dir)
+            raise
+        tarball.replace_tree(tmp_dir, name, parent_dir)
+
     def _extract_main_software(self, source_type, target_dir, extracted):
         """Extract the main software to target_dir and return relative path.
 
@@ -1545,7 +1858,7 @@ class BaseRecipe(object):
             return local_path
 
         if source_type == 'downloadable':
-            shutil.copytree(self.odoo_dir, target_path)
+            self._copy_downloaded(self.odoo_dir, target_path)
         elif source_type != 'local':  # see docstring for 'local'
             self._extract_vcs_source(source_type, self.odoo_dir, target_dir,
                                      local_path, extracted)
@@ -1645,6 +1958,114 @@ class BaseRecipe(object):
 
         self.options['options.addons_path'] = ','.join(self.addons_paths)
 
+    @property
+    def addons_index_path(self):
+        """Path to the index of the modules of this part."""
+        return addons_index.index_path(self.config_path)
+
+    def scan_addons(self):
+        """Scan the addons paths, check for shadowing and write the index.
+
+        This must be called after :meth:`finalize_addons_paths`.
+        The addons paths are listed only once, for both
+        :meth:`check_shadowed_addons` and :meth:`write_addons_index`.
+        """
+        scan = addons_index.scan_addons_paths(self.addons_paths)
+        self.check_shadowed_addons(scan)
+        self.write_addons_index(scan=scan)
+
+    def check_shadowed_addons(self, scan):
+        """Report the modules that appear in several addons paths.
+
+        Only the first one is used by Odoo. Occurrences whose manifests
+        differ are reported as warnings, whereas identical ones are mere
+        duplicates, reported at the info level. Depending on the
+        ``shadowed-addons`` option, warnings are turned into errors
+        (``fail``) or everything is silenced (``ignore``).
+
+        :param scan: as returned by
+                     :func:`anybox.recipe.odoo.addons_index.scan_addons_paths`
+        :raises: :class:`UserError` if some modules are shadowed and the
+                 option is ``fail``
+        """
+        policy = self.options.get(SHADOWED_ADDONS_OPTION,
+                                  'warn').strip().lower()
+        if policy not in SHADOWED_ADDONS_VALUES:
+            raise UserError("In part %r, invalid value %r for option %r "
+                            "(must be one of %s)" % (
+                                self.name, policy, SHADOWED_ADDONS_OPTION,
+                                ', '.join(SHADOWED_ADDONS_VALUES)))
+        if policy == 'ignore':
+            return
+
+        shadowed = []
+        for name, module_dirs, identical in addons_index.shadowed_modules(
+                scan):
+            if identical:
+                logger.info("Module %r is duplicated, using %s instead of "
+                            "%s", name, module_dirs[0],
+                            ', '.join(module_dirs[1:]))
+            else:
+                logger.warn("Module %r in %s shadows the one(s) in %s",
+                            name, module_dirs[0], ', '.join(module_dirs[1:]))
+                shadowed.append(name)
+
+        if shadowed and policy == 'fail':
+            raise UserError("In part %r, the following modules appear, "
+                            "with different manifests, in several addons "
+                            "paths: %s. See above for details." % (
+                                self.name, ', '.join(shadowed)))
+
+    def byte_compile(self):
+        """Byte-compile Odoo and the addons, if the option says so.
+
+        This must be called after :meth:`finalize_addons_paths`. The work is
+        done by several processes (``byte-compile-jobs`` option, defaulting
+        to the number of CPUs), at the optimization level given by the
+        ``byte-compile-optimize`` option.
+        """
+        if not self.bool_opt_get(BYTE_COMPILE_OPTION):
+            return
+        optimize = self.int_opt_get('byte-compile-optimize', 0, minimum=0)
+        if optimize > 2:
+            raise UserError("Invalid value %r for option "
+                            "'byte-compile-optimize' in part %r "
+                            "(expecting 0, 1 or 2)" % (optimize, self.name))
+        jobs = self.int_opt_get('byte-compile-jobs', cpu_count())
+
+        directories = [self.odoo_dir]
+        directories.extend(p for p in self.addons_paths
+                           if not p.startswith(self.odoo_dir + os.sep))
+        logger.info("Byte-compiling Odoo and addons (%d processes, "
+                    "optimization level %d)", jobs, optimize)
+        count, errors = utils.byte_compile(directories, jobs,
+                                           optimize=optimize)
+        for output in errors:
+            logger.warn("Errors while byte-compiling:\n%s", output.strip())
+        logger.info("Byte-compiled %d source files", count)
+
+    def write_addons_index(self, scan=None):
+        """Build or refresh the index of the modules in the addons paths.
+
+        This must be called after :meth:`finalize_addons_paths`. Manifests
+        that did not change since the previous index are not read again.
+        If the ``addons-index`` option is false, any previous index is
+        removed, so that the scripts don't use it any more.
+
+        :param scan: the result of a previous scan of the addons paths
+        """
+        path = self.addons_index_path
+        if self.options.get(ADDONS_INDEX_OPTION,
+                            'true').strip().lower() != 'true':
+            if os.path.exists(path):
+                os.unlink(path)
+            return
+        index = addons_index.update_index(path, self.addons_paths,
+                                          scan=scan)
+        logger.info("Addons index %s: %d modules (%d manifests read)",
+                    os.path.relpath(path, self.buildout_dir),
+                    len(index['modules']), index['stats']['read'])
+
     def insert_odoo_git_addons(self, base_addons):
         """Insert the standard, non-base addons bundled within Odoo git repo.
 
@@ -1662,6 +2083,7 @@ class BaseRecipe(object):
         of them being found is used. This can be used, for instance, to
         replace an official addon by another one by placing a different
         addons' path before the official one.
+        Such shadowed modules are reported by :meth:`check_shadowed_addons`.
 
         If the official addons' path is already set in the config file
         (e.g. at the end), it will leave it at the end of the paths list,
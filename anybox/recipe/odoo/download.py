@@ -0,0 +1,333 @@
+"""Download of big archives, such as the main software tarballs.
+
+The download is streamed in chunks to a ``.part`` file that's renamed only
+once complete and verified, so that an interrupted download can be resumed
+by the next run, using a HTTP Range request.
+
+The HTTP validators (``ETag`` and ``Last-Modified`` headers) of downloaded
+files are stored beside them, allowing conditional requests to check for
+their freshness, without any transfer if they're still current.
+"""
+import os
+import time
+import json
+import hashlib
+import logging
+from email import utils as email_utils
+try:
+    import httplib  # Python 2
+except ImportError:
+    from http import client as httplib  # Python 3
+try:
+    from urllib2 import urlopen, Request, HTTPError  # Python 2
+except ImportError:
+    from urllib.request import urlopen, Request  # Python 3
+    from urllib.error import HTTPError  # Python 3
+
+from zc.buildout import UserError
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 16
+
+PROGRESS_INTERVAL = 10
+"""Minimal interval in seconds between two logs of download progress."""
+
+PART_SUFFIX = '.part'
+
+VALIDATORS_SUFFIX = '.validators.json'
+
+VALIDATOR_HEADERS = ('ETag', 'Last-Modified')
+
+
+def rfc822_time(h):
+    """Parse RFC 2822-formatted http header and return a time int.
+
+    >>> rfc822_time('Thu, 01 Jan 1970 00:01:40 GMT')
+    100
+    """
+    return email_utils.mktime_tz(email_utils.parsedate_tz(h))
+
+
+def read_validators(path):
+    """Return the stored HTTP validators of the file at given path.
+
+    :returns: a ``dict``, empty if none is stored.
+    """
+    try:
+        with open(path + VALIDATORS_SUFFIX) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_validators(path, info):
+    """Store the HTTP validators from ``info`` (response headers)."""
+    validators = dict((h, info.get(h)) for h in VALIDATOR_HEADERS
+                      if info.get(h))
+    with open(path + VALIDATORS_SUFFIX, 'w') as f:
+        json.dump(validators, f)
+    return validators
+
+
+def move_validators(src, dest):
+    """Move stored HTTP validators from ``src`` to ``dest`` file path."""
+    src_validators = src + VALIDATORS_SUFFIX
+    if os.path.exists(src_validators):
+        os.rename(src_validators, dest + VALIDATORS_SUFFIX)
+    elif os.path.exists(dest + VALIDATORS_SUFFIX):
+        os.unlink(dest + VALIDATORS_SUFFIX)
+
+
+def remove_part(part_path):
+    """Remove a partial download and its validators."""
+    for path in (part_path, part_path + VALIDATORS_SUFFIX):
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def conditional_headers(path):
+    """Headers to request the file at given path only if it changed.
+
+    Based on stored validators, or on the modification time of the file,
+    which is set after the ``Last-Modified`` header after download.
+    """
+    validators = read_validators(path)
+    headers = {}
+    if validators.get('ETag'):
+        headers['If-None-Match'] = validators['ETag']
+    headers['If-Modified-Since'] = validators.get(
+        'Last-Modified',
+        email_utils.formatdate(os.path.getmtime(path), usegmt=True))
+    return headers
+
+
+def get_content_type(msg):
+    """Return the mimetype of the HTTP message.
+    This is a helper to support Python 2 and 3.
+    """
+    try:
+        return msg.type
+    except AttributeError:
+        return msg.get_content_type()
+
+
+def human_size(size):
+    """Format a number of bytes for humans.
+
+    >>> human_size(12)
+    '12 B'
+    >>> human_size(3 << 20)
+    '3.0 MiB'
+    """
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1 << 10:
+            return ('%d %s' if unit == 'B' else '%.1f %s') % (size, unit)
+        size /= 1024.0
+    return '%.1f GiB' % size
+
+
+def file_sha256(path, hasher=None):
+    """Return the hexadecimal sha256 digest of the file at given path.
+
+    :param hasher: if specified, the file contents are fed to this
+                   :mod:`hashlib` object, and its digest is returned.
+    """
+    if hasher is None:
+        hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def content_range_length(value):
+    """Extract the total length from a Content-Range header value.
+
+    >>> content_range_length('bytes 100-199/200')
+    200
+    >>> content_range_length('bytes */200')
+    200
+    >>> content_range_length('bytes 100-199/*') is None
+    True
+    """
+    if not value:
+        return None
+    total = value.rsplit('/', 1)[-1].strip()
+    return int(total) if total.isdigit() else None
+
+
+def content_range_start(value):
+    """Extract the first byte position from a Content-Range header value.
+
+    >>> content_range_start('bytes 100-199/200')
+    100
+    >>> content_range_start('bytes */200') is None
+    True
+    """
+    try:
+        return int(value.split()[1].split('-', 1)[0])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+class DownloadProgress(object):
+    """Log download progress and throughput, at most every few seconds."""
+
+    def __init__(self, url, start, total=None):
+        self.url = url
+        self.start = self.done = start
+        self.total = total
+        self.started_at = self.logged_at = time.time()
+
+    def throughput(self, now):
+        elapsed = now - self.started_at
+        if elapsed <= 0:
+            return 0
+        return (self.done - self.start) / elapsed
+
+    def update(self, size):
+        self.done += size
+        now = time.time()
+        if now - self.logged_at < PROGRESS_INTERVAL:
+            return
+        self.logged_at = now
+        if self.total:
+            logger.info("%s: %d%% (%s of %s, %s/s)",
+                        self.url, self.done * 100 // self.total,
+                        human_size(self.done), human_size(self.total),
+                        human_size(self.throughput(now)))
+        else:
+            logger.info("%s: %s (%s/s)", self.url, human_size(self.done),
+                        human_size(self.throughput(now)))
+
+    def finish(self):
+        now = time.time()
+        logger.info("Downloaded %s (%s in %.1fs, %s/s)",
+                    self.url, human_size(self.done - self.start),
+                    now - self.started_at, human_size(self.throughput(now)))
+
+
+def download(url, path, sha256=None, conditional=False):
+    """Download ``url`` to ``path``, resuming a previous partial download.
+
+    The contents are written to ``path`` with the :data:`PART_SUFFIX`, and
+    renamed to ``path`` once complete and (optionally) verified. In case of
+    error while transferring the data, the partial file is kept, so that the
+    next call can resume from there if the server supports Range requests.
+    The resume is conditional to the remote file being unchanged (If-Range).
+
+    :param sha256: if specified, the expected sha256 hexadecimal digest of
+                   the contents.
+    :param conditional: if ``True`` and ``path`` exists, it is downloaded
+                        again only if the remote file changed.
+    :returns: ``True`` if downloaded, ``False`` if ``conditional`` and the
+              remote file did not change.
+    :raises LookupError: if the server answers with an HTML page, which
+                         usually means that the wanted file does not exist.
+    :raises IOError: if the download failed or is incomplete.
+    :raises UserError: if the checksum does not match. The partial file
+                       is removed in that case.
+    """
+    part_path = path + PART_SUFFIX
+    hasher = hashlib.sha256()
+    offset = 0
+    if os.path.exists(part_path):
+        offset = os.path.getsize(part_path)
+        if offset:
+            file_sha256(part_path, hasher=hasher)
+
+    request = Request(url)
+    if offset:
+        logger.info("Resuming download of %s after %s",
+                    url, human_size(offset))
+        request.add_header('Range', 'bytes=%d-' % offset)
+        part_validators = read_validators(part_path)
+        if_range = (part_validators.get('ETag') or
+                    part_validators.get('Last-Modified'))
+        if if_range:
+            request.add_header('If-Range', if_range)
+    elif conditional and os.path.exists(path):
+        for header, value in conditional_headers(path).items():
+            request.add_header(header, value)
+
+    response = None
+    try:
+        response = urlopen(request)
+    except HTTPError as exc:
+        if exc.code == 304:
+            logger.info("No need to re-download %s", path)
+            return False
+        if exc.code != 416 or not offset:
+            raise
+        # Range Not Satisfiable: the partial download may be complete
+        length = content_range_length(exc.info().get('Content-Range'))
+        if length != offset:
+            logger.warn("Could not resume download of %s, restarting it",
+                        url)
+            remove_part(part_path)
+            return download(url, path, sha256=sha256,
+                            conditional=conditional)
+
+    if response is not None:
+        try:
+            info = response.info()
+            if get_content_type(info) == 'text/html':
+                raise LookupError("Got an HTML page instead of the "
+                                  "expected file at %s" % url)
+            total = info.get('Content-Length')
+            total = int(total) if total is not None else None
+            mode = 'wb'
+            if (offset and response.getcode() == 206 and content_range_start(
+                    info.get('Content-Range')) == offset):
+                mode = 'ab'
+                if total is not None:
+                    total += offset
+            elif offset:
+                logger.info("Could not resume download of %s (unsupported "
+                            "or file changed), restarting from the beginning",
+                            url)
+                offset = 0
+                hasher = hashlib.sha256()
+            if mode == 'wb':
+                write_validators(part_path, info)
+
+            progress = DownloadProgress(url, offset, total=total)
+            with open(part_path, mode) as part_file:
+                while True:
+                    try:
+                        chunk = response.read(CHUNK_SIZE)
+                    except (IOError, httplib.HTTPException) as exc:
+                        raise IOError(
+                            "Download of %s interrupted after %s (%s). "
+                            "It will be resumed on next run." % (
+                                url, human_size(progress.done), exc))
+                    if not chunk:
+                        break
+                    part_file.write(chunk)
+                    hasher.update(chunk)
+                    progress.update(len(chunk))
+        finally:
+            response.close()
+
+        if total is not None and progress.done != total:
+            raise IOError("Incomplete download of %s (got %d bytes, expected "
+                          "%d). It will be resumed on next run." % (
+                              url, progress.done, total))
+        progress.finish()
+
+    if sha256 is not None and hasher.hexdigest() != sha256.lower():
+        remove_part(part_path)
+        raise UserError("Checksum mismatch for %s: expected sha256 %s, "
+                        "got %s" % (url, sha256, hasher.hexdigest()))
+    os.rename(part_path, path)
+    move_validators(part_path, path)
+    last_modified = read_validators(path).get('Last-Modified')
+    if last_modified:
+        # same as GNU Wget, for conditional requests without validators
+        mtime = rfc822_time(last_modified)
+        os.utime(path, (mtime, mtime))
+    return True
@@ -0,0 +1,120 @@
+"""Helpers to process large numbers of records by chunks.
+
+These are the parts of :meth:`.Session.iter_chunks` that don't depend
+on Odoo: keyset pagination over ids, the bookkeeping between chunks,
+and throughput reporting.
+"""
+import time
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def keyset_chunks(fetch_ids, chunk_size=DEFAULT_CHUNK_SIZE, start_after=0):
+    """Generate lists of ids, using keyset pagination.
+
+    Each chunk is fetched from the last id of the previous one, hence
+    at a constant cost, unlike with ``OFFSET``, and without depending on
+    the records of previous chunks still being there.
+
+    :param fetch_ids: callable taking an id and a limit, and returning
+                      at most that many ids greater than the given id,
+                      in increasing order.
+    :param start_after: ids up to this one are not fetched (useful to
+                        resume an interrupted processing).
+
+    >>> ids = [2, 3, 5, 7, 11, 13, 17]
+    >>> fetch = lambda last, limit: [i for i in ids if i > last][:limit]
+    >>> list(keyset_chunks(fetch, 3))
+    [[2, 3, 5], [7, 11, 13], [17]]
+    >>> list(keyset_chunks(fetch, 3, start_after=7))
+    [[11, 13, 17]]
+    """
+    if chunk_size < 1:
+        raise ValueError("Invalid chunk size: %r" % chunk_size)
+    last_id = start_after
+    while True:
+        ids = list(fetch_ids(last_id, chunk_size))
+        if not ids:
+            return
+        yield ids
+        if len(ids) < chunk_size:
+            return
+        last_id = ids[-1]
+
+
+def end_chunk(session, commit=True):
+    """Terminate the processing of a chunk of records in session.
+
+    Pending updates are flushed, then the transaction is committed, unless
+    ``commit`` is ``False`` or ``session.dry_run`` is set, and finally the
+    caches are invalidated and the environments cleaned.
+    """
+    session.flush()
+    if commit and not session.dry_run:
+        session.cr.commit()
+    session.env.invalidate_all()
+    session.clean_environments()
+
+
+def bookkept_chunks(chunks, done, interrupted, wrap=None):
+    """Yield chunks, calling ``done(chunk)`` once each has been processed.
+
+    A chunk is considered processed when the consumer asks for the next
+    one, or when the iteration is over. If the consumer stops before that
+    (``break``, exception), ``interrupted(chunk)`` is called instead,
+    as soon as this generator is closed: the current chunk is then left
+    to the caller.
+
+    :param wrap: if specified, callable applied to each chunk to produce
+                 what is actually yielded.
+
+    >>> processed = []
+    >>> list(bookkept_chunks([[1, 2], [3]], processed.append, None))
+    [[1, 2], [3]]
+    >>> processed
+    [[1, 2], [3]]
+    """
+    for chunk in chunks:
+        try:
+            yield chunk if wrap is None else wrap(chunk)
+        except GeneratorExit:
+            interrupted(chunk)
+            raise
+        done(chunk)
+
+
+class Throughput(object):
+    """Keep track of the number of records processed, and their rate.
+
+    :param total: expected number of records, if known
+    """
+
+    def __init__(self, total=None, timer=time.time):
+        self.total = total
+        self.timer = timer
+        self.count = 0
+        self.start = timer()
+
+    def add(self, count):
+        self.count += count
+
+    @property
+    def rate(self):
+        """Records processed per second."""
+        elapsed = self.timer() - self.start
+        return float(self.count) / elapsed if elapsed > 0 else 0.
+
+    def __str__(self):
+        """Human readable report.
+
+        >>> ticks = iter([0, 4])
+        >>> throughput = Throughput(total=400, timer=lambda: next(ticks))
+        >>> throughput.add(100)
+        >>> str(throughput)
+        '100/400 records (25.0%), 25.0 records/s'
+        """
+        rate = self.rate
+        if self.total:
+            return "%d/%d records (%.1f%%), %.1f records/s" % (
+                self.count, self.total, 100. * self.count / self.total, rate)
+        return "%d records, %.1f records/s" % (self.count, rate)
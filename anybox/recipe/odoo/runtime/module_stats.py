@@ -0,0 +1,154 @@
+"""Per module statistics of module loading during registry rebuilds.
+
+A :class:`ModuleStats` instance hooks Odoo module loading, for the time
+the registry is rebuilt by :meth:`.Session.update_modules` or
+:meth:`.Session.install_modules`, to record for each module the wall
+time, the number of SQL queries, and the number of rows written
+(inserted, updated or deleted) from the start of its loading, including
+its data files and migration scripts, to the start of the next one.
+
+This module does not import Odoo until it is actually needed.
+"""
+import csv
+import json
+import time
+from contextlib import contextmanager
+from collections import OrderedDict
+
+WRITE_STATEMENTS = ('insert', 'update', 'delete')
+
+FIELDS = ('module', 'seconds', 'queries', 'rows_written')
+
+DEFAULT_TOP = 10
+
+
+def is_write_statement(query):
+    """True if query is a SQL statement writing rows.
+
+    >>> is_write_statement('  UPDATE res_partner SET active=false')
+    True
+    >>> is_write_statement('SELECT id FROM res_partner')
+    False
+    """
+    try:
+        return query.lstrip()[:6].lower() in WRITE_STATEMENTS
+    except AttributeError:  # composed queries (Odoo >= 13), bytes
+        return False
+
+
+class ModuleStats(object):
+    """Collect loading statistics for each module.
+
+    The loading of a module ends when the next one starts, or when the
+    whole module graph has been loaded. Modules loaded several times in a
+    same registry rebuild accumulate their statistics.
+    """
+
+    def __init__(self, timer=time.time):
+        self.timer = timer
+        self.modules = OrderedDict()
+        self.current = None
+        self._start = None
+
+    def start_module(self, name):
+        self.stop_module()
+        self.current = self.modules.setdefault(
+            name, dict(module=name, seconds=0., queries=0, rows_written=0))
+        self._start = self.timer()
+
+    def stop_module(self):
+        if self.current is None:
+            return
+        self.current['seconds'] += self.timer() - self._start
+        self.current = None
+
+    def count_query(self, query, rowcount):
+        if self.current is None:
+            return
+        self.current['queries'] += 1
+        if rowcount > 0 and is_write_statement(query):
+            self.current['rows_written'] += rowcount
+
+    @contextmanager
+    def instrument(self, loading=None, cursor_class=None):
+        """Context manager hooking module loading while active.
+
+        :param loading: module of Odoo in which ``load_openerp_module`` and
+                        ``load_module_graph`` are looked up
+        :param cursor_class: class whose ``execute`` method is wrapped to
+                             count queries and written rows.
+        """
+        if loading is None or cursor_class is None:
+            try:
+                from odoo.modules import loading
+                from odoo.sql_db import Cursor as cursor_class
+            except ImportError:
+                from openerp.modules import loading
+                from openerp.sql_db import Cursor as cursor_class
+
+        orig_load_module = loading.load_openerp_module
+        orig_load_graph = loading.load_module_graph
+        orig_execute = cursor_class.__dict__['execute']
+
+        def load_openerp_module(module_name, *args, **kwargs):
+            self.start_module(module_name)
+            return orig_load_module(module_name, *args, **kwargs)
+
+        def load_module_graph(*args, **kwargs):
+            try:
+                return orig_load_graph(*args, **kwargs)
+            finally:
+                self.stop_module()
+
+        def execute(cr, query, *args, **kwargs):
+            res = orig_execute(cr, query, *args, **kwargs)
+            self.count_query(query, cr.rowcount)
+            return res
+
+        loading.load_openerp_module = load_openerp_module
+        loading.load_module_graph = load_module_graph
+        cursor_class.execute = execute
+        try:
+            yield self
+        finally:
+            self.stop_module()
+            loading.load_openerp_module = orig_load_module
+            loading.load_module_graph = orig_load_graph
+            cursor_class.execute = orig_execute
+
+    def results(self, sort=False):
+        """Return the statistics, as a list of dicts.
+
+        :param sort: if ``True``, the slowest modules come first, otherwise
+                     the modules are in their loading order.
+        """
+        results = list(self.modules.values())
+        if sort:
+            results.sort(key=lambda r: r['seconds'], reverse=True)
+        return results
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.results(), f, indent=2)
+
+    def write_csv(self, path):
+        with open(path, 'w') as f:
+            writer = csv.DictWriter(f, FIELDS, lineterminator='\n')
+            writer.writeheader()
+            for row in self.results():
+                row = dict(row, seconds='%.3f' % row['seconds'])
+                writer.writerow(row)
+
+    def summary(self, top=DEFAULT_TOP):
+        """Return lines summarizing the statistics of the slowest modules.
+        """
+        results = self.results(sort=True)
+        if not results:
+            return ["No module has been loaded."]
+        total = sum(r['seconds'] for r in results)
+        lines = ["%d modules loaded in %.1f seconds, the slowest being:" % (
+            len(results), total)]
+        lines.extend("  %-40s %8.1f s %8d queries %9d rows written" % (
+            r['module'], r['seconds'], r['queries'], r['rows_written'])
+            for r in results[:top])
+        return lines
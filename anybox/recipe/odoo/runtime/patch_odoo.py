@@ -1,6 +1,7 @@
 """Necessary monkey patches to make Odoo work in the buildout context.
 """
 
+import sys
 import subprocess
 
 
@@ -28,3 +29,87 @@ def do_patch(gevent_script_path):
         server.long_polling_pid = popen.pid
 
     PreforkServer.long_polling_spawn = long_polling_spawn
+
+
+_discovery_originals = {}
+"""Odoo's own module discovery functions, by name of their module.
+
+They are recorded by the first call of :func:`apply_module_discovery`, so
+that later calls don't wrap already patched functions.
+"""
+
+_discovery_index_path = []
+"""Path of the addons index :func:`patch_module_discovery` applied."""
+
+
+def patch_module_discovery(index_path):
+    """Make Odoo resolve modules from the addons index at index_path.
+
+    Odoo's ``get_modules`` and ``get_module_path`` functions are replaced by
+    those of :class:`anybox.recipe.odoo.addons_index.IndexedDiscovery`,
+    which fall back to the original ones whenever the index does not apply.
+
+    This is done once per process: subsequent calls for the same
+    index_path (e.g., by several :class:`.Session` instances) do nothing.
+
+    :returns: ``True`` if the patch has been applied, ``False`` if there is
+              no usable index at index_path.
+    """
+    from .. import addons_index
+
+    if _discovery_index_path == [index_path]:
+        return True
+
+    try:
+        import odoo
+        from odoo.modules import module as odoo_module
+    except ImportError:
+        import openerp as odoo
+        from openerp.modules import module as odoo_module
+
+    initialized = []
+
+    def get_ad_paths():
+        # initialize_sys_path() is not cheap enough to be called for each
+        # lookup. Later changes by Odoo are seen through the same objects.
+        if not initialized:
+            odoo_module.initialize_sys_path()
+            initialized.append(True)
+        ad_paths = getattr(odoo_module, 'ad_paths', None)
+        if ad_paths is None:  # Odoo >= 13
+            ad_paths = odoo.addons.__path__
+        return ad_paths
+
+    index = addons_index.load_index(index_path)
+    # also re-exported in odoo.modules, from which they are often imported
+    odoo_modules = sys.modules[odoo_module.__name__.rsplit('.', 1)[0]]
+    apply_module_discovery(index, get_ad_paths, odoo_module, odoo_modules)
+    del _discovery_index_path[:]
+    if index is None:
+        return False
+    _discovery_index_path.append(index_path)
+    return True
+
+
+def apply_module_discovery(index, get_ad_paths, *modules):
+    """Set the module discovery functions of modules according to index.
+
+    :param index: the addons index to use, or ``None`` to restore the
+                  original functions.
+    :param get_ad_paths: callable returning Odoo's current addons paths
+    :param modules: the modules in which the functions are replaced. The
+                    first one is where Odoo defines them.
+    """
+    from .. import addons_index
+
+    originals = _discovery_originals.setdefault(
+        modules[0].__name__,
+        (modules[0].get_modules, modules[0].get_module_path))
+    if index is None:
+        functions = originals
+    else:
+        discovery = addons_index.IndexedDiscovery(index, get_ad_paths,
+                                                  *originals)
+        functions = (discovery.get_modules, discovery.get_module_path)
+    for module in modules:
+        module.get_modules, module.get_module_path = functions
@@ -2,9 +2,17 @@
 import warnings
 import sys
 import os
+import json
+import time
 import logging
+from datetime import datetime
+from contextlib import contextmanager
 from distutils.version import Version
 from optparse import OptionParser  # we support python >= 2.6
+from . import patch_odoo
+from . import upgrade_steps
+from . import batch
+from .. import addons_index
 
 try:
     import openerp as odoo
@@ -35,6 +43,10 @@ DEFAULT_VERSION_PARAMETER = 'buildout.db_version'
 
 DEFAULT_VERSION_FILE = 'VERSION.txt'
 
+DEFAULT_MODULE_HASHES_PARAMETER = 'buildout.module_hashes'
+
+DEFAULT_UPGRADE_STEPS_PARAMETER = 'buildout.upgrade_steps'
+
 
 if sys.version_info < (3,):
     from ..utils import next
@@ -127,13 +139,28 @@ class Session(object):
     which the buildout configuration has not been parsed).
     """
 
+    module_stats = None
+    """If set to a :class:`.module_stats.ModuleStats` instance, the loading
+    of modules by :meth:`update_modules` and :meth:`install_modules` gets
+    recorded in it."""
+
+    dry_run = False
+    """If ``True``, :meth:`run_upgrade_steps` only lists the steps,
+    :meth:`update_modules` and :meth:`install_modules` do nothing, and
+    :meth:`iter_chunks` does not commit."""
+
+    upgrade_from_step = None
+    """Id or name of the first step :meth:`run_upgrade_steps` runs."""
+
     def __init__(self, conffile, buildout_dir, parse_config=True):
         self.buildout_dir = buildout_dir
         self.openerp_config_file = conffile
 
         self._registry = self.cr = None
+        self._applied_modules = set()
         if parse_config:
             config.parse_config(['-c', conffile])
+        patch_odoo.patch_module_discovery(addons_index.index_path(conffile))
 
     def ready(self):
         return self._registry is not None
@@ -197,6 +224,8 @@ class Session(object):
         self.init_environments()
         self.context = self.env['res.users'].context_get()
         self.env = odoo.api.Environment(self.cr, self.uid, self.context)
+        self._module_hashes = None
+        self._applied_modules = set()
 
     def init_environments(self):
         """Enter the environments context manager, but don't leave it
@@ -314,6 +343,49 @@ class Session(object):
             self._version_parameter_name, str(version))
         self._db_version = OdooVersion(version)
 
+    def read_db_version(self, db=None):
+        """Read the version stored in a database, without opening it.
+
+        This is the same value as :attr:`db_version`, read with a plain
+        ``psycopg2`` connection, hence much faster than :meth:`open`, which
+        loads the whole registry.
+
+        :param db: database name, defaulting to the one from configuration.
+        :returns: ``None`` if the version could not be read (no database
+                  name, database not initialized, etc.)
+        """
+        import psycopg2
+
+        if db is None:
+            db = config['db_name']
+        if not db:
+            return None
+        sql_db = odoo.sql_db
+        try:
+            if hasattr(sql_db, 'connection_info_for'):
+                info = sql_db.connection_info_for(db)[1]
+                cnx = psycopg2.connect(**info)
+            else:  # Odoo < 9
+                cnx = psycopg2.connect(sql_db.dsn(db)[1])
+        except psycopg2.Error as exc:
+            logger.info("Could not connect to database %r to read its "
+                        "version: %s", db, exc)
+            return None
+        try:
+            cr = cnx.cursor()
+            cr.execute("SELECT value FROM ir_config_parameter WHERE key=%s",
+                       (self._version_parameter_name,))
+            row = cr.fetchone()
+        except psycopg2.Error as exc:
+            logger.info("Could not read the version of database %r: %s",
+                        db, exc)
+            return None
+        finally:
+            cnx.close()
+        if row is None or not row[0]:
+            return None
+        return OdooVersion(row[0])
+
     @property
     def package_version(self):
         """Property reading the version file from buildout directory.
@@ -367,6 +439,95 @@ class Session(object):
         self.cr.rollback()
         self.clean_environments()
 
+    def flush(self):
+        """Write pending updates and recomputations of the ORM to database.
+
+        This must be done before cleaning the environments, which would
+        otherwise lose them.
+        """
+        env = self.env
+        if hasattr(env, 'flush_all'):  # Odoo >= 16
+            env.flush_all()
+        elif hasattr(env['res.users'], 'flush'):  # Odoo 13 to 15
+            env['res.users'].flush()
+        else:
+            env['res.users'].recompute()
+
+    def iter_chunks(self, model, domain=None,
+                    chunk_size=batch.DEFAULT_CHUNK_SIZE, start_after=0,
+                    commit=True, logger=logger):
+        """Iterate over the records of a model, by chunks of limited size.
+
+        This is meant for data migrations on large tables, keeping both
+        memory usage and transactions bounded: once each chunk has been
+        processed by the caller, pending updates are flushed, the
+        transaction is committed (if ``commit`` is ``True`` and
+        :attr:`dry_run` is not set), caches are invalidated and
+        environments are cleaned (see :meth:`clean_environments`).
+        Therefore the caller must not keep records from one chunk to the
+        next, and should use :attr:`env` afresh for each chunk.
+
+        Chunks are fetched by keyset pagination over ids, in increasing
+        order. Progress and throughput are logged after each chunk, with
+        the last processed id: an interrupted processing can be resumed
+        by passing it as ``start_after``.
+
+        If the caller stops iterating in the middle (``break`` or
+        exception), the current chunk is left to it, neither flushed nor
+        committed, and the last processed id is logged.
+
+        Example::
+
+           for partners in session.iter_chunks('res.partner',
+                                               [('customer', '=', True)]):
+               partners.write({'ref': False})
+
+        :param domain: to restrict the records. Inactive records are
+                       included, unless excluded by the domain.
+        :param commit: if ``False``, the caller is responsible for
+                       transaction management.
+        :returns: a generator of recordsets
+        """
+        domain = list(domain or [])
+
+        def fetch_ids(last_id, limit):
+            return self.env[model].with_context(active_test=False).search(
+                domain + [('id', '>', last_id)], order='id', limit=limit).ids
+
+        total = self.env[model].with_context(active_test=False).search_count(
+            domain + [('id', '>', start_after)])
+        throughput = batch.Throughput(total=total)
+        last_done = [start_after]
+
+        def done(ids):
+            batch.end_chunk(self, commit=commit)
+            throughput.add(len(ids))
+            last_done[0] = ids[-1]
+            logger.info("%s: %s, last id %d", model, throughput, ids[-1])
+
+        def interrupted(ids):
+            logger.warn("%s: interrupted in the chunk of ids %d to %d, "
+                        "left to the caller. Last processed id: %d",
+                        model, ids[0], ids[-1], last_done[0])
+
+        return batch.bookkept_chunks(
+            batch.keyset_chunks(fetch_ids, chunk_size=chunk_size,
+                                start_after=start_after),
+            done, interrupted, wrap=lambda ids: self.env[model].browse(ids))
+
+    def process_in_chunks(self, model, func, domain=None, **kwargs):
+        """Call func on the records of a model, by chunks.
+
+        :param func: callable taking a recordset as single argument
+        :param kwargs: passed to :meth:`iter_chunks`
+        :returns: the number of records processed
+        """
+        count = 0
+        for records in self.iter_chunks(model, domain=domain, **kwargs):
+            func(records)
+            count += len(records)
+        return count
+
     def is_cursor_closed(self):
         """Compatibility wrapper.
 
@@ -393,6 +554,106 @@ class Session(object):
         self.clean_environments()
         Registry.delete(dbname)
 
+    @contextmanager
+    def recording_module_stats(self):
+        """Context manager instrumenting module loading into module_stats.
+
+        This does nothing if :attr:`module_stats` is not set.
+        """
+        if self.module_stats is None:
+            yield
+        else:
+            with self.module_stats.instrument():
+                yield
+
+    @property
+    def upgrade_steps(self):
+        """The :class:`.upgrade_steps.UpgradeSteps` registry."""
+        steps = getattr(self, '_upgrade_steps', None)
+        if steps is None:
+            steps = self._upgrade_steps = upgrade_steps.UpgradeSteps(
+                parse_version)
+        return steps
+
+    def upgrade_step(self, version, name=None):
+        """Decorator registering an upgrade step for :meth:`run_upgrade_steps`.
+
+        The decorated callable takes the same arguments as upgrade callables
+        (the session and a logger), and may return a non zero status code
+        to indicate an error.
+
+        :param version: the package version that needs this step.
+        :param name: defaults to the name of the callable. Together with
+                     version, it identifies the step in the database.
+        """
+        return self.upgrade_steps.step(version, name=name)
+
+    _upgrade_steps_parameter_name = DEFAULT_UPGRADE_STEPS_PARAMETER
+
+    @property
+    def done_upgrade_steps(self):
+        """Upgrade steps recorded in database, with their completion times.
+
+        :returns: a ``dict`` mapping step ids to UTC timestamps in ISO format
+        """
+        stored = self.env['ir.config_parameter'].get_param(
+            self._upgrade_steps_parameter_name)
+        return json.loads(stored) if stored else {}
+
+    def run_upgrade_steps(self, logger=logger):
+        """Run the pending upgrade steps, committing after each of them.
+
+        Steps are pending if they aren't recorded in the database as done,
+        and their version is greater than :attr:`db_version`. If
+        :attr:`upgrade_from_step` is set, the steps are run from that one
+        instead, whether they've been done or not.
+
+        A failing step is rolled back, and the following ones aren't run.
+        If :attr:`dry_run` is ``True``, the steps are only listed.
+
+        :returns: ``0`` if all steps have been successful, or the first
+                  non zero status code returned by a step. Exceptions are
+                  raised again after the rollback.
+        """
+        try:
+            plan = self.upgrade_steps.plan(self.done_upgrade_steps,
+                                           db_version=self.db_version,
+                                           from_step=self.upgrade_from_step)
+        except ValueError as exc:
+            logger.error("Can't run upgrade steps: %s", exc)
+            return 1
+        pending = [step for step, status in plan
+                   if status == upgrade_steps.PENDING]
+        logger.info("Upgrade steps (%d pending):", len(pending))
+        for step, status in plan:
+            logger.info("  %-8s %s", status, step.id)
+        if self.dry_run:
+            return 0
+
+        for step in pending:
+            logger.info("Running upgrade step %s", step.id)
+            start = time.time()
+            try:
+                statuscode = step.func(self, logger)
+            except Exception:
+                logger.error("Upgrade step %s failed, rolling back", step.id)
+                self.rollback()
+                raise
+            if statuscode not in (None, 0):
+                logger.error("Upgrade step %s failed with status code %s, "
+                             "rolling back", step.id, statuscode)
+                self.rollback()
+                return statuscode
+            done = self.done_upgrade_steps
+            done[step.id] = datetime.utcnow().isoformat()
+            self.env['ir.config_parameter'].set_param(
+                self._upgrade_steps_parameter_name,
+                json.dumps(done, sort_keys=True))
+            self.cr.commit()
+            logger.info("Upgrade step %s done in %.1f seconds", step.id,
+                        time.time() - start)
+        return 0
+
     def update_modules(self, modules, db=None):
         """Update the prescribed modules in the database.
 
@@ -407,6 +668,10 @@ class Session(object):
                         The special name ``'all'`` triggers the update of
                         all installed modules.
         """
+        if self.dry_run:
+            logger.info("Dry run: not updating modules %s",
+                        ', '.join(modules))
+            return
         if db is None:
             if self.cr is None:
                 raise ValueError("update_modules needs either the session to "
@@ -417,11 +682,13 @@ class Session(object):
             self.close()
         for module in modules:
             config['update'][module] = 1
-        if version_info[0] <= 10:
-            self._registry = Registry.get(db, update_module=True)
-        else:
-            # Form Odoo 11.0: no get method available
-            self._registry = Registry(db)
+            self._applied_modules.add(module)
+        with self.recording_module_stats():
+            if version_info[0] <= 10:
+                self._registry = Registry.get(db, update_module=True)
+            else:
+                # Form Odoo 11.0: no get method available
+                self._registry = Registry(db)
         config['update'].clear()
         self.init_cursor()
         self.clean_environments()
@@ -448,6 +715,10 @@ class Session(object):
         :param open_with_demo: if ``db`` is not None, will be passed to
                                :meth:`open`.
         """
+        if self.dry_run:
+            logger.info("Dry run: not installing modules %s",
+                        ', '.join(modules))
+            return
         already_open = self.cr is not None
         if db is None:
             if not already_open:
@@ -471,13 +742,118 @@ class Session(object):
         config['without_demo'] = not getattr(self, 'with_demo', open_with_demo)
         for module in modules:
             config['init'][module] = 1
-        self._registry = Registry.new(
-            db, update_module=True, force_demo=self.with_demo)
+        with self.recording_module_stats():
+            self._registry = Registry.new(
+                db, update_module=True, force_demo=self.with_demo)
         config['init'].clear()
         config['without_demo'] = saved_without_demo
         self.init_cursor()
         self.clean_environments()
 
+    _module_hashes_parameter_name = DEFAULT_MODULE_HASHES_PARAMETER
+
+    def installed_modules_dependencies(self):
+        """Return the installed modules, with their direct dependencies.
+
+        :returns: a ``dict`` mapping module names to lists of module names
+        """
+        modules = self.env['ir.module.module'].search(
+            [('state', '=', 'installed')])
+        return dict((mod.name, [dep.name for dep in mod.dependencies_id])
+                    for mod in modules)
+
+    def module_hashes(self, modules):
+        """Compute the content hashes of the given modules.
+
+        Modules that can't be found in the addons paths are ignored.
+
+        :returns: a ``dict`` mapping module names to hashes, as computed by
+                  :func:`anybox.recipe.odoo.addons_index.module_content_hash`
+        """
+        get_module_path = odoo.modules.module.get_module_path
+        module_dirs = {}
+        for name in modules:
+            path = get_module_path(name)
+            if path:
+                module_dirs[name] = path
+        return addons_index.module_content_hashes(module_dirs)
+
+    @property
+    def stored_module_hashes(self):
+        """Module hashes recorded by the latest successful upgrade.
+
+        :returns: a ``dict``, empty if they've never been recorded
+        """
+        stored = self.env['ir.config_parameter'].get_param(
+            self._module_hashes_parameter_name)
+        if not stored:
+            return {}
+        try:
+            return json.loads(stored)
+        except ValueError:
+            logger.warn("Invalid module hashes in ir.config_parameter %r, "
+                        "ignoring them", self._module_hashes_parameter_name)
+            return {}
+
+    def changed_modules(self):
+        """Return the minimal set of modules to update in current database.
+
+        These are the installed modules whose content changed since the
+        latest call of :meth:`record_module_hashes` (normally done at the
+        end of a successful upgrade), together with all the installed
+        modules that depend on them. Installed modules without any recorded
+        hash are considered to have changed.
+
+        The current hashes are kept, for :meth:`record_module_hashes`
+        to store them once the upgrade is successful.
+
+        :returns: a sorted list of module names, to be passed to
+                  :meth:`update_modules`. It can be empty.
+        """
+        dependencies = self.installed_modules_dependencies()
+        hashes = self.module_hashes(dependencies)
+        self._module_hashes = hashes
+        to_update = addons_index.changed_modules(
+            hashes, self.stored_module_hashes, dependencies)
+        logger.info("%d installed modules, %d to update: %s",
+                    len(dependencies), len(to_update), ', '.join(to_update))
+        return to_update
+
+    def record_module_hashes(self):
+        """Store the module hashes computed by :meth:`changed_modules`.
+
+        Only the hashes of the modules actually updated by
+        :meth:`update_modules` (with the modules depending on them, that
+        Odoo updates as well) are recorded. The previously stored hashes
+        of other modules are kept, so that they are still returned by the
+        next call of :meth:`changed_modules` if they have changed.
+        Hashes of the modules installed since then are computed right away.
+
+        This does nothing if :meth:`changed_modules` wasn't called since the
+        database was opened, and does not commit.
+        """
+        hashes = getattr(self, '_module_hashes', None)
+        if hashes is None:
+            return
+        installed = self.installed_modules_dependencies()
+        applied = self._applied_modules
+        if 'all' in applied:
+            applied = None
+        else:
+            applied = addons_index.reverse_dependencies(applied, installed)
+        hashes = dict((name, h) for name, h in hashes.items()
+                      if name in installed)
+        new = [name for name in installed if name not in hashes]
+        hashes.update(self.module_hashes(new))
+        if applied is not None:
+            applied.update(new)
+        hashes = addons_index.hashes_to_record(
+            hashes, self.stored_module_hashes, applied)
+        self.env['ir.config_parameter'].set_param(
+            self._module_hashes_parameter_name,
+            json.dumps(hashes, sort_keys=True))
+        self._module_hashes = None
+
     def ref(self, external_id):
         """Return ir.model.data object id from its external identifier.
 
@@ -11,6 +11,7 @@ from here.
 import sys
 import os
 from . import patch_odoo
+from .. import addons_index
 
 
 def insert_args(arguments):
@@ -55,6 +56,8 @@ def main(starter, conf, version=None, just_test=False,
         else:
             arguments.append('--load=' + ','.join(server_wide_modules))
 
+    patch_odoo.patch_module_discovery(addons_index.index_path(conf))
+
     if '--install-all' in sys.argv:
         sys.argv.remove('--install-all')
         try:
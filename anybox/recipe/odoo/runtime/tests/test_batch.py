@@ -0,0 +1,116 @@
+from unittest import TestCase
+
+from ..batch import bookkept_chunks
+from ..batch import end_chunk
+from ..batch import keyset_chunks
+from ..batch import Throughput
+
+
+class TestKeysetChunks(TestCase):
+
+    def setUp(self):
+        self.ids = list(range(1, 11))
+        self.calls = []
+
+    def fetch_ids(self, last_id, limit):
+        self.calls.append(last_id)
+        return [i for i in self.ids if i > last_id][:limit]
+
+    def test_chunks(self):
+        self.assertEqual(list(keyset_chunks(self.fetch_ids, 4)),
+                         [[1, 2, 3, 4], [5, 6, 7, 8], [9, 10]])
+        self.assertEqual(self.calls, [0, 4, 8])
+
+    def test_exact_multiple(self):
+        self.assertEqual(list(keyset_chunks(self.fetch_ids, 5)),
+                         [[1, 2, 3, 4, 5], [6, 7, 8, 9, 10]])
+        # one more query to find out there's nothing left
+        self.assertEqual(self.calls, [0, 5, 10])
+
+    def test_deleted_while_iterating(self):
+        chunks = []
+        for chunk in keyset_chunks(self.fetch_ids, 3):
+            chunks.append(chunk)
+            for i in chunk:
+                self.ids.remove(i)
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(self.ids, [])
+
+    def test_invalid_size(self):
+        self.assertRaises(ValueError, list, keyset_chunks(self.fetch_ids, 0))
+
+
+class TestThroughput(TestCase):
+
+    def test_no_total(self):
+        ticks = iter([10, 10, 12])
+        throughput = Throughput(timer=lambda: next(ticks))
+        self.assertEqual(throughput.rate, 0.)
+        throughput.add(3)
+        self.assertEqual(str(throughput), '3 records, 1.5 records/s')
+
+
+class FakeSession(object):
+
+    dry_run = False
+
+    def __init__(self):
+        self.calls = []
+        self.cr = self.env = self
+
+    def __getattr__(self, name):
+        return lambda: self.calls.append(name)
+
+
+class TestEndChunk(TestCase):
+
+    def test_commit(self):
+        session = FakeSession()
+        end_chunk(session)
+        self.assertEqual(session.calls, ['flush', 'commit', 'invalidate_all',
+                                         'clean_environments'])
+
+    def test_no_commit(self):
+        session = FakeSession()
+        end_chunk(session, commit=False)
+        self.assertEqual(session.calls,
+                         ['flush', 'invalidate_all', 'clean_environments'])
+
+    def test_dry_run(self):
+        session = FakeSession()
+        session.dry_run = True
+        end_chunk(session)
+        self.assertNotIn('commit', session.calls)
+
+
+class TestBookkeptChunks(TestCase):
+
+    def setUp(self):
+        self.done = []
+        self.interrupted = []
+
+    def chunks(self):
+        return bookkept_chunks([[1, 2], [3, 4], [5]],
+                               self.done.append, self.interrupted.append,
+                               wrap=tuple)
+
+    def test_complete(self):
+        self.assertEqual(list(self.chunks()), [(1, 2), (3, 4), (5,)])
+        self.assertEqual(self.done, [[1, 2], [3, 4], [5]])
+        self.assertEqual(self.interrupted, [])
+
+    def test_break(self):
+        for chunk in self.chunks():
+            if chunk == (3, 4):
+                break
+        self.assertEqual(self.done, [[1, 2]])
+        self.assertEqual(self.interrupted, [[3, 4]])
+
+    def test_exception(self):
+        chunks = self.chunks()
+        with self.assertRaises(ZeroDivisionError):
+            for chunk in chunks:
+                1 / 0
+        chunks.close()
+        self.assertEqual(self.done, [])
+        self.assertEqual(self.interrupted, [[1, 2]])
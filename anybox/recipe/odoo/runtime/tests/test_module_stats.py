@@ -0,0 +1,92 @@
+import os
+import csv
+import json
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from ..module_stats import ModuleStats
+
+
+class FakeCursor(object):
+
+    rowcount = -1
+
+    def execute(self, query, params=None):
+        self.rowcount = params or 0
+
+    orig_execute = execute
+
+
+class FakeLoading(object):
+    """Stands for the loading module of Odoo."""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def load_openerp_module(self, module_name):
+        pass
+
+    def load_module_graph(self, queries):
+        for module, module_queries in queries:
+            self.load_openerp_module(module)
+            for query, rowcount in module_queries:
+                self.cursor.execute(query, rowcount)
+
+
+class TestModuleStats(TestCase):
+
+    def setUp(self):
+        self.sandbox = mkdtemp('test_oerp_recipe_module_stats')
+        self.ticks = iter(range(100))
+        self.stats = ModuleStats(timer=lambda: next(self.ticks))
+
+    def tearDown(self):
+        shutil.rmtree(self.sandbox)
+
+    def load(self, queries):
+        cursor = FakeCursor()
+        loading = FakeLoading(cursor)
+        with self.stats.instrument(loading=loading, cursor_class=FakeCursor):
+            loading.load_module_graph(queries)
+            # not counted: no module being loaded
+            cursor.execute("DELETE FROM ir_model_data", 4)
+        self.assertIs(FakeCursor.__dict__['execute'],
+                      FakeCursor.__dict__['orig_execute'])
+
+    def test_stats(self):
+        self.load([('base', [("INSERT INTO res_partner", 1),
+                             ("SELECT 1", 1)]),
+                   ('web', []),
+                   ('sale', [("UPDATE res_partner", 3),
+                             ("delete from sale_order", 2),
+                             ("update x", 0)])])
+        self.load([('sale', [("SELECT 2", 1)])])
+        self.assertEqual(self.stats.results(), [
+            dict(module='base', seconds=1., queries=2, rows_written=1),
+            dict(module='web', seconds=1., queries=0, rows_written=0),
+            dict(module='sale', seconds=2., queries=4, rows_written=5),
+        ])
+        self.assertEqual([r['module'] for r in self.stats.results(sort=True)],
+                         ['sale', 'base', 'web'])
+        summary = self.stats.summary(top=2)
+        self.assertEqual(len(summary), 3)
+        self.assertTrue(summary[0].startswith('3 modules loaded in 4.0'))
+        self.assertEqual(summary[1].split()[0], 'sale')
+
+        json_path = os.path.join(self.sandbox, 'stats.json')
+        self.stats.write_json(json_path)
+        with open(json_path) as f:
+            self.assertEqual(json.load(f), self.stats.results())
+
+        csv_path = os.path.join(self.sandbox, 'stats.csv')
+        self.stats.write_csv(csv_path)
+        with open(csv_path) as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(rows[2], dict(module='sale', seconds='2.000',
+                                       queries='4', rows_written='5'))
+
+    def test_empty(self):
+        self.load([])
+        self.assertEqual(self.stats.results(), [])
+        self.assertEqual(self.stats.summary(), ["No module has been loaded."])
@@ -0,0 +1,84 @@
+import os
+import types
+import shutil
+from tempfile import mkdtemp
+from unittest import TestCase
+
+from ... import addons_index
+from .. import patch_odoo
+from ..patch_odoo import apply_module_discovery
+
+
+class TestModuleDiscovery(TestCase):
+
+    def setUp(self):
+        self.sandbox = mkdtemp('test_oerp_recipe_patch_odoo')
+        self.addons = os.path.join(self.sandbox, 'addons')
+        os.mkdir(self.addons)
+        self.ad_paths = [self.addons]
+        self.orig_calls = []
+
+        # stand for odoo.modules.module and odoo.modules
+        self.odoo_module = types.ModuleType('fake_odoo.modules.module')
+        self.odoo_module.get_modules = self.orig_get_modules
+        self.odoo_module.get_module_path = self.orig_get_module_path
+        self.odoo_modules = types.ModuleType('fake_odoo.modules')
+
+    def tearDown(self):
+        patch_odoo._discovery_originals.pop(self.odoo_module.__name__, None)
+        shutil.rmtree(self.sandbox)
+
+    def orig_get_modules(self):
+        self.orig_calls.append('get_modules')
+        return []
+
+    def orig_get_module_path(self, module, downloaded=False):
+        self.orig_calls.append(module)
+        return False
+
+    def make_index(self):
+        index_path = os.path.join(self.sandbox, 'odoo.addons-index.json')
+        return addons_index.update_index(index_path, [self.addons])
+
+    def apply(self, index):
+        apply_module_discovery(index, lambda: self.ad_paths,
+                               self.odoo_module, self.odoo_modules)
+
+    def test_not_chained(self):
+        os.mkdir(os.path.join(self.addons, 'mod_a'))
+        with open(os.path.join(self.addons, 'mod_a', '__manifest__.py'),
+                  'w') as f:
+            f.write('{}')
+        index = self.make_index()
+        self.apply(index)
+        self.apply(index)
+        for mod in (self.odoo_module, self.odoo_modules):
+            self.assertEqual(mod.get_module_path('mod_a'),
+                             os.path.join(self.addons, 'mod_a'))
+        self.assertEqual(self.orig_calls, [])
+
+        # falling back goes straight to the original functions
+        self.ad_paths = [self.sandbox]
+        self.assertFalse(self.odoo_modules.get_module_path('mod_a'))
+        self.assertEqual(self.orig_calls, ['mod_a'])
+        self.assertEqual(
+            patch_odoo._discovery_originals[self.odoo_module.__name__],
+            (self.orig_get_modules, self.orig_get_module_path))
+
+    def test_restore(self):
+        self.apply(self.make_index())
+        self.apply(None)
+        self.assertEqual(self.odoo_module.get_modules, self.orig_get_modules)
+        self.assertEqual(self.odoo_modules.get_module_path,
+                         self.orig_get_module_path)
+
+    def test_paths_cache(self):
+        discovery = addons_index.IndexedDiscovery(
+            self.make_index(), lambda: self.ad_paths,
+            self.orig_get_modules, self.orig_get_module_path)
+        discovery.get_module_path('mod_a')
+        discovery.get_module_path('mod_b')
+        self.assertEqual(discovery._paths_cache,
+                         (tuple(self.ad_paths), [self.addons]))
+        self.ad_paths = [self.sandbox]
+        self.assertIsNone(discovery.current_paths())
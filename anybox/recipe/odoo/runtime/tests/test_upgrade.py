@@ -0,0 +1,23 @@
+import os
+from unittest import TestCase
+
+from ..upgrade import map_databases
+
+
+def worker(args):
+    db_name, context = args
+    return db_name, context['upgrade_script'], os.getpid()
+
+
+class TestMapDatabases(TestCase):
+
+    def test_map(self):
+        db_names = ['tenant_1', 'tenant_2', 'tenant_3']
+        results = map_databases(worker, db_names, 2,
+                                dict(upgrade_script='upgrade.py'))
+        self.assertEqual([r[:2] for r in results],
+                         [(name, 'upgrade.py') for name in db_names])
+        # a fresh process for each database
+        pids = set(r[2] for r in results)
+        self.assertEqual(len(pids), 3)
+        self.assertNotIn(os.getpid(), pids)
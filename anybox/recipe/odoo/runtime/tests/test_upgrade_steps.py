@@ -0,0 +1,77 @@
+from unittest import TestCase
+
+from ..upgrade_steps import UpgradeSteps
+from ..upgrade_steps import DONE, REACHED, SKIPPED, PENDING
+
+
+def parse_version(vstring):
+    return tuple(int(x) for x in vstring.split('.'))
+
+
+class TestUpgradeSteps(TestCase):
+
+    def setUp(self):
+        steps = self.steps = UpgradeSteps(parse_version)
+
+        @steps.step('1.10')
+        def migrate_invoices(session, logger):
+            pass
+
+        @steps.step('1.2')
+        def migrate_partners(session, logger):
+            pass
+
+        @steps.step('1.2', name='recompute')
+        def recompute_partners(session, logger):
+            pass
+
+        steps.register(lambda session, logger: None, '1.10', name='cleanup')
+
+    def plan(self, *args, **kwargs):
+        return [(step.id, status)
+                for step, status in self.steps.plan(*args, **kwargs)]
+
+    def test_order(self):
+        self.assertEqual([step.id for step in self.steps.steps],
+                         ['1.2:migrate_partners', '1.2:recompute',
+                          '1.10:migrate_invoices', '1.10:cleanup'])
+        self.assertEqual(self.steps.steps[2].func.__name__,
+                         'migrate_invoices')
+
+    def test_duplicate(self):
+        with self.assertRaises(ValueError):
+            self.steps.register(lambda session, logger: None, '1.2',
+                                name='recompute')
+
+    def test_index(self):
+        self.assertEqual(self.steps.index('1.10:cleanup'), 3)
+        self.assertEqual(self.steps.index('recompute'), 1)
+        self.steps.register(lambda session, logger: None, '1.3',
+                            name='recompute')
+        self.assertRaises(ValueError, self.steps.index, 'recompute')
+        self.assertRaises(ValueError, self.steps.index, 'unknown')
+
+    def test_plan(self):
+        self.assertEqual(self.plan({}), [
+            ('1.2:migrate_partners', PENDING),
+            ('1.2:recompute', PENDING),
+            ('1.10:migrate_invoices', PENDING),
+            ('1.10:cleanup', PENDING),
+        ])
+        self.assertEqual(self.plan({'1.10:migrate_invoices': 'x'},
+                                   db_version='1.2'), [
+            ('1.2:migrate_partners', REACHED),
+            ('1.2:recompute', REACHED),
+            ('1.10:migrate_invoices', DONE),
+            ('1.10:cleanup', PENDING),
+        ])
+
+    def test_plan_from_step(self):
+        self.assertEqual(self.plan({'1.2:recompute': 'x'},
+                                   from_step='recompute'), [
+            ('1.2:migrate_partners', SKIPPED),
+            ('1.2:recompute', PENDING),
+            ('1.10:migrate_invoices', PENDING),
+            ('1.10:cleanup', PENDING),
+        ])
+        self.assertRaises(ValueError, self.plan, {}, from_step='unknown')
@@ -12,13 +12,66 @@ from argparse import ArgumentParser
 from argparse import ArgumentDefaultsHelpFormatter
 from argparse import SUPPRESS
 from datetime import datetime
+from fnmatch import fnmatchcase
 from math import ceil
+from multiprocessing import Pool
 
 from ..utils import total_seconds
-from .session import Session
+from .module_stats import ModuleStats
+from .module_stats import DEFAULT_TOP
 
 DEFAULT_LOG_FILE = 'upgrade.log'
 
+DB_PATTERN_CHARS = '*?['
+
+
+def is_multi_db(db_spec):
+    """True if the value of the ``--db-name`` option designates several dbs.
+
+    >>> is_multi_db('prod')
+    False
+    >>> is_multi_db('tenant1,tenant2')
+    True
+    >>> is_multi_db('tenant_*')
+    True
+    """
+    return ',' in db_spec or any(c in db_spec for c in DB_PATTERN_CHARS)
+
+
+def expand_db_names(db_spec, existing):
+    """Return the names of databases designated by db_spec.
+
+    :param db_spec: comma separated list of names or shell-style patterns
+    :param existing: names of the existing databases, used to expand the
+                     patterns.
+    :returns: the list of names, in the order of db_spec, without
+              duplicates. Patterns are expanded in alphabetical order.
+
+    >>> expand_db_names('b*,a,b1', ['b2', 'a', 'b1', 'c'])
+    ['b1', 'b2', 'a']
+    """
+    names = []
+    for item in db_spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if any(c in item for c in DB_PATTERN_CHARS):
+            matching = sorted(n for n in existing if fnmatchcase(n, item))
+        else:
+            matching = [item]
+        names.extend(n for n in matching if n not in names)
+    return names
+
+
+def module_stats_path(log_path, db_name, ext):
+    """Path of the module loading statistics report for db_name.
+
+    >>> module_stats_path('/var/log/upgrade.log', 'prod', 'json')
+    '/var/log/upgrade.prod.module-stats.json'
+    """
+    return '%s.%s.module-stats.%s' % (os.path.splitext(log_path)[0],
+                                      db_name, ext)
+
 
 def upgrade(upgrade_script, upgrade_callable, conf, buildout_dir):
     """Run the upgrade from a source file.
@@ -61,11 +114,42 @@ def upgrade(upgrade_script, upgrade_callable, conf, buildout_dir):
                              "script (lower level stages can still write)")
     parser.add_argument('-d', '--db-name', default=SUPPRESS,
                         help="Database name. If ommitted, the general default "
-                        "values from Odoo config file or libpq will apply.")
+                        "values from Odoo config file or libpq will apply. "
+                        "Several databases can be upgraded by giving a "
+                        "comma separated list of names or shell-style "
+                        "patterns, such as 'tenant_*'.")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of databases to upgrade concurrently, "
+                        "each in its own process, if several are "
+                        "specified.")
     parser.add_argument('--init-load-demo-data', action='store_true',
                         help="Demo data will be loaded with module "
                         "installations if and only if "
                         "this modifier is specified")
+    parser.add_argument('--skip-if-current', action='store_true',
+                        help="Don't load a database whose version is already "
+                        "the package version (checked with a plain "
+                        "database connection), and report it as "
+                        "successfully upgraded.")
+    parser.add_argument('--module-stats', action='store_true',
+                        help="Record the time, number of SQL queries and "
+                        "rows written of each module loaded by the "
+                        "update and install of modules. The report is "
+                        "written in JSON and CSV files next to the log file, "
+                        "and summarized on the console.")
+    parser.add_argument('--module-stats-top', type=int, default=DEFAULT_TOP,
+                        metavar='N',
+                        help="Number of modules in the console summary of "
+                        "--module-stats.")
+    parser.add_argument('--from-step', metavar='STEP',
+                        help="Id or name of the first upgrade step to run "
+                        "(see Session.upgrade_step). Previous steps are "
+                        "skipped, and following ones are run even if "
+                        "already done.")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Only list the upgrade steps with their status, "
+                        "without running them, nor updating or installing "
+                        "modules. The database version is not set.")
 
     arguments = parser.parse_args()  # 'args' would shadow the one of pdb
     log_path = os.path.abspath(os.path.expanduser(arguments.log_file))
@@ -79,6 +163,7 @@ def upgrade(upgrade_script, upgrade_callable, conf, buildout_dir):
         sys.stderr.write("Cannot open %r for write" % log_path + os.linesep)
         sys.exit(-1)
 
+    from .session import Session  # imports Odoo
     session = Session(conf, buildout_dir)
 
     try:
@@ -114,8 +199,62 @@ def upgrade(upgrade_script, upgrade_callable, conf, buildout_dir):
         logger.addHandler(console_handler)
 
     db_name = getattr(arguments, 'db_name', None)
+    with_demo = bool(arguments.init_load_demo_data)
+    skip_if_current = arguments.skip_if_current
+    module_stats_top = None
+    if arguments.module_stats:
+        module_stats_top = arguments.module_stats_top
+    steps_options = dict(from_step=arguments.from_step,
+                         dry_run=arguments.dry_run)
+    if db_name is not None and is_multi_db(db_name):
+        statuscode = upgrade_databases(
+            session, db_name, max(arguments.jobs, 1), upgrade_script,
+            upgrade_callable, logger, log_path, with_demo,
+            skip_if_current=skip_if_current,
+            module_stats_top=module_stats_top, **steps_options)
+    else:
+        statuscode = upgrade_database(session, db_name, upgrade_script,
+                                      upgrade_callable, logger, log_path,
+                                      with_demo, start_time,
+                                      skip_if_current=skip_if_current,
+                                      module_stats_top=module_stats_top,
+                                      **steps_options)
+
+    log_file.close()
+    sys.exit(statuscode)
+
+
+def upgrade_database(session, db_name, upgrade_script, upgrade_callable,
+                     logger, log_path, with_demo, start_time,
+                     skip_if_current=False, module_stats_top=None,
+                     from_step=None, dry_run=False):
+    """Open one database with session and run the upgrade callable on it.
+
+    See :func:`upgrade` for the arguments.
+
+    :param start_time: to compute the total time logged in case of success
+    :param skip_if_current: if ``True``, the database is not even opened if
+                            its version is the package version, as read by
+                            :meth:`.Session.read_db_version`.
+    :param module_stats_top: if not ``None``, module loading statistics
+                             are recorded, reported by
+                             :func:`report_module_stats`, and this many
+                             modules are summarized on the console.
+    :param from_step: set as :attr:`.Session.upgrade_from_step`
+    :param dry_run: set as :attr:`.Session.dry_run`. Nothing is committed
+                    after the upgrade callable.
+    :returns: the status code of the upgrade callable
+    """
+    if skip_if_current and is_current(session, db_name, logger):
+        return 0
+
+    if module_stats_top is not None:
+        session.module_stats = ModuleStats()
+    session.upgrade_from_step = from_step
+    session.dry_run = dry_run
+
     logger.info("Opening database %r", db_name)
-    session.open(db=db_name, with_demo=bool(arguments.init_load_demo_data))
+    session.open(db=db_name, with_demo=with_demo)
     # actual value after all defaultings have been done
     db_name = session.cr.dbname
 
@@ -148,11 +287,22 @@ def upgrade(upgrade_script, upgrade_callable, conf, buildout_dir):
 
     upgrade_module = imp.load_source('anybox.recipe.odoo.upgrade_odoo',
                                      upgrade_script)
-    statuscode = getattr(upgrade_module, upgrade_callable)(session, logger)
-    if statuscode is None or statuscode == 0:
+    try:
+        statuscode = getattr(upgrade_module, upgrade_callable)(session,
+                                                               logger)
+    finally:
+        if session.module_stats is not None:
+            report_module_stats(session.module_stats, db_name, logger,
+                                log_path, module_stats_top)
+    if dry_run:
+        session.rollback()
+        session.close()
+        logger.info("Dry run, nothing committed.")
+    elif statuscode is None or statuscode == 0:
         if pkg_version is not None:
             logger.info("setting version %s in database" % pkg_version)
             session.db_version = pkg_version
+        session.record_module_hashes()
         session.cr.commit()
         session.close()
         logger.info("%s successful. Total time: %d seconds." % (
@@ -161,6 +311,157 @@ def upgrade(upgrade_script, upgrade_callable, conf, buildout_dir):
         ))
     else:
         logger.error("Please check logs at %s" % log_path)
+    return statuscode
 
-    log_file.close()
-    sys.exit(statuscode)
+
+def report_module_stats(stats, db_name, logger, log_path, top):
+    """Write the module loading statistics, and log a summary of them."""
+    paths = [module_stats_path(log_path, db_name, ext)
+             for ext in ('json', 'csv')]
+    stats.write_json(paths[0])
+    stats.write_csv(paths[1])
+    for line in stats.summary(top):
+        logger.info(line)
+    logger.info("Module loading statistics written to %s", ' and '.join(paths))
+
+
+def is_current(session, db_name, logger):
+    """True if the version of the database is the package version.
+
+    This doesn't load the database.
+    """
+    pkg_version = session.package_version
+    if pkg_version is None:
+        logger.info("No package version, can't skip the upgrade of "
+                    "database %r", db_name)
+        return False
+    db_version = session.read_db_version(db_name)
+    if db_version is None or db_version != pkg_version:
+        return False
+    logger.info("Database %r is already at version %s, nothing to upgrade.",
+                db_name, db_version)
+    return True
+
+
+def upgrade_databases(session, db_spec, jobs, upgrade_script,
+                      upgrade_callable, logger, log_path, with_demo,
+                      skip_if_current=False, module_stats_top=None,
+                      from_step=None, dry_run=False):
+    """Upgrade several databases, in a pool of processes.
+
+    Each database is upgraded by :func:`upgrade_database` in a new process,
+    with its own :class:`.Session`. A failure for one database does not
+    stop the others.
+
+    :param db_spec: see :func:`expand_db_names`
+    :param jobs: number of concurrent processes
+    :returns: 0 if all upgrades succeeded, 1 otherwise. A per-database
+              report of statuses, durations and exit codes is logged.
+    """
+    try:
+        from odoo import sql_db
+        from odoo.service import db as db_service
+    except ImportError:
+        from openerp import sql_db
+        from openerp.service import db as db_service
+
+    existing = ()
+    if any(c in db_spec for c in DB_PATTERN_CHARS):
+        existing = db_service.list_dbs(True)
+    db_names = expand_db_names(db_spec, existing)
+    if not db_names:
+        logger.error("No database matches %r", db_spec)
+        return 1
+    # the forked processes must not share connections
+    sql_db.close_all()
+
+    logger.info("Upgrading %d databases, %d at a time: %s", len(db_names),
+                jobs, ', '.join(db_names))
+    context = dict(
+        conf=session.openerp_config_file, buildout_dir=session.buildout_dir,
+        upgrade_script=upgrade_script, upgrade_callable=upgrade_callable,
+        log_path=log_path, with_demo=with_demo,
+        skip_if_current=skip_if_current, module_stats_top=module_stats_top,
+        from_step=from_step, dry_run=dry_run)
+    results = map_databases(upgrade_database_process, db_names, jobs,
+                            context)
+
+    failed = 0
+    logger.info("Upgrade report:")
+    for db_name, statuscode, duration in results:
+        ok = statuscode in (None, 0)
+        failed += not ok
+        logger.info("  %-30s %-7s %6d seconds  exit code %s", db_name,
+                    "OK" if ok else "FAILED", ceil(duration),
+                    0 if statuscode is None else statuscode)
+    if failed:
+        logger.error("%d database upgrades out of %d failed. "
+                     "Please check logs at %s", failed, len(results),
+                     log_path)
+        return 1
+    logger.info("All %d database upgrades successful.", len(results))
+    return 0
+
+
+def fork_pool(processes):
+    """Return a pool of forked processes, each one running a single task.
+
+    The processes must be forked, whatever the default start method, to
+    inherit Odoo's configuration, as adapted by :func:`upgrade`, and the
+    logging setup. Having a fresh process for each task avoids accumulating
+    registries.
+    """
+    try:
+        from multiprocessing import get_context
+    except ImportError:  # Python 2 always forks on POSIX systems
+        pool_class = Pool
+    else:
+        pool_class = get_context('fork').Pool
+    return pool_class(processes, maxtasksperchild=1)
+
+
+def map_databases(worker, db_names, jobs, context):
+    """Call worker for each database in a pool of at most jobs processes.
+
+    :param worker: a module level function (hence picklable), called with
+                   a ``(db_name, context)`` pair.
+    :param context: picklable ``dict`` of what the workers need to know.
+    :returns: the results of worker, in the order of db_names.
+    """
+    pool = fork_pool(min(jobs, len(db_names)))
+    try:
+        return pool.map(worker, [(db_name, context) for db_name in db_names],
+                        chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def upgrade_database_process(args):
+    """Run :func:`upgrade_database` in a process of the pool.
+
+    Exceptions are logged, and reported with a status code of 1.
+
+    :param args: a ``(db_name, context)`` pair, see :func:`map_databases`
+    :returns: the database name, the status code and the duration in seconds
+    """
+    from .session import Session
+
+    db_name, ctx = args
+    logger = logging.getLogger('odoo.upgrade')
+    start_time = datetime.utcnow()
+    try:
+        # configuration has been parsed and adapted before the fork
+        session = Session(ctx['conf'], ctx['buildout_dir'],
+                          parse_config=False)
+        statuscode = upgrade_database(
+            session, db_name, ctx['upgrade_script'], ctx['upgrade_callable'],
+            logger, ctx['log_path'], ctx['with_demo'], start_time,
+            skip_if_current=ctx['skip_if_current'],
+            module_stats_top=ctx['module_stats_top'],
+            from_step=ctx['from_step'], dry_run=ctx['dry_run'])
+    except Exception:
+        logger.exception("Upgrade of database %r failed", db_name)
+        statuscode = 1
+    return (db_name, statuscode,
+            total_seconds(datetime.utcnow() - start_time))
@@ -0,0 +1,117 @@
+"""Registry of versioned upgrade steps.
+
+Upgrade steps are callables registered with a version, and usually a
+name, through :meth:`.Session.upgrade_step`. They are run in the order of
+their versions (then of their registration) by
+:meth:`.Session.run_upgrade_steps`, which records each of them in the
+database as soon as it has been committed, so that an interrupted upgrade
+can be resumed instead of being started over.
+
+This module does not depend on Odoo, the parsing of versions being
+provided by the caller.
+"""
+
+DONE = 'done'
+REACHED = 'reached'
+SKIPPED = 'skipped'
+PENDING = 'pending'
+
+
+class UpgradeStep(object):
+    """An upgrade step, identified by its version and name."""
+
+    def __init__(self, version, name, func):
+        self.version = version
+        self.name = name
+        self.func = func
+
+    @property
+    def id(self):
+        return '%s:%s' % (self.version, self.name)
+
+    def __repr__(self):
+        return 'UpgradeStep(%r)' % self.id
+
+
+class UpgradeSteps(object):
+    """Ordered registry of upgrade steps.
+
+    :param parse_version: callable returning comparable objects out of
+                          version strings.
+    """
+
+    def __init__(self, parse_version):
+        self.parse_version = parse_version
+        self.steps = []
+
+    def register(self, func, version, name=None):
+        """Register func as the upgrade step for version and name.
+
+        :param name: defaults to the name of func.
+        :raises: ValueError if there's already such a step.
+        """
+        step = UpgradeStep(str(version), name or func.__name__, func)
+        if any(s.id == step.id for s in self.steps):
+            raise ValueError("Duplicate upgrade step %r" % step.id)
+        self.steps.append(step)
+        # sorting is stable, keeping the registration order for each version
+        self.steps.sort(key=lambda s: self.parse_version(s.version))
+        return func
+
+    def step(self, version, name=None):
+        """Decorator form of :meth:`register`."""
+        def decorator(func):
+            return self.register(func, version, name=name)
+        return decorator
+
+    def index(self, step_ref):
+        """Return the position of a step from its id or unique name.
+
+        :raises: ValueError if there's no such step, or if the name is
+                 ambiguous.
+        """
+        for i, step in enumerate(self.steps):
+            if step.id == step_ref:
+                return i
+        found = [i for i, step in enumerate(self.steps)
+                 if step.name == step_ref]
+        if not found:
+            raise ValueError("No upgrade step %r" % step_ref)
+        if len(found) > 1:
+            raise ValueError("Several upgrade steps are named %r: %s" % (
+                step_ref, ', '.join(self.steps[i].id for i in found)))
+        return found[0]
+
+    def plan(self, done, db_version=None, from_step=None):
+        """Tell which steps have to be run.
+
+        :param done: ids of the steps already recorded in the database
+        :param db_version: the version of the database before the upgrade.
+                           Steps for this version and previous ones are
+                           considered to have been run before the steps
+                           registry was used.
+        :param from_step: if specified, id or name of the first step to
+                          run. It and all following steps are then run,
+                          even if already done, while previous ones are
+                          skipped.
+        :returns: a list of ``(step, status)`` pairs, in order, the status
+                  being one of :data:`DONE`, :data:`REACHED`,
+                  :data:`SKIPPED` and :data:`PENDING`.
+        """
+        start = None if from_step is None else self.index(from_step)
+        if db_version is not None:
+            db_version = self.parse_version(str(db_version))
+
+        plan = []
+        for i, step in enumerate(self.steps):
+            if start is not None:
+                status = SKIPPED if i < start else PENDING
+            elif step.id in done:
+                status = DONE
+            elif (db_version is not None and
+                  self.parse_version(step.version) <= db_version):
+                status = REACHED
+            else:
+                status = PENDING
+            plan.append((step, status))
+        return plan
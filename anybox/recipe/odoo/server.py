@@ -8,12 +8,21 @@ import zc.buildout
 from zc.buildout import UserError
 from .base import BaseRecipe
 from . import devtools
+from multiprocessing import cpu_count
 from .utils import option_splitlines, option_strip, major_version
+from .utils import parse_size, available_memory, auto_workers
 
 logger = logging.getLogger(__name__)
 
 SERVER_COMMA_LIST_OPTIONS = ('log_handler', )
 
+GUNICORN_WORKER_CLASSES = ('sync', 'gthread', 'gevent')
+"""Gunicorn worker classes that can be given by their short names."""
+
+GUNICORN_WORKER_MEMORY = '512M'
+"""Default estimate of the memory footprint of a worker, for auto-sizing.
+"""
+
 
 class ServerRecipe(BaseRecipe):
     """Recipe for server install and config
@@ -132,6 +141,9 @@ class ServerRecipe(BaseRecipe):
 
         gunicorn_options['server_wide_modules'] = list(
             self.server_wide_modules) if self.server_wide_modules else ['web']
+        if gunicorn_options['workers'].strip().lower() == 'auto':
+            gunicorn_options['workers'] = self._gunicorn_auto_workers(
+                gunicorn_options.get('worker_memory', GUNICORN_WORKER_MEMORY))
 
         f = open(join(self.etc, qualified_name + '.conf.py'), 'w')
         conf = """'''Gunicorn configuration script.
@@ -151,6 +163,7 @@ odoo.multi_process = True  # needed even with only one worker
 odoo.conf.server_wide_modules = %(server_wide_modules)r
 conf = odoo.tools.config
 """ % gunicorn_options
+        conf += self._gunicorn_worker_settings(gunicorn_options)
 
         # forwarding specified options
         prefix = 'options.'
@@ -170,7 +183,53 @@ conf = odoo.tools.config
 
         preload_dbs = option_splitlines(self.options.get(
             'gunicorn.preload_databases'))
-        if preload_dbs:
+        preload_app = self.options.get(
+            'gunicorn.preload_app', '').strip().lower() == 'true'
+        if preload_app:
+            conf += os.linesep.join((
+                "",
+                "preload_app = True",
+                "preload_dbs = %r" % (preload_dbs,),
+                "",
+                "",
+                "def on_starting(server):",
+                "    '''Load Odoo in the master process, before any fork.",
+                "",
+                "    Workers share the corresponding memory pages as long as",
+                "    they don't modify them (copy-on-write).",
+                "    '''",
+                "    odoo.service.server.load_server_wide_modules()",
+                "    registries = odoo.modules.registry",
+                "    for db_name in preload_dbs:",
+                "        server.log.info('Master loading database %r',",
+                "                        db_name)",
+                "        if hasattr(registries, 'RegistryManager'):",
+                "            registries.RegistryManager.get(db_name)",
+                "        else:",
+                "            registries.Registry(db_name)",
+                "    # connections must not be shared with the workers",
+                "    odoo.sql_db.close_all()",
+                "",
+                "",
+                "def when_ready(server):",
+                "    server.log.info('Odoo server-wide modules and '",
+                "                    'databases %r loaded in master '",
+                "                    'process, ready to fork workers',",
+                "                    preload_dbs)",
+                "",
+                "",
+                "def post_fork(server, worker):",
+                "    '''Reset what the worker must not share with the master.",
+                "",
+                "    Cursors are not kept by the registries, but the pool of",
+                "    connections is replaced, so that nothing opened by the",
+                "    master since the preload can ever be used or closed in",
+                "    the worker (closing would end the session for all).",
+                "    '''",
+                "    odoo.sql_db._Pool = None",
+                "",
+            ))
+        elif preload_dbs:
             conf += os.linesep.join((
                 "",
                 "def post_fork(server, worker):",
@@ -189,6 +248,55 @@ conf = odoo.tools.config
         f.write(conf)
         f.close()
 
+    def _gunicorn_auto_workers(self, worker_memory):
+        """Number of Gunicorn workers for this host.
+
+        See :func:`anybox.recipe.odoo.utils.auto_workers`.
+
+        :param worker_memory: estimate of the memory footprint of a worker,
+                              see :func:`anybox.recipe.odoo.utils.parse_size`
+        """
+        try:
+            worker_memory = parse_size(worker_memory)
+        except ValueError:
+            raise UserError("Invalid value %r for option "
+                            "'gunicorn.worker_memory' in part %r" % (
+                                worker_memory, self.name))
+        cpus = cpu_count()
+        memory = available_memory()
+        workers = auto_workers(cpus, memory=memory,
+                               worker_memory=worker_memory)
+        logger.info("Gunicorn workers for %d CPUs and %s bytes of "
+                    "available memory: %d", cpus, memory, workers)
+        return str(workers)
+
+    def _gunicorn_worker_settings(self, gunicorn_options):
+        """Lines of Gunicorn configuration about the type of workers.
+
+        :param gunicorn_options: the ``gunicorn.`` options, without prefix
+        """
+        worker_class = gunicorn_options.get('worker_class', '').strip()
+        lines = []
+        if worker_class:
+            if (worker_class not in GUNICORN_WORKER_CLASSES and
+                    '.' not in worker_class):
+                raise UserError(
+                    "Invalid value %r for option 'gunicorn.worker_class' in "
+                    "part %r (expecting one of %s, or a class "
+                    "path)" % (worker_class, self.name,
+                               ', '.join(GUNICORN_WORKER_CLASSES)))
+            lines.append('worker_class = %r' % worker_class)
+        for opt in ('threads', 'worker_connections'):
+            value = gunicorn_options.get(opt, '').strip()
+            if not value:
+                continue
+            if not value.isdigit() or not int(value):
+                raise UserError("Invalid value %r for option 'gunicorn.%s' "
+                                "in part %r (expecting a positive "
+                                "integer)" % (value, opt, self.name))
+            lines.append('%s = %d' % (opt, int(value)))
+        return ''.join(line + os.linesep for line in lines)
+
     def _get_server_command(self):
         """Return a full path to the main Odoo server command."""
         if major_version(self.version_detected)[0] >= 10:
@@ -0,0 +1,387 @@
+"""Extraction of main software tarballs.
+
+Tarballs are read in a single streaming pass, and extracted in a
+temporary directory, that replaces the previous tree only once complete.
+The same goes for tar streams produced by VCS commands, such as
+``git archive``.
+
+Extracted trees can also be kept in a cache directory shared by several
+buildouts, indexed by the sha256 checksum of the archives. Parts
+directories then get reflink copies of the cached files if the filesystem
+supports them, otherwise hard links to them, or plain copies. Cached files
+are read-only, and files that builds rewrite in place are never hard
+linked, so that the cache can't be altered through the parts.
+"""
+import os
+import stat
+import errno
+import shutil
+import tarfile
+import logging
+import tempfile
+import subprocess
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+try:
+    from isal import igzip as gzip_backend  # faster, if available
+except ImportError:
+    gzip_backend = None
+
+logger = logging.getLogger(__name__)
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+WRITE_JOBS = 4
+"""Number of threads writing extracted files to disk."""
+
+MAX_BUFFERED_SIZE = 1 << 20
+"""Files larger than this are written directly, instead of by the threads.
+"""
+
+REWRITTEN_DIR_SUFFIXES = ('.egg-info',)
+"""Directories whose files builds rewrite in place (``setup.py develop``).
+"""
+
+REWRITTEN_FILE_SUFFIXES = ('.pyc', '.pyo')
+"""Files that builds may rewrite in place (byte-compilation)."""
+
+WRITE_MODES = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+
+
+@contextmanager
+def open_stream(path):
+    """Open the tarball at path as a stream (sequential access only).
+
+    Gzip decompression is done by the ``isal`` library if available.
+    This is a context manager, closing the tar stream and the underlying
+    file on exit.
+    """
+    fileobj = None
+    if gzip_backend is not None:
+        with open(path, 'rb') as f:
+            magic = f.read(2)
+        if magic == GZIP_MAGIC:
+            fileobj = gzip_backend.open(path, 'rb')
+    try:
+        if fileobj is None:
+            tar = tarfile.open(path, mode='r|*')
+        else:
+            tar = tarfile.open(fileobj=fileobj, mode='r|')
+        try:
+            yield tar
+        finally:
+            tar.close()
+    finally:
+        if fileobj is not None:
+            fileobj.close()
+
+
+def in_sandbox(name, sandbox):
+    """True if the relative path ``name`` is inside ``sandbox``.
+
+    >>> in_sandbox('odoo-10/setup.py', 'odoo-10')
+    True
+    >>> in_sandbox('odoo-10/../x.py', 'odoo-10')
+    False
+    >>> in_sandbox('/etc/passwd', 'odoo-10')
+    False
+    """
+    return (not os.path.isabs(name) and
+            os.path.normpath(name).startswith(sandbox + os.sep))
+
+
+def is_safe_member(tinfo, sandbox):
+    """True if the tarball member and its link target are inside sandbox.
+
+    The tarfile module official doc warns against attacks with .. in tar,
+    and symbolic links can be used in the same way.
+
+    >>> is_safe_member(tarfile.TarInfo('odoo-10/setup.py'), 'odoo-10')
+    True
+    >>> link = tarfile.TarInfo('odoo-10/addons/etc')
+    >>> link.type, link.linkname = tarfile.SYMTYPE, '../../etc'
+    >>> is_safe_member(link, 'odoo-10')
+    False
+    >>> link.linkname = '../README'
+    >>> is_safe_member(link, 'odoo-10')
+    True
+    """
+    if not in_sandbox(tinfo.name, sandbox):
+        return False
+    if tinfo.issym():
+        return in_sandbox(os.path.join(os.path.dirname(tinfo.name),
+                                       tinfo.linkname), sandbox)
+    if tinfo.islnk():
+        return in_sandbox(tinfo.linkname, sandbox)
+    return True
+
+
+def write_member(path, data, tinfo):
+    """Write a regular file member, whose contents have already been read.
+    """
+    with open(path, 'wb') as f:
+        f.write(data)
+    os.chmod(path, tinfo.mode & 0o777)
+    os.utime(path, (tinfo.mtime, tinfo.mtime))
+
+
+def extract_members(tar, tmp_dir, pool):
+    """Extract all members of the tar stream in tmp_dir.
+
+    Small regular files are written by the threads of pool.
+
+    :returns: the name of the top directory
+    """
+    first = tar.next()
+    # Everything that follows assumes all tarball members
+    # are inside a directory with an expected name such
+    # as odoo-6.1-1
+    if first is None or not first.isdir():
+        raise ValueError("Tarball does not start with a directory")
+    top_name = first.name.split('/')[0]
+    # protection against malicious tarballs
+    if top_name in ('', '.', '..'):
+        raise ValueError("Unexpected top directory %r in tarball" % (
+            first.name))
+
+    pending = []
+    directories = []
+    for tinfo in tar:  # starts again with first
+        if tinfo is not first and not is_safe_member(tinfo, top_name):
+            logger.warn('Tarball member %r is outside of %r. Ignored.',
+                        tinfo, top_name)
+            continue
+        path = os.path.join(tmp_dir, tinfo.name)
+        if tinfo.isdir():
+            # attributes set at the end, in case they are restrictive
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            directories.append((tinfo, path))
+        elif tinfo.isfile() and tinfo.size <= MAX_BUFFERED_SIZE:
+            dirpath = os.path.dirname(path)
+            if not os.path.isdir(dirpath):
+                os.makedirs(dirpath)
+            data = tar.extractfile(tinfo).read()
+            pending.append(pool.apply_async(write_member,
+                                            (path, data, tinfo)))
+            if len(pending) > 4 * WRITE_JOBS:
+                pending.pop(0).get()
+        else:
+            if tinfo.islnk():  # the target must have been written
+                while pending:
+                    pending.pop(0).get()
+            tar.extract(tinfo, tmp_dir)
+
+    for result in pending:
+        result.get()
+    for tinfo, path in reversed(directories):
+        os.chmod(path, tinfo.mode & 0o777)
+        os.utime(path, (tinfo.mtime, tinfo.mtime))
+    return top_name
+
+
+def extract_tarball(archive_path, parent_dir):
+    """Extract the tarball at archive_path in parent_dir.
+
+    All members must be inside a single top directory, such as
+    ``odoo-10.0``, which is also the first member. Those that are outside
+    are ignored. A previously existing tree of that name is replaced
+    once the extraction is complete.
+
+    :returns: the name of the top directory
+    """
+    with open_stream(archive_path) as tar:
+        return extract_tar(tar, parent_dir)
+
+
+def extract_stream(fileobj, parent_dir):
+    """Same as :func:`extract_tarball`, reading from a file-like object.
+
+    The tar stream is uncompressed, such as the output of ``git archive``,
+    and is read sequentially, e.g, from a pipe.
+    """
+    tar = tarfile.open(fileobj=fileobj, mode='r|')
+    try:
+        return extract_tar(tar, parent_dir)
+    finally:
+        tar.close()
+
+
+def extract_tar(tar, parent_dir):
+    """Extract the open tar stream in parent_dir.
+
+    See :func:`extract_tarball` for details.
+    """
+    tmp_dir = tempfile.mkdtemp(dir=parent_dir, prefix='.extracting-')
+    try:
+        pool = ThreadPool(WRITE_JOBS)
+        try:
+            top_name = extract_members(tar, tmp_dir, pool)
+        finally:
+            pool.close()
+            pool.join()
+    except BaseException:
+        shutil.rmtree(tmp_dir)
+        raise
+
+    replace_tree(tmp_dir, top_name, parent_dir)
+    return top_name
+
+
+def replace_tree(tmp_dir, name, parent_dir):
+    """Move ``name`` from tmp_dir to parent_dir, replacing existing one.
+
+    The temporary directory must be in parent_dir (same filesystem), so that
+    the moves are simple renames. It is removed afterwards.
+    """
+    target = os.path.join(parent_dir, name)
+    old = None
+    if os.path.exists(target):
+        old = tempfile.mkdtemp(dir=parent_dir, prefix='.replaced-')
+        os.rename(target, os.path.join(old, name))
+    os.rename(os.path.join(tmp_dir, name), target)
+    os.rmdir(tmp_dir)
+    if old is not None:
+        shutil.rmtree(old)
+
+
+def set_files_writable(top, writable):
+    """Add or remove the write permissions of all files in the top tree.
+
+    For files, removing is done for everybody, whereas adding is done for
+    the owner only. Directories and symbolic links are left untouched.
+    """
+    for dirpath, dirnames, filenames in os.walk(top):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                continue
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+            if writable:
+                mode |= stat.S_IWUSR
+            else:
+                mode &= ~WRITE_MODES
+            os.chmod(path, mode)
+
+
+def hardlink_tree(src, dst, copy=False):
+    """Recreate the src tree at dst, with hard links to its files.
+
+    Files that builds rewrite in place (see :data:`REWRITTEN_DIR_SUFFIXES`
+    and :data:`REWRITTEN_FILE_SUFFIXES`) are copied instead, and made
+    writable.
+
+    :param copy: if ``True``, all files are copied
+    """
+    os.mkdir(dst)
+    copy = copy or dst.endswith(REWRITTEN_DIR_SUFFIXES)
+    for name in os.listdir(src):
+        src_path = os.path.join(src, name)
+        dst_path = os.path.join(dst, name)
+        if os.path.islink(src_path):
+            os.symlink(os.readlink(src_path), dst_path)
+        elif os.path.isdir(src_path):
+            hardlink_tree(src_path, dst_path, copy=copy)
+        elif copy or name.endswith(REWRITTEN_FILE_SUFFIXES):
+            shutil.copy2(src_path, dst_path)
+            os.chmod(dst_path,
+                     stat.S_IMODE(os.stat(dst_path).st_mode) | stat.S_IWUSR)
+        else:
+            os.link(src_path, dst_path)
+    shutil.copystat(src, dst)
+
+
+def reflink_tree(src, dst):
+    """Copy the src tree at dst with reflinks (copy-on-write clones).
+
+    Reflinks are done by GNU cp, on the filesystems that support them.
+
+    :raises: OSError or CalledProcessError if that's not possible
+    """
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(['cp', '-a', '--reflink=always', src, dst],
+                              stderr=devnull)
+
+
+def copy_tree(src, dst):
+    """Copy the src tree at dst, using reflinks if possible.
+
+    Reflinks (copy-on-write clones) are done by GNU cp, on the filesystems
+    that support them. Otherwise, this is a plain copy.
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['cp', '-a', '--reflink=auto', src, dst],
+                                  stderr=devnull)
+        return
+    except (OSError, subprocess.CalledProcessError):
+        if os.path.exists(dst):
+            shutil.rmtree(dst)
+    shutil.copytree(src, dst, symlinks=True)
+
+
+def link_tree(src, dst):
+    """Recreate the src tree at dst, sharing files as much as possible.
+
+    Reflinks are used if possible, then hard links, otherwise copies,
+    see :func:`copy_tree`. Only hard linked files stay read-only: they are
+    shared with src, and must not be modified in place.
+    """
+    try:
+        reflink_tree(src, dst)
+    except (OSError, subprocess.CalledProcessError):
+        if os.path.exists(dst):
+            shutil.rmtree(dst)
+    else:
+        set_files_writable(dst, True)
+        return
+
+    try:
+        hardlink_tree(src, dst)
+    except OSError as exc:
+        if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        logger.info("Could not hard link files from %s (%s), copying them",
+                    src, exc)
+        if os.path.exists(dst):
+            shutil.rmtree(dst)
+        copy_tree(src, dst)
+        set_files_writable(dst, True)
+
+
+def cached_extract(archive_path, sha256, cache_dir, parent_dir):
+    """Same as :func:`extract_tarball`, through a cache of extracted trees.
+
+    :param sha256: checksum of the archive, used as the cache key
+    :param cache_dir: the cache directory. Extracted trees are stored in
+                      subdirectories named after the archive checksums.
+    """
+    entry = os.path.join(cache_dir, sha256)
+    if not os.path.isdir(entry):
+        logger.info("Extracting %s to cache %s", archive_path, entry)
+        tmp_entry = tempfile.mkdtemp(dir=cache_dir, prefix=sha256 + '.tmp-')
+        try:
+            extract_tarball(archive_path, tmp_entry)
+            # protects the cache against in place writes on hard links
+            set_files_writable(tmp_entry, False)
+            os.rename(tmp_entry, entry)
+        except OSError:
+            shutil.rmtree(tmp_entry)
+            if not os.path.isdir(entry):
+                raise
+            logger.info("Cache entry %s has been concurrently created",
+                        entry)
+        except BaseException:
+            shutil.rmtree(tmp_entry)
+            raise
+
+    top_name = os.listdir(entry)[0]
+    tmp_dir = tempfile.mkdtemp(dir=parent_dir, prefix='.extracting-')
+    try:
+        link_tree(os.path.join(entry, top_name),
+                  os.path.join(tmp_dir, top_name))
+    except BaseException:
+        shutil.rmtree(tmp_dir)
+        raise
+    replace_tree(tmp_dir, top_name, parent_dir)
+    return top_name
@@ -69,6 +69,11 @@ class FakeRepo(vcs.base.BaseRepo):
     def parents(self, pip_compatible=False):
         return [self.revision]
 
+    tree_id = None
+
+    def archive_tree_id(self):
+        return self.tree_id
+
     def archive(self, target):
         if not os.path.isdir(target):
             os.makedirs(target)
@@ -0,0 +1,280 @@
+"""Tests for the index of modules in addons paths."""
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+
+from .. import addons_index
+from ..addons_index import build_index
+from ..addons_index import update_index
+from ..addons_index import load_index
+from ..addons_index import IndexedDiscovery
+from ..addons_index import module_content_hash
+from ..addons_index import module_content_hashes
+from ..addons_index import reverse_dependencies
+from ..addons_index import changed_modules
+from ..addons_index import hashes_to_record
+from ..addons_index import scan_addons_paths
+from ..addons_index import shadowed_modules
+
+
+class AddonsBaseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sandbox = mkdtemp('test_oerp_recipe_addons_index')
+        self.paths = []
+        for name in ('first', 'second'):
+            path = os.path.join(self.sandbox, name)
+            os.mkdir(path)
+            self.paths.append(path)
+        self.index_path = os.path.join(self.sandbox, 'odoo.addons-index.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.sandbox)
+
+    def make_module(self, path, name, manifest="{'version': '1.0'}",
+                    manifest_name='__manifest__.py'):
+        module_dir = os.path.join(path, name)
+        if not os.path.isdir(module_dir):
+            os.mkdir(module_dir)
+        with open(os.path.join(module_dir, manifest_name), 'w') as f:
+            f.write(manifest)
+        return module_dir
+
+
+class AddonsIndexTestCase(AddonsBaseTestCase):
+
+    def test_build(self):
+        first, second = self.paths
+        self.make_module(first, 'mod_a',
+                         "{'version': '10.0.1.0', 'depends': ['base'],"
+                         " 'installable': False}")
+        self.make_module(first, 'mod_b', manifest_name='__openerp__.py')
+        self.make_module(second, 'mod_b')
+        self.make_module(second, 'broken', "{'version': _('x')}")
+        os.mkdir(os.path.join(second, 'not_a_module'))
+
+        index = build_index(self.paths)
+        modules = index['modules']
+        self.assertEqual(sorted(modules), ['broken', 'mod_a', 'mod_b'])
+        mod_a = modules['mod_a']
+        self.assertEqual(mod_a['version'], '10.0.1.0')
+        self.assertEqual(mod_a['depends'], ['base'])
+        self.assertFalse(mod_a['installable'])
+        self.assertEqual(len(mod_a['sha1']), 40)
+        # first one wins
+        self.assertEqual(modules['mod_b']['path'],
+                         os.path.join(first, 'mod_b'))
+        self.assertEqual(modules['mod_b']['manifest'], '__openerp__.py')
+        self.assertTrue(modules['broken']['installable'])
+        self.assertIsNone(modules['broken']['version'])
+
+    def test_incremental(self):
+        first = self.paths[0]
+        self.make_module(first, 'mod_a')
+        mod_b = self.make_module(first, 'mod_b')
+        index = update_index(self.index_path, self.paths)
+        self.assertEqual(index['stats'], dict(read=2, reused=0))
+        self.assertEqual(load_index(self.index_path)['modules'],
+                         index['modules'])
+
+        index = update_index(self.index_path, self.paths)
+        self.assertEqual(index['stats'], dict(read=0, reused=2))
+
+        self.make_module(first, 'mod_b', "{'version': '2.0'}")
+        manifest = os.path.join(mod_b, '__manifest__.py')
+        st = os.stat(manifest)
+        os.utime(manifest, (st.st_atime, st.st_mtime + 10))
+        index = update_index(self.index_path, self.paths)
+        self.assertEqual(index['stats'], dict(read=1, reused=1))
+        self.assertEqual(index['modules']['mod_b']['version'], '2.0')
+
+    def test_scan_shadowed(self):
+        first, second = self.paths
+        self.make_module(first, 'mod_a')
+        self.make_module(second, 'mod_a')
+        self.make_module(first, 'mod_b', "{'version': '2.0'}")
+        self.make_module(second, 'mod_b', manifest_name='__openerp__.py')
+        self.make_module(second, 'mod_c')
+        with open(os.path.join(first, 'README'), 'w') as f:
+            f.write('not a module')
+
+        scan = scan_addons_paths(self.paths + [first], jobs=2)
+        self.assertEqual(list(scan), ['mod_a', 'mod_b', 'mod_c'])
+        self.assertEqual(scan['mod_b'],
+                         [(os.path.join(first, 'mod_b'), '__manifest__.py'),
+                          (os.path.join(second, 'mod_b'), '__openerp__.py')])
+        self.assertEqual(shadowed_modules(scan), [
+            ('mod_a', [os.path.join(p, 'mod_a') for p in self.paths], True),
+            ('mod_b', [os.path.join(p, 'mod_b') for p in self.paths], False),
+        ])
+        self.assertEqual(
+            build_index(self.paths, scan=scan)['modules']['mod_b']['version'],
+            '2.0')
+
+    def test_load_invalid(self):
+        self.assertIsNone(load_index(self.index_path))
+        with open(self.index_path, 'w') as f:
+            f.write('{"format": 0}')
+        self.assertIsNone(load_index(self.index_path))
+
+
+class IndexedDiscoveryTestCase(AddonsBaseTestCase):
+
+    def setUp(self):
+        super(IndexedDiscoveryTestCase, self).setUp()
+        self.data_dir = os.path.join(self.sandbox, 'data')
+        os.mkdir(self.data_dir)
+        self.ad_paths = [self.data_dir] + self.paths
+        self.orig_calls = []
+
+    def orig_get_modules(self):
+        self.orig_calls.append('get_modules')
+        return []
+
+    def orig_get_module_path(self, module, downloaded=False):
+        self.orig_calls.append(module)
+        return False
+
+    def discovery(self):
+        index = update_index(self.index_path, self.paths)
+        return IndexedDiscovery(index, lambda: self.ad_paths,
+                                self.orig_get_modules,
+                                self.orig_get_module_path)
+
+    def test_resolve(self):
+        first, second = self.paths
+        self.make_module(first, 'mod_a')
+        self.make_module(second, 'mod_a')
+        self.make_module(second, 'mod_b')
+        discovery = self.discovery()
+        # modules downloaded in data dir aren't indexed, and take precedence
+        self.make_module(self.data_dir, 'mod_b')
+        self.make_module(self.data_dir, 'mod_c')
+
+        self.assertEqual(sorted(discovery.get_modules()),
+                         ['mod_a', 'mod_b', 'mod_c'])
+        self.assertEqual(discovery.get_module_path('mod_a'),
+                         os.path.join(first, 'mod_a'))
+        self.assertEqual(discovery.get_module_path('mod_b'),
+                         os.path.join(self.data_dir, 'mod_b'))
+        self.assertFalse(discovery.get_module_path('unknown'))
+        self.assertEqual(self.orig_calls, ['unknown'])
+
+    def test_resolve_paths_order(self):
+        """Unindexed paths between indexed ones keep their precedence."""
+        first, second = self.paths
+        self.ad_paths = [first, self.data_dir, second]
+        self.make_module(first, 'mod_a')
+        self.make_module(second, 'mod_b')
+        discovery = self.discovery()
+        self.make_module(self.data_dir, 'mod_a')
+        self.make_module(self.data_dir, 'mod_b')
+
+        self.assertEqual(discovery.get_module_path('mod_a'),
+                         os.path.join(first, 'mod_a'))
+        self.assertEqual(discovery.get_module_path('mod_b'),
+                         os.path.join(self.data_dir, 'mod_b'))
+        self.assertEqual(self.orig_calls, [])
+
+    def test_fallback_paths_changed(self):
+        self.make_module(self.paths[0], 'mod_a')
+        discovery = self.discovery()
+        self.ad_paths.reverse()
+        self.assertEqual(discovery.get_modules(), [])
+        self.assertFalse(discovery.get_module_path('mod_a'))
+        self.assertEqual(self.orig_calls, ['get_modules', 'mod_a'])
+
+    def test_fallback_stale(self):
+        self.make_module(self.paths[0], 'mod_a')
+        index = update_index(self.index_path, self.paths)
+        index['paths_mtimes'][self.paths[1]] -= 10
+        discovery = IndexedDiscovery(index, lambda: self.ad_paths,
+                                     self.orig_get_modules,
+                                     self.orig_get_module_path)
+        self.assertEqual(discovery.stale, [self.paths[1]])
+        self.assertEqual(discovery.get_modules(), [])
+        self.assertEqual(self.orig_calls, ['get_modules'])
+
+    def test_index_path(self):
+        self.assertEqual(addons_index.index_path('/tmp/etc/odoo.cfg'),
+                         '/tmp/etc/odoo.addons-index.json')
+
+
+class ModuleContentHashTestCase(AddonsBaseTestCase):
+
+    def test_hash(self):
+        first, second = self.paths
+        mod_a = self.make_module(first, 'mod_a')
+        h = module_content_hash(mod_a)
+        self.assertEqual(h, module_content_hash(
+            self.make_module(second, 'mod_a')))
+
+        # byte-compiled and hidden files are ignored
+        for name in ('__init__.pyc', '.swp'):
+            with open(os.path.join(mod_a, name), 'w') as f:
+                f.write('ignored')
+        os.mkdir(os.path.join(mod_a, '__pycache__'))
+        with open(os.path.join(mod_a, '__pycache__', 'x.pyc'), 'w') as f:
+            f.write('ignored')
+        self.assertEqual(module_content_hash(mod_a), h)
+
+        os.mkdir(os.path.join(mod_a, 'data'))
+        with open(os.path.join(mod_a, 'data', 'data.xml'), 'w') as f:
+            f.write('<odoo/>')
+        h2 = module_content_hash(mod_a)
+        self.assertNotEqual(h2, h)
+
+        # renaming counts as a change
+        os.rename(os.path.join(mod_a, 'data', 'data.xml'),
+                  os.path.join(mod_a, 'data', 'other.xml'))
+        self.assertNotIn(module_content_hash(mod_a), (h, h2))
+
+    def test_hashes(self):
+        first, second = self.paths
+        module_dirs = dict(mod_a=self.make_module(first, 'mod_a'),
+                           mod_b=self.make_module(second, 'mod_b', "{}"))
+        hashes = module_content_hashes(module_dirs, jobs=2)
+        self.assertEqual(sorted(hashes), ['mod_a', 'mod_b'])
+        self.assertEqual(hashes['mod_b'],
+                         module_content_hash(module_dirs['mod_b']))
+        self.assertNotEqual(hashes['mod_a'], hashes['mod_b'])
+
+    def test_reverse_dependencies(self):
+        deps = dict(base=[], web=['base'], sale=['base', 'web'],
+                    sale_ext=['sale'], crm=['base'])
+        self.assertEqual(reverse_dependencies(['web', 'crm'], deps),
+                         set(['web', 'sale', 'sale_ext', 'crm']))
+        self.assertEqual(reverse_dependencies([], deps), set())
+        # unknown modules are kept
+        self.assertEqual(reverse_dependencies(['unknown'], deps),
+                         set(['unknown']))
+
+    def test_changed_not_updated(self):
+        deps = dict(base=[], sale=['base'], crm=['base'], sale_crm=['sale'])
+        stored = dict(base='0', sale='1', crm='2', sale_crm='3')
+        hashes = dict(stored, sale='1b', crm='2b')
+        self.assertEqual(changed_modules(hashes, stored, deps),
+                         ['crm', 'sale', 'sale_crm'])
+
+        # the upgrade script updates crm only
+        stored = hashes_to_record(hashes, stored, set(['crm']))
+        self.assertEqual(stored, dict(base='0', sale='1', crm='2b',
+                                      sale_crm='3'))
+        self.assertEqual(changed_modules(hashes, stored, deps),
+                         ['sale', 'sale_crm'])
+
+        # nothing updated at all
+        self.assertEqual(hashes_to_record(hashes, stored, set()), stored)
+
+        # everything updated
+        stored = hashes_to_record(hashes, stored, None)
+        self.assertEqual(changed_modules(hashes, stored, deps), [])
+
+    def test_record_unknown(self):
+        # modules without stored hash are recorded only if applied
+        hashes = dict(base='0', new='1')
+        self.assertEqual(hashes_to_record(hashes, {}, set(['base'])),
+                         dict(base='0'))
+        self.assertEqual(changed_modules(dict(base='0'), {}, dict(base=[])),
+                         ['base'])
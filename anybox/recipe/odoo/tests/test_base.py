@@ -6,8 +6,12 @@ from zc.buildout import UserError
 from ..server import BaseRecipe
 from ..base import main_software
 from ..base import WITH_ODOO_REQUIREMENTS_FILE_OPTION
+from ..base import BUILD_STATE_MANIFEST_OPTION
+from ..addons_index import load_index
+from ..addons_index import scan_addons_paths
 from ..testing import RecipeTestCase
 from ..testing import get_vcs_log
+from ..utils import working_directory_keeper
 
 TEST_DIR = os.path.dirname(__file__)
 
@@ -64,6 +68,32 @@ class TestBaseRecipe(RecipeTestCase):
         self.assertDownloadUrl(url)
         self.assertEquals(recipe.archive_filename, 'odoo-12.0.tgz')
 
+    def test_version_url_sha256(self):
+        url = 'http://download.example/future/odoo-12.0.tgz'
+        sha256 = 'ab' * 32
+        self.make_recipe(version='url %s sha256=%s' % (url, sha256))
+        self.assertDownloadUrl(url)
+        self.assertEquals(self.recipe.main_software_sha256, sha256)
+
+    def test_version_nightly_sha256_option(self):
+        sha256 = 'AB' * 32
+        self.make_recipe(version='nightly 10.0rc1c latest',
+                         **{'main-software-sha256': sha256})
+        self.assertDownloadUrl(
+            'http://nightly.odoo.com/10.0/nightly/src/10-0-nightly-latest.tbz')
+        self.assertEquals(self.recipe.main_software_sha256, sha256.lower())
+
+    def test_version_sha256_invalid(self):
+        url = 'url http://download.example/future/odoo-12.0.tgz'
+        self.assertRaises(UserError, self.make_recipe,
+                          version=url + ' sha256=abc')
+        self.assertRaises(UserError, self.make_recipe,
+                          version=url + ' sha256=' + 'ab' * 32,
+                          **{'main-software-sha256': 'cd' * 32})
+        self.assertRaises(UserError, self.make_recipe,
+                          version='local path/to/odoo',
+                          **{'main-software-sha256': 'cd' * 32})
+
     def test_base_url(self):
         self.make_recipe(version='10.0-1',
                          base_url='http://example.org/odoo')
@@ -131,6 +161,27 @@ class TestBaseRecipe(RecipeTestCase):
             self.assertRaises(UserError,
                               recipe.parse_addons, dict(addons=illformed))
 
+    def test_parse_addons_sparse(self):
+        self.make_recipe(version='git http://some/odoo odoo 10.0 '
+                         'sparse=sale,stock')
+        recipe = self.recipe
+        self.assertEquals(
+            recipe.sparse_checkout_dirs(recipe.sources[main_software][2],
+                                        main=True),
+            'odoo,openerp,setup,addons/sale,addons/stock')
+
+        recipe.parse_addons(dict(addons='git http://some/repo oca 10.0 '
+                                 'subdir=addons sparse=mod1,mod2'))
+        self.assertEquals(
+            recipe.sparse_checkout_dirs(recipe.sources['oca'][2]),
+            'addons/mod1,addons/mod2')
+
+        for invalid in ('hg http://some/repo specific default sparse=mod1',
+                        'git http://some/repo mod1 10.0 group=grp '
+                        'sparse=mod1'):
+            self.assertRaises(UserError,
+                              recipe.parse_addons, dict(addons=invalid))
+
     def test_clean(self):
         """Test clean for local server & addons and base class vcs addons.
         """
@@ -199,6 +250,115 @@ class TestBaseRecipe(RecipeTestCase):
             self.assertEquals(os.path.exists(os.path.join(server_path, *path)),
                               expected)
 
+    def make_parallel_recipe(self, jobs='3'):
+        self.make_recipe(
+            version='local server-dir',
+            addons=os.linesep.join(
+                ['fakevcs http://some/repo%d vcs-addons%d rev%d' % (i, i, i)
+                 for i in range(5)] + ['local local-addons']),
+            **{'vcs-parallel-jobs': jobs})
+        os.mkdir(os.path.join(self.recipe.buildout_dir, 'local-addons'))
+
+    def test_retrieve_addons_parallel(self):
+        self.make_parallel_recipe()
+        self.recipe.retrieve_addons()
+
+        expected = [self.path_from_buildout('vcs-addons%d' % i)
+                    for i in range(5)]
+        self.assertEqual(self.recipe.addons_paths,
+                         expected + [self.path_from_buildout('local-addons')])
+        self.assertEqual(sorted(entry[:3] for entry in get_vcs_log()),
+                         [(path, 'http://some/repo%d' % i, 'rev%d' % i)
+                          for i, path in enumerate(expected)])
+
+    def test_retrieve_addons_parallel_error(self):
+        """The first failure in declared order is the one to be raised."""
+        self.make_parallel_recipe()
+        from ..testing import FakeRepo
+        from ..vcs import UpdateError
+        orig_get_update = FakeRepo.get_update
+
+        def get_update(repo, revision):
+            if revision in ('rev1', 'rev3'):
+                raise UpdateError(1, revision)
+            return orig_get_update(repo, revision)
+
+        FakeRepo.get_update = get_update
+        try:
+            with self.assertRaises(UpdateError) as arc:
+                self.recipe.retrieve_addons()
+        finally:
+            FakeRepo.get_update = orig_get_update
+        self.assertEqual(arc.exception.cmd, 'rev1')
+        # the other sources have been fetched anyway
+        self.assertEqual(len(get_vcs_log()), 3)
+
+    def test_vcs_parallel_jobs_invalid(self):
+        for invalid in ('0', 'many'):
+            self.assertRaises(UserError, self.make_parallel_recipe,
+                              jobs=invalid)
+
+    def test_build_state(self):
+        self.make_recipe(
+            version='local server-dir',
+            addons='pr_fakevcs http://some/repo vcs-addons rev1')
+        recipe = self.recipe
+        os.mkdir(recipe.odoo_dir)
+        os.mkdir(recipe.parts)
+        setup_path = os.path.join(recipe.odoo_dir, 'setup.py')
+        with open(setup_path, 'w') as f:
+            f.write("setup(version='10.0')")
+        with open(recipe.config_path, 'w') as f:
+            f.write("[options]")
+        recipe_options = dict(recipe.options.items())
+        recipe.retrieve_addons()
+
+        inputs = recipe.build_state_inputs(recipe_options)
+        self.assertIsNone(recipe.unchanged_build_state(inputs))
+        recipe.odoo_installed = [recipe.config_path]
+        recipe.write_build_state(inputs)
+        self.assertEqual(recipe.unchanged_build_state(
+            recipe.build_state_inputs(recipe_options)), [recipe.config_path])
+
+        # any change in options, sources or setup.py is detected
+        recipe_options['options.workers'] = '3'
+        self.assertIsNone(recipe.unchanged_build_state(
+            recipe.build_state_inputs(recipe_options)))
+        del recipe_options['options.workers']
+
+        recipe.sources['vcs-addons'] = ('pr_fakevcs',
+                                        ('http://some/repo', 'rev2'), {})
+        recipe.retrieve_addons()
+        self.assertIsNone(recipe.unchanged_build_state(
+            recipe.build_state_inputs(recipe_options)))
+        recipe.write_build_state(recipe.build_state_inputs(recipe_options))
+
+        with open(setup_path, 'w') as f:
+            f.write("setup(version='10.0.1')")
+        self.assertIsNone(recipe.unchanged_build_state(
+            recipe.build_state_inputs(recipe_options)))
+
+        # an unchanged rebuild still registers the extra paths
+        recipe.options[BUILD_STATE_MANIFEST_OPTION] = 'true'
+        recipe.write_build_state(
+            recipe.build_state_inputs(dict(recipe.options.items())))
+        registered = []
+        recipe._register_extra_paths = lambda: registered.append(True)
+        recipe.install_recipe_requirements = lambda: self.fail(
+            "Unchanged build should be skipped")
+        with working_directory_keeper:
+            self.assertEqual(recipe.install(), [recipe.config_path])
+        self.assertEqual(registered, [True])
+
+    def test_build_state_missing_file(self):
+        self.make_recipe(version='local server-dir')
+        recipe = self.recipe
+        os.mkdir(recipe.parts)
+        recipe.odoo_installed = [recipe.config_path]
+        inputs = recipe.build_state_inputs({})
+        recipe.write_build_state(inputs)
+        self.assertIsNone(recipe.unchanged_build_state(inputs))
+
     def path_from_buildout(self, *relpath, **opt):
         relpath = list(relpath)
         if opt.get('from_parts'):
@@ -286,6 +446,43 @@ class TestBaseRecipe(RecipeTestCase):
         self.assertEquals(self.recipe.addons_paths,
                           [base_addons, '/some/separate/addons', odoo_addons])
 
+    def test_write_addons_index(self):
+        self.make_recipe(
+            version='git http://github.com/odoo/odoo.git odoo 10.0')
+        base_addons = os.path.join(self.recipe.odoo_dir, 'odoo', 'addons')
+        os.makedirs(os.path.join(base_addons, 'base'))
+        with open(os.path.join(base_addons, 'base',
+                               '__manifest__.py'), 'w') as f:
+            f.write("{'version': '1.3'}")
+        self.recipe.addons_paths = []
+        self.recipe.finalize_addons_paths()
+        self.recipe.write_addons_index()
+        index = load_index(self.recipe.addons_index_path)
+        self.assertEqual(index['addons_paths'], [base_addons])
+        self.assertEqual(index['modules']['base']['version'], '1.3')
+
+        self.recipe.options['addons-index'] = 'false'
+        self.recipe.write_addons_index()
+        self.assertFalse(os.path.exists(self.recipe.addons_index_path))
+
+    def test_check_shadowed_addons(self):
+        self.make_recipe(version='local path/to/odoo')
+        recipe = self.recipe
+        paths = [os.path.join(self.buildout_dir, d) for d in ('a', 'b')]
+        for i, path in enumerate(paths):
+            os.makedirs(os.path.join(path, 'mod'))
+            with open(os.path.join(path, 'mod', '__manifest__.py'), 'w') as f:
+                f.write("{'version': '1.%d'}" % i)
+        scan = scan_addons_paths(paths)
+        recipe.check_shadowed_addons(scan)
+
+        recipe.options['shadowed-addons'] = 'fail'
+        self.assertRaises(UserError, recipe.check_shadowed_addons, scan)
+        recipe.options['shadowed-addons'] = 'ignore'
+        recipe.check_shadowed_addons(scan)
+        recipe.options['shadowed-addons'] = 'explode'
+        self.assertRaises(UserError, recipe.check_shadowed_addons, scan)
+
     def make_recipe_appplying_requirements_file(self, reqs_content):
         """Prepare recipe object and requirements file
 
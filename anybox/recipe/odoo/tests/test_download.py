@@ -0,0 +1,172 @@
+"""Tests for the download of main software archives."""
+import os
+import shutil
+import hashlib
+import threading
+import unittest
+from tempfile import mkdtemp
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler  # Python 2
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler  # Python 3
+
+from zc.buildout import UserError
+from ..download import download
+from ..download import PART_SUFFIX
+from ..download import rfc822_time
+
+CONTENTS = b''.join(b'%06d\n' % i for i in range(20000))
+
+LAST_MODIFIED = 'Mon, 02 Jan 2017 10:00:00 GMT'
+
+
+class ArchiveRequestHandler(BaseHTTPRequestHandler):
+    """Serve the server ``contents``, with support for Range requests.
+
+    The other server attributes control the behaviour: ``ranges`` to support
+    them or not, ``cut_at`` to simulate a connection loss, ``etag`` for
+    conditional requests.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict((k.lower(), v)
+                                    for k, v in self.headers.items()))
+        if self.path.endswith('.html'):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.end_headers()
+            self.wfile.write(b'<html>Not found</html>')
+            return
+
+        contents = server.contents
+        if self.headers.get('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        start = 0
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if if_range is not None and if_range != server.etag:
+            range_header = None
+        if server.ranges and range_header:
+            start = int(range_header.split('=')[1].split('-')[0])
+            if start >= len(contents):
+                self.send_response(416)
+                self.send_header('Content-Range',
+                                 'bytes */%d' % len(contents))
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, len(contents) - 1, len(contents)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/x-gzip')
+        self.send_header('Content-Length', str(len(contents) - start))
+        self.send_header('ETag', server.etag)
+        self.send_header('Last-Modified', LAST_MODIFIED)
+        self.end_headers()
+        end = len(contents)
+        if server.cut_at is not None:
+            end = server.cut_at
+            server.cut_at = None
+        self.wfile.write(contents[start:end])
+
+
+class DownloadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), ArchiveRequestHandler)
+        self.server.ranges = True
+        self.server.cut_at = None
+        self.server.contents = CONTENTS
+        self.server.etag = '"v1"'
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/odoo.tgz' % self.server.server_port
+        self.dl_dir = mkdtemp('test_oerp_recipe_download')
+        self.path = os.path.join(self.dl_dir, 'odoo.tgz')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dl_dir)
+
+    def assertDownloaded(self):
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), CONTENTS)
+        self.assertFalse(os.path.exists(self.path + PART_SUFFIX))
+
+    def test_download(self):
+        download(self.url, self.path,
+                 sha256=hashlib.sha256(CONTENTS).hexdigest())
+        self.assertDownloaded()
+
+    def test_resume(self):
+        self.server.cut_at = 1000
+        self.assertRaises(IOError, download, self.url, self.path)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(os.path.getsize(self.path + PART_SUFFIX), 1000)
+
+        download(self.url, self.path,
+                 sha256=hashlib.sha256(CONTENTS).hexdigest())
+        self.assertDownloaded()
+        self.assertEqual(self.server.requests[-1].get('range'),
+                         'bytes=1000-')
+
+    def test_resume_complete_part(self):
+        with open(self.path + PART_SUFFIX, 'wb') as f:
+            f.write(CONTENTS)
+        download(self.url, self.path)
+        self.assertDownloaded()
+
+    def test_resume_unsupported(self):
+        self.server.ranges = False
+        with open(self.path + PART_SUFFIX, 'wb') as f:
+            f.write(b'garbage')
+        download(self.url, self.path)
+        self.assertDownloaded()
+
+    def test_checksum_mismatch(self):
+        self.assertRaises(UserError, download, self.url, self.path,
+                          sha256='0' * 64)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path + PART_SUFFIX))
+
+    def test_html(self):
+        self.assertRaises(LookupError, download, self.url + '.html',
+                          self.path)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path + PART_SUFFIX))
+
+    def test_conditional(self):
+        self.assertTrue(download(self.url, self.path))
+        self.assertEqual(rfc822_time(LAST_MODIFIED),
+                         int(os.path.getmtime(self.path)))
+
+        self.assertFalse(download(self.url, self.path, conditional=True))
+        self.assertEqual(self.server.requests[-1].get('if-none-match'),
+                         '"v1"')
+
+        self.server.etag = '"v2"'
+        self.server.contents = b'new contents'
+        self.assertTrue(download(self.url, self.path, conditional=True))
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), b'new contents')
+
+    def test_resume_changed(self):
+        self.server.cut_at = 1000
+        self.assertRaises(IOError, download, self.url, self.path)
+        self.server.etag = '"v2"'
+        self.server.contents = b'new contents'
+        download(self.url, self.path)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), b'new contents')
+        self.assertEqual(self.server.requests[-1].get('if-range'), '"v1"')
@@ -5,6 +5,7 @@ from ConfigParser import ConfigParser, NoOptionError
 from ..base import GP_VCS_EXTEND_DEVELOP
 from ..base import GP_DEVELOP_DIR
 from ..testing import RecipeTestCase
+from ..testing import FakeRepo
 
 
 class TestExtraction(RecipeTestCase):
@@ -60,6 +61,30 @@ class TestExtraction(RecipeTestCase):
                                '.fake_archival.txt')) as f:
             self.assertEquals(f.read(), 'fakerev')
 
+    def test_extract_addons_incremental(self):
+        """Unchanged VCS trees are not exported again."""
+        target_dir = self.extract_target_dir
+        self.make_recipe(version='local mainsoftware',
+                         addons='fakevcs http://some/repo vcs-addons rev')
+        archival = os.path.join(target_dir, 'vcs-addons',
+                                '.fake_archival.txt')
+        FakeRepo.tree_id = 'tree1'
+        try:
+            self.recipe._extract_sources(ConfigParser(), target_dir, set())
+            with open(archival, 'w') as f:
+                f.write('untouched')
+
+            self.recipe._extract_sources(ConfigParser(), target_dir, set())
+            with open(archival) as f:
+                self.assertEquals(f.read(), 'untouched')
+
+            FakeRepo.tree_id = 'tree2'
+            self.recipe._extract_sources(ConfigParser(), target_dir, set())
+            with open(archival) as f:
+                self.assertEquals(f.read(), 'fakerev')
+        finally:
+            FakeRepo.tree_id = None
+
     def test_extract_addons_revisions(self):
         """Test extract_downloads_to about revisions overriding.
 
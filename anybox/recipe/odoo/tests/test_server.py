@@ -4,6 +4,7 @@ NB: zc.buildout.testing provides utilities for integration tests, with
 an embedded http server, etc.
 """
 import os
+from multiprocessing import cpu_count
 from pkg_resources import Requirement
 
 from ..base import MissingDistribution
@@ -425,6 +426,63 @@ class TestServer(RecipeTestCase):
         self.test_gunicorn_preload_databases(databases='db1\ndb2',
                                              expected="('db1', 'db2')")
 
+    def test_gunicorn_preload_app(self):
+        self.make_recipe(version='local %s' % os.path.join(TEST_DIR, 'odoo10'),
+                         gunicorn='direct')
+        self.recipe.version_detected = "10.0"
+        self.recipe.options['gunicorn.preload_databases'] = 'db1\ndb2'
+        self.recipe.options['gunicorn.preload_app'] = 'True'
+
+        self.install_scripts()
+
+        gunicorn_conf = os.path.join(self.recipe.etc,
+                                     'gunicorn_odoo.conf.py')
+        with open(gunicorn_conf) as conf:
+            source = conf.read()
+        compile(source, gunicorn_conf, 'exec')
+        lines = source.splitlines()
+        self.assertTrue('preload_app = True' in lines)
+        self.assertTrue("preload_dbs = ('db1', 'db2')" in lines)
+        for hook in ('on_starting', 'when_ready', 'post_fork'):
+            self.assertTrue('def %s(server' % hook in source)
+        # no registry loading in workers
+        self.assertFalse('Worker loading database' in source)
+
+    def test_gunicorn_workers(self):
+        self.make_recipe(version='local %s' % os.path.join(TEST_DIR, 'odoo10'),
+                         gunicorn='direct')
+        self.recipe.version_detected = "10.0"
+        self.recipe.options.update({
+            'gunicorn.workers': 'auto',
+            'gunicorn.worker_memory': '1',
+            'gunicorn.worker_class': 'gthread',
+            'gunicorn.threads': '4',
+        })
+
+        self.install_scripts()
+
+        with open(os.path.join(self.recipe.etc,
+                               'gunicorn_odoo.conf.py')) as conf:
+            lines = conf.read().splitlines()
+        self.assertTrue('workers = %d' % (2 * cpu_count() + 1) in lines)
+        self.assertTrue("worker_class = 'gthread'" in lines)
+        self.assertTrue('threads = 4' in lines)
+
+    def test_gunicorn_workers_invalid(self):
+        self.make_recipe(version='local %s' % os.path.join(TEST_DIR, 'odoo10'),
+                         gunicorn='direct')
+        self.recipe.version_detected = "10.0"
+        for opt, value in (('worker_class', 'eventlet'),
+                           ('threads', 'many'),
+                           ('worker_memory', 'lots')):
+            options = {'gunicorn.workers': 'auto'}
+            options['gunicorn.' + opt] = value
+            self.recipe.options.update(options)
+            self.assertRaises(UserError,
+                              self.recipe._create_gunicorn_conf,
+                              'gunicorn_odoo')
+            del self.recipe.options['gunicorn.' + opt]
+
     def test_install_scripts_10_server_wide_modules(self):
         self.make_recipe(version='local %s' % os.path.join(TEST_DIR, 'odoo10'),
                          gunicorn='direct',
@@ -0,0 +1,253 @@
+"""Tests for the extraction of main software tarballs."""
+import os
+import io
+import gzip
+import stat
+import errno
+import shutil
+import tarfile
+import unittest
+from tempfile import mkdtemp
+
+from .. import tarball
+from ..tarball import extract_tarball
+from ..tarball import cached_extract
+
+
+class TarballBaseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sandbox = mkdtemp('test_oerp_recipe_tarball')
+        self.parts = os.path.join(self.sandbox, 'parts')
+        os.mkdir(self.parts)
+        self.archive_path = os.path.join(self.sandbox, 'odoo.tar.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.sandbox)
+
+    def make_tarball(self, members):
+        """Create the tarball from a list of (name, contents) pairs.
+
+        Directories have ``None`` contents, symbolic links are specified
+        with a ``('symlink', target)`` tuple.
+        """
+        tar = tarfile.open(self.archive_path, 'w:gz')
+        for name, contents in members:
+            tinfo = tarfile.TarInfo(name)
+            tinfo.mtime = 1000000000
+            if contents is None:
+                tinfo.type = tarfile.DIRTYPE
+                tinfo.mode = 0o755
+                tar.addfile(tinfo)
+            elif isinstance(contents, tuple):
+                tinfo.type = tarfile.SYMTYPE
+                tinfo.linkname = contents[1]
+                tar.addfile(tinfo)
+            else:
+                tinfo.size = len(contents)
+                tinfo.mode = 0o644
+                tar.addfile(tinfo, io.BytesIO(contents))
+        tar.close()
+
+    def read(self, *path):
+        with open(os.path.join(self.parts, *path), 'rb') as f:
+            return f.read()
+
+
+class TarballTestCase(TarballBaseTestCase):
+
+    def test_extract(self):
+        self.make_tarball([('odoo-10.0', None),
+                           ('odoo-10.0/setup.py', b'setup()'),
+                           ('odoo-10.0/odoo', None),
+                           ('odoo-10.0/odoo/big.py', b'x' * (3 << 20)),
+                           ] + [('odoo-10.0/odoo/mod%d.py' % i, b'%d' % i)
+                                for i in range(50)])
+        self.assertEqual(extract_tarball(self.archive_path, self.parts),
+                         'odoo-10.0')
+        self.assertEqual(self.read('odoo-10.0', 'setup.py'), b'setup()')
+        self.assertEqual(self.read('odoo-10.0', 'odoo', 'big.py'),
+                         b'x' * (3 << 20))
+        for i in range(50):
+            self.assertEqual(self.read('odoo-10.0', 'odoo', 'mod%d.py' % i),
+                             b'%d' % i)
+        self.assertEqual(
+            os.path.getmtime(os.path.join(self.parts, 'odoo-10.0')),
+            1000000000)
+        self.assertEqual(os.listdir(self.parts), ['odoo-10.0'])
+
+    def test_replace(self):
+        old_path = os.path.join(self.parts, 'odoo-10.0', 'old.py')
+        os.mkdir(os.path.dirname(old_path))
+        with open(old_path, 'w') as f:
+            f.write("old")
+        self.make_tarball([('odoo-10.0', None),
+                           ('odoo-10.0/setup.py', b'setup()')])
+        extract_tarball(self.archive_path, self.parts)
+        self.assertFalse(os.path.exists(old_path))
+        self.assertEqual(os.listdir(self.parts), ['odoo-10.0'])
+
+    def test_outside_members(self):
+        self.make_tarball([('odoo-10.0', None),
+                           ('odoo-10.0/../evil.py', b'evil'),
+                           ('other/evil.py', b'evil'),
+                           ('odoo-10.0/etc', ('symlink', '../../etc')),
+                           ('odoo-10.0/link', ('symlink', 'setup.py')),
+                           ('odoo-10.0/setup.py', b'setup()')])
+        extract_tarball(self.archive_path, self.parts)
+        self.assertEqual(sorted(os.listdir(self.parts)), ['odoo-10.0'])
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.parts, 'odoo-10.0'))),
+            ['link', 'setup.py'])
+        self.assertEqual(self.read('odoo-10.0', 'link'), b'setup()')
+
+    def test_error_keeps_previous(self):
+        old_path = os.path.join(self.parts, 'odoo-10.0', 'old.py')
+        os.mkdir(os.path.dirname(old_path))
+        with open(old_path, 'w') as f:
+            f.write("old")
+        with open(self.archive_path, 'wb') as f:
+            f.write(b'not a tarball')
+        self.assertRaises(tarfile.TarError,
+                          extract_tarball, self.archive_path, self.parts)
+        self.assertTrue(os.path.exists(old_path))
+        self.assertEqual(os.listdir(self.parts), ['odoo-10.0'])
+
+
+class GzipBackendTestCase(TarballBaseTestCase):
+    """Extraction through the alternative gzip backend (isal)."""
+
+    def setUp(self):
+        super(GzipBackendTestCase, self).setUp()
+        self.opened = []
+        self.orig_backend = tarball.gzip_backend
+        tarball.gzip_backend = self  # stands for isal.igzip
+
+    def tearDown(self):
+        tarball.gzip_backend = self.orig_backend
+        super(GzipBackendTestCase, self).tearDown()
+
+    def open(self, path, mode):
+        fileobj = gzip.open(path, mode)
+        self.opened.append(fileobj)
+        return fileobj
+
+    def test_extract(self):
+        self.make_tarball([('odoo-10.0', None),
+                           ('odoo-10.0/setup.py', b'setup()')])
+        extract_tarball(self.archive_path, self.parts)
+        self.assertEqual(self.read('odoo-10.0', 'setup.py'), b'setup()')
+        self.assertEqual(len(self.opened), 1)
+        self.assertTrue(self.opened[0].closed)
+
+    def test_error(self):
+        self.make_tarball([('odoo-10.0', None),
+                           ('odoo-10.0/setup.py', b'setup()' * 1000)])
+        with open(self.archive_path, 'rb') as f:
+            truncated = f.read(50)
+        with open(self.archive_path, 'wb') as f:
+            f.write(truncated)
+        self.assertRaises((EOFError, IOError, tarfile.TarError),
+                          extract_tarball, self.archive_path, self.parts)
+        self.assertTrue(self.opened[0].closed)
+
+    def test_not_gzip(self):
+        with open(self.archive_path, 'wb') as f:
+            f.write(b'not a tarball')
+        self.assertRaises(tarfile.TarError,
+                          extract_tarball, self.archive_path, self.parts)
+        self.assertEqual(self.opened, [])
+
+
+class CachedExtractTestCase(TarballBaseTestCase):
+
+    def setUp(self):
+        super(CachedExtractTestCase, self).setUp()
+        self.cache_dir = os.path.join(self.sandbox, 'cache')
+        os.mkdir(self.cache_dir)
+        self.make_tarball([('odoo-10.0', None),
+                           ('odoo-10.0/setup.py', b'setup()'),
+                           ('odoo-10.0/link', ('symlink', 'setup.py')),
+                           ('odoo-10.0/odoo.egg-info', None),
+                           ('odoo-10.0/odoo.egg-info/PKG-INFO', b'10.0')])
+        # reflinks depend on the filesystem, tests using them force them
+        self.orig_reflink_tree = tarball.reflink_tree
+        tarball.reflink_tree = self.no_reflink_tree
+
+    def tearDown(self):
+        tarball.reflink_tree = self.orig_reflink_tree
+        super(CachedExtractTestCase, self).tearDown()
+
+    def no_reflink_tree(self, src, dst):
+        raise OSError(errno.EOPNOTSUPP, "Operation not supported")
+
+    def cached_path(self, *path):
+        return os.path.join(self.cache_dir, 'ab' * 32, 'odoo-10.0', *path)
+
+    def extract(self, parent_dir):
+        if not os.path.exists(parent_dir):
+            os.mkdir(parent_dir)
+        return cached_extract(self.archive_path, 'ab' * 32, self.cache_dir,
+                              parent_dir)
+
+    def test_cached_extract(self):
+        other_parts = os.path.join(self.sandbox, 'other-parts')
+        self.assertEqual(self.extract(self.parts), 'odoo-10.0')
+        # the archive is not read any more
+        os.unlink(self.archive_path)
+        self.assertEqual(self.extract(other_parts), 'odoo-10.0')
+
+        self.assertEqual(os.listdir(self.cache_dir), ['ab' * 32])
+        paths = [os.path.join(parent, 'odoo-10.0', 'setup.py')
+                 for parent in (self.parts, other_parts)]
+        self.assertEqual(os.stat(paths[0]).st_ino, os.stat(paths[1]).st_ino)
+        self.assertEqual(self.read('odoo-10.0', 'link'), b'setup()')
+        # hard linked files are read-only
+        self.assertFalse(os.stat(paths[0]).st_mode & tarball.WRITE_MODES)
+
+    def test_cached_extract_write_in_parts(self):
+        self.extract(self.parts)
+        # what setup.py develop does
+        pkg_info = os.path.join(self.parts, 'odoo-10.0', 'odoo.egg-info',
+                                'PKG-INFO')
+        with open(pkg_info, 'wb') as f:
+            f.write(b'rewritten')
+        self.assertEqual(self.read('odoo-10.0', 'odoo.egg-info', 'PKG-INFO'),
+                         b'rewritten')
+        with open(self.cached_path('odoo.egg-info', 'PKG-INFO'), 'rb') as f:
+            self.assertEqual(f.read(), b'10.0')
+
+    def test_cached_extract_reflinks(self):
+        def reflink_tree(src, dst):
+            shutil.copytree(src, dst, symlinks=True)
+
+        tarball.reflink_tree = reflink_tree
+        self.extract(self.parts)
+        setup_path = os.path.join(self.parts, 'odoo-10.0', 'setup.py')
+        self.assertTrue(os.stat(setup_path).st_mode & stat.S_IWUSR)
+        with open(setup_path, 'wb') as f:
+            f.write(b'patched')
+        self.assertEqual(self.read('odoo-10.0', 'setup.py'), b'patched')
+        with open(self.cached_path('setup.py'), 'rb') as f:
+            self.assertEqual(f.read(), b'setup()')
+
+    def test_cached_extract_no_hardlinks(self):
+        def hardlink_tree(src, dst):
+            os.mkdir(dst)
+            raise OSError(errno.EXDEV, "Cross-device link")
+
+        orig_hardlink_tree = tarball.hardlink_tree
+        tarball.hardlink_tree = hardlink_tree
+        try:
+            self.extract(self.parts)
+        finally:
+            tarball.hardlink_tree = orig_hardlink_tree
+        self.assertEqual(self.read('odoo-10.0', 'setup.py'), b'setup()')
+        cached = self.cached_path('setup.py')
+        self.assertNotEqual(
+            os.stat(cached).st_ino,
+            os.stat(os.path.join(self.parts, 'odoo-10.0',
+                                 'setup.py')).st_ino)
+        # private copies are writable
+        self.assertTrue(os.stat(os.path.join(
+            self.parts, 'odoo-10.0', 'setup.py')).st_mode & stat.S_IWUSR)
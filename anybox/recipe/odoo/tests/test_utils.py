@@ -2,9 +2,14 @@ import unittest
 import tempfile
 import shutil
 import os
+import sys
+import traceback
 from datetime import timedelta
 
 from ..utils import working_directory_keeper, total_seconds
+from ..utils import byte_compile
+from ..utils import call_in_threads
+from ..utils import reraise
 
 
 class WorkingDirectoryTestCase(unittest.TestCase):
@@ -32,3 +37,58 @@ class VariousTestCase(unittest.TestCase):
         self.assertEqual(total_seconds(timedelta(1, 2)), 86402.0)
         self.assertEqual(total_seconds(timedelta(0, -3)), -3.0)
         self.assertEqual(total_seconds(timedelta(0, 12, 35000)), 12.035)
+
+    def test_reraise(self):
+        def failing():
+            raise ValueError("in thread")
+
+        exc_info = call_in_threads(failing, [()], 1)[0][1]
+        try:
+            reraise(exc_info)
+        except ValueError:
+            tb = traceback.extract_tb(sys.exc_info()[2])
+        self.assertEqual(tb[-1][2], 'failing')
+
+
+class ByteCompileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def write(self, *path, **kwargs):
+        path = os.path.join(self.dirpath, *path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(kwargs.get('content', 'x = 1\n'))
+
+    def compiled(self, *path):
+        """True if the source file at path has an object file."""
+        path = os.path.join(self.dirpath, *path)
+        if sys.version_info < (3,):
+            return os.path.exists(path + 'c')
+        cache_dir = os.path.join(os.path.dirname(path), '__pycache__')
+        return any(f.startswith(os.path.basename(path)[:-3] + '.')
+                   for f in os.listdir(cache_dir))
+
+    def test_byte_compile(self):
+        for i in range(5):
+            self.write('odoo', 'mod%d.py' % i)
+        self.write('addons', 'mod', '__init__.py')
+        self.write('addons', '.git', 'hook.py')
+        self.write('addons', 'mod', 'broken.py', content='def (\n')
+
+        count, errors = byte_compile(
+            [os.path.join(self.dirpath, 'odoo'),
+             os.path.join(self.dirpath, 'addons')], 3)
+        self.assertEqual(count, 7)
+        self.assertEqual(len(errors), 1)
+        self.assertTrue('broken.py' in errors[0])
+        for i in range(5):
+            self.assertTrue(self.compiled('odoo', 'mod%d.py' % i))
+        self.assertTrue(self.compiled('addons', 'mod', '__init__.py'))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.dirpath, 'addons', '.git', 'hook.pyc')))
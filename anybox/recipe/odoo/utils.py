@@ -2,7 +2,9 @@ import os
 import sys
 import re
 import subprocess
+import tempfile
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 try:
     from ConfigParser import DuplicateSectionError  # Python 2
 except ImportError:
@@ -125,6 +127,116 @@ def clean_object_files(directory):
                              "Proceeding anyway.", p)
 
 
+def python_source_files(directories):
+    """Recursively list the Python source files in given directories.
+
+    Hidden directories (such as VCS control directories) are skipped, and
+    files are listed only once even if directories are nested.
+    """
+    seen = set()
+    sources = []
+    for directory in directories:
+        for dirpath, dirnames, filenames in os.walk(directory):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+            for f in sorted(filenames):
+                path = os.path.join(dirpath, f)
+                if f.endswith('.py') and path not in seen:
+                    seen.add(path)
+                    sources.append(path)
+    return sources
+
+
+def byte_compile(directories, jobs, optimize=0, python=sys.executable):
+    """Byte-compile the Python source files in directories, in parallel.
+
+    The files are spread over ``jobs`` processes, each running the standard
+    :mod:`compileall` module. As such, files whose object file is up to date
+    are not compiled again.
+
+    :param optimize: optimization level of the object files, as with the
+                     ``-O`` flags of the interpreter (0, 1 or 2)
+    :param python: the interpreter to compile for
+    :returns: the number of source files, and a list of the outputs of
+              processes that reported errors (typically, syntax errors in
+              files not meant for this version of Python).
+    """
+    sources = python_source_files(directories)
+    chunks = [sources[i::jobs] for i in range(jobs)]
+    cmd = [python] + ['-O'] * optimize + ['-m', 'compileall', '-q', '-i', '-']
+    procs = []
+    for chunk in chunks:
+        if not chunk:
+            continue
+        # temporary files rather than pipes, so that the processes never
+        # block on them while we are waiting for another one
+        listing = tempfile.TemporaryFile('w+')
+        listing.write('\n'.join(chunk) + '\n')
+        listing.seek(0)
+        output = tempfile.TemporaryFile('w+')
+        procs.append((subprocess.Popen(cmd, stdin=listing, stdout=output,
+                                       stderr=subprocess.STDOUT),
+                      listing, output))
+
+    errors = []
+    for proc, listing, output in procs:
+        proc.wait()
+        listing.close()
+        if proc.returncode:
+            output.seek(0)
+            errors.append(output.read())
+        output.close()
+    return len(sources), errors
+
+
+def call_in_threads(func, arglists, jobs):
+    """Call ``func`` on each of the given argument tuples in a thread pool.
+
+    At most ``jobs`` calls are running concurrently. Exceptions are not
+    raised, but collected, so that the caller can decide what to report
+    and in which order.
+
+    >>> call_in_threads(lambda x, y: x // y, [(4, 2), (1, 0), (9, 3)], 2)[0]
+    (2, None)
+    >>> res, exc_info = call_in_threads(lambda x, y: x // y, [(1, 0)], 2)[0]
+    >>> exc_info[0] is ZeroDivisionError
+    True
+
+    :returns: a list of pairs ``(result, exc_info)``, in the same order as
+              ``arglists``, where ``exc_info`` is ``None`` unless the call
+              raised an exception, in which case it is the value returned
+              by :func:`sys.exc_info`.
+    """
+    def wrapped(args):
+        try:
+            return func(*args), None
+        except Exception:
+            return None, sys.exc_info()
+
+    arglists = list(arglists)
+    if not arglists:
+        return []
+    pool = ThreadPool(min(jobs, len(arglists)))
+    try:
+        return pool.map(wrapped, arglists)
+    finally:
+        pool.close()
+        pool.join()
+
+
+if sys.version_info >= (3,):
+    def reraise(exc_info):
+        """Raise again the exception of exc_info, with its traceback.
+
+        :param exc_info: as returned by :func:`sys.exc_info`, e.g., from
+                         :func:`call_in_threads`.
+        """
+        raise exc_info[1].with_traceback(exc_info[2])
+else:
+    # Python 2 syntax, that would not even compile with Python 3
+    exec("def reraise(exc_info):\n"
+         "    raise exc_info[0], exc_info[1], exc_info[2]\n")
+
+
 def check_output(*popenargs, **kwargs):
     r"""Backport of subprocess.check_output from python 2.7.
 
@@ -263,6 +375,66 @@ def total_seconds(td):
              (td.seconds + td.days * 24 * 3600) * 1e6) / 10**6)
 
 
+SIZE_UNITS = dict(K=1 << 10, M=1 << 20, G=1 << 30)
+
+
+def parse_size(size):
+    """Parse a memory size, in bytes or with a K, M or G suffix.
+
+    >>> parse_size('512M')
+    536870912
+    >>> parse_size('1g')
+    1073741824
+    >>> parse_size('4096')
+    4096
+    """
+    size = size.strip().upper()
+    if size.endswith('B'):
+        size = size[:-1]
+    factor = SIZE_UNITS.get(size[-1:])
+    if factor is not None:
+        size = size[:-1]
+    return int(size) * (factor or 1)
+
+
+def available_memory():
+    """Return the memory available to new processes, in bytes.
+
+    This is ``MemAvailable`` from ``/proc/meminfo`` on Linux, the physical
+    memory size on other POSIX systems, or ``None`` if neither can be read.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def auto_workers(cpus, memory=None, worker_memory=None):
+    """Number of worker processes for a host, as advised by Gunicorn.
+
+    This is ``2 * cpus + 1``, capped by the number of workers that fit in
+    the available memory, given the memory footprint of one worker.
+
+    >>> auto_workers(4)
+    9
+    >>> auto_workers(4, memory=4 << 30, worker_memory=1 << 30)
+    4
+    >>> auto_workers(4, memory=256 << 20, worker_memory=1 << 30)
+    1
+    """
+    workers = 2 * cpus + 1
+    if memory is not None and worker_memory:
+        workers = min(workers, memory // worker_memory)
+    return max(1, workers)
+
+
 def conf_ensure_section(conf, section):
     try:
         conf.add_section(section)
@@ -192,5 +192,38 @@ class BaseRepo(object):
         """
         raise NotImplementedError
 
+    def freeze_status(self, revspec=None, pip_compatible=False,
+                      check_changes=True):
+        """Return all the information needed to freeze the repository.
+
+        This is meant for subclasses to get it with as few VCS commands
+        as possible. The default implementation just combines
+        :meth:`uncommitted_changes`, :meth:`is_local_fixed_revision` and
+        :meth:`parents`.
+
+        :param revspec: if not ``None``, a revision specification to check
+                        for being a fixed revision.
+        :param pip_compatible: same as in :meth:`parents`.
+        :param check_changes: if ``False``, uncommitted changes may not be
+                              checked, and ``dirty`` is then ``None``.
+        :returns: a triple ``(dirty, parents, fixed)``, where ``dirty`` is
+                  the result of :meth:`uncommitted_changes`, and ``fixed``
+                  tells if ``revspec`` is a local fixed revision that can be
+                  used as such to freeze the current state.
+        """
+        dirty = self.uncommitted_changes() if check_changes else None
+        fixed = (revspec is not None and
+                 self.is_local_fixed_revision(revspec))
+        return dirty, self.parents(pip_compatible=pip_compatible), fixed
+
     def archive(self, target_path):
         raise NotImplementedError
+
+    def archive_tree_id(self):
+        """Return an identifier of the contents that :meth:`archive` exports.
+
+        Two archives of the same tree identifier are identical, which allows
+        to skip exporting again. Concrete subclasses return ``None`` if they
+        don't have such a notion.
+        """
+        return None
@@ -14,7 +14,6 @@ from copy import deepcopy
 
 from zc.buildout import UserError
 from ..utils import use_or_open
-from ..utils import working_directory_keeper
 from ..utils import check_output
 from .base import SUBPROCESS_ENV
 from .base import BaseRepo
@@ -83,8 +82,6 @@ class BzrBranch(BaseRepo):
                         for name, url in (
                             line.split('=', 1) for line in conffile
                             if not line.startswith('#') and '=' in line))
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
 
     def write_conf(self, conf, to_file=None):
         """Write counterpart to :meth:`read_conf`
@@ -182,19 +179,14 @@ class BzrBranch(BaseRepo):
         if not os.path.exists(self.target_dir):
             # not branched yet, there's nothing to clean
             return
-            subprocess.check_call(['bzr', 'clean-tree',
-                                   '--ignored', '--force'])
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
-            subprocess.check_call(['bzr', 'clean-tree',
-                                   '--ignored', '--force'])
+        subprocess.check_call(['bzr', 'clean-tree', '--ignored', '--force'],
+                              cwd=self.target_dir)
 
     def revert(self, revision):
         logger.info("Reverting bzr repo at %s to revision %r", self.target_dir,
                     revision)
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
-            subprocess.check_call(['bzr', 'revert', '-r', revision])
+        subprocess.check_call(['bzr', 'revert', '-r', revision],
+                              cwd=self.target_dir)
 
     def _update(self, revision):
         """Update existing branch at target dir to given revision.
@@ -211,23 +203,21 @@ class BzrBranch(BaseRepo):
         :param str revision: any valid revision string.
         :raises: :class:`LookupError` if not actually available.
         """
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
-            try:
-                log = check_output(
-                    ['bzr', 'log', '--show-ids', '-r', revision],
-                    env=SUBPROCESS_ENV)
-            except subprocess.CalledProcessError as exc:
-                if exc.returncode != 3:
-                    raise
-                raise LookupError(
-                    "could not find revision id for %r" % revision)
+        try:
+            log = check_output(
+                ['bzr', 'log', '--show-ids', '-r', revision],
+                env=SUBPROCESS_ENV, cwd=self.target_dir)
+        except subprocess.CalledProcessError as exc:
+            if exc.returncode != 3:
+                raise
+            raise LookupError(
+                "could not find revision id for %r" % revision)
 
-            prefix = 'revision-id:'
-            for line in log.split(os.linesep):
-                if line.startswith(prefix):
-                    return line[len(prefix):].strip()
-            raise LookupError("could not find revision id for %r" % revision)
+        prefix = 'revision-id:'
+        for line in log.split(os.linesep):
+            if line.startswith(prefix):
+                return line[len(prefix):].strip()
+        raise LookupError("could not find revision id for %r" % revision)
 
     def is_revno(self, revspec, fixed=False):
         """True iff revspec is a fixed revision number.
@@ -421,6 +411,5 @@ class BzrBranch(BaseRepo):
                               env=SUBPROCESS_ENV)
 
     def archive(self, target_path):
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
-            subprocess.check_call(['bzr', 'export', target_path])
+        subprocess.check_call(['bzr', 'export', target_path],
+                              cwd=self.target_dir)
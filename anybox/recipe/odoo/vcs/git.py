@@ -1,22 +1,30 @@
 import os
+import shutil
 import subprocess
 import logging
 import tempfile
+import hashlib
+import threading
 
 from zc.buildout import UserError
 from .. import utils
-from ..utils import working_directory_keeper
+from .. import tarball
 from ..utils import check_output
+from . import gitreader
 from .base import BaseRepo
 from .base import SUBPROCESS_ENV
 from .base import update_check_call
 from .base import update_check_output
+from .base import clone_check_call
 from .base import UpdateError
 
 logger = logging.getLogger(__name__)
 
 BUILDOUT_ORIGIN = 'origin'
 
+PARTIAL_CLONE_FILTERS = ('blob:none', 'tree:0')
+"""Supported values for the ``filter`` option (see git-rev-list(1))."""
+
 
 def ishex(s):
     """True iff given string is a valid hexadecimal number.
@@ -42,6 +50,13 @@ class GitRepo(BaseRepo):
 
     _git_version = None
 
+    _remote_refs = {}
+
+    _remote_urls = {}
+
+    _locks = {}
+    _locks_lock = threading.Lock()
+
     def __init__(self, *args, **kwargs):
         super(GitRepo, self).__init__(*args, **kwargs)
         depth = self.options.pop('depth', None)
@@ -58,6 +73,23 @@ class GitRepo(BaseRepo):
                 raise invalid
             self.options['depth'] = depth
 
+        filter_spec = self.options.pop('git-filter', None)
+        filter_spec = self.options.pop('filter', filter_spec)
+        if filter_spec is not None and filter_spec != 'None':
+            if filter_spec not in PARTIAL_CLONE_FILTERS:
+                raise UserError(
+                    "Invalid filter %r for Git repository at %r. "
+                    "Supported values: %s" % (
+                        filter_spec, self.target_dir,
+                        ', '.join(PARTIAL_CLONE_FILTERS)))
+            self.options['filter'] = filter_spec
+
+        sparse = self.options.pop('sparse', None)
+        if sparse:
+            self.options['sparse'] = sorted(set(
+                d.strip().strip('/') for d in sparse.split(',')
+                if d.strip().strip('/')))
+
     @property
     def git_version(self):
         cls = self.__class__
@@ -141,46 +173,97 @@ class GitRepo(BaseRepo):
                  log_level=logging.INFO, **kw):
             """Wrap a subprocess call with logging
 
+            Unless specified, the call is done from the target directory.
+            The current working directory of the process is never changed,
+            so that several repositories can be handled concurrently.
+
             :param meth: the calling method to use.
             """
+            kw.setdefault('cwd', self.target_dir)
             logger.log(log_level, "%s> call %r", self.target_dir, cmd)
             return callwith(cmd, **kw)
 
     def clean(self):
         if not os.path.isdir(self.target_dir):
             return
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
-            subprocess.check_call(['git', 'clean', '-fdqx'])
+        subprocess.check_call(['git', 'clean', '-fdqx'], cwd=self.target_dir)
+
+    def reader(self):
+        """Return a :class:`gitreader.GitReader` for the local repository.
+
+        Its methods raise :class:`gitreader.UnsupportedRepository` if the
+        git command line must be used instead.
+        """
+        return gitreader.GitReader(self.target_dir)
 
     def parents(self, pip_compatible=False):
         """Return full hash of parent nodes.
 
         :param pip_compatible: ignored, all Git revspecs are pip compatible
         """
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
-            p = subprocess.Popen(['git', 'rev-parse', '--verify', 'HEAD'],
-                                 stdout=subprocess.PIPE, env=SUBPROCESS_ENV)
-            return p.communicate()[0].split()
+        try:
+            with self.reader() as reader:
+                head = reader.read_ref('HEAD')
+            return [] if head is None else [head]
+        except gitreader.UnsupportedRepository:
+            pass
+        p = subprocess.Popen(['git', 'rev-parse', '--verify', 'HEAD'],
+                             stdout=subprocess.PIPE, env=SUBPROCESS_ENV,
+                             cwd=self.target_dir)
+        return p.communicate()[0].split()
 
     def uncommitted_changes(self):
         """True if we have uncommitted changes."""
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
-            p = subprocess.Popen(['git', 'status', '--short'],
-                                 stdout=subprocess.PIPE, env=SUBPROCESS_ENV)
-            out = p.communicate()[0]
-            return bool(out.strip())
+        p = subprocess.Popen(['git', 'status', '--short'],
+                             stdout=subprocess.PIPE, env=SUBPROCESS_ENV,
+                             cwd=self.target_dir)
+        out = p.communicate()[0]
+        return bool(out.strip())
+
+    def freeze_status(self, revspec=None, pip_compatible=False,
+                      check_changes=True):
+        """Same as the base class method, with at most two git commands.
+
+        ``git status --porcelain=v2 --branch`` gives both the HEAD commit
+        and the uncommitted changes, and ``revspec`` is looked up among the
+        tags pointing at HEAD only, instead of listing all tags, which
+        can be really slow on repositories that have thousands of them.
+
+        :param pip_compatible: ignored, all Git revspecs are pip compatible
+        :param check_changes: ignored, this is needed to get HEAD anyway
+        """
+        if self.git_version < (2, 11):  # porcelain v2 status
+            return super(GitRepo, self).freeze_status(
+                revspec=revspec, check_changes=check_changes)
+
+        head = None
+        dirty = False
+        for line in self.log_call(['git', 'status', '--porcelain=v2',
+                                   '--branch'], callwith=check_output,
+                                  log_level=logging.DEBUG).splitlines():
+            if line.startswith('# branch.oid '):
+                head = line.split()[2]
+            elif not line.startswith('#'):
+                dirty = True
+        if head is None or not ishex(head):  # e.g, '(initial)'
+            return super(GitRepo, self).freeze_status(
+                revspec=revspec, check_changes=check_changes)
+
+        fixed = False
+        if revspec is not None:
+            tags = self.log_call(['git', 'for-each-ref', '--points-at', head,
+                                  '--format=%(refname)', 'refs/tags'],
+                                 callwith=check_output,
+                                 log_level=logging.DEBUG).split()
+            fixed = 'refs/tags/' + revspec in tags
+        return dirty, [head], fixed
 
     def get_current_remote_fetch(self):
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
-            for line in self.log_call(['git', 'remote', '-v'],
-                                      callwith=check_output).splitlines():
-                if (line.endswith('(fetch)') and
-                        line.startswith(BUILDOUT_ORIGIN)):
-                    return line[len(BUILDOUT_ORIGIN):-7].strip()
+        for line in self.log_call(['git', 'remote', '-v'],
+                                  callwith=check_output).splitlines():
+            if (line.endswith('(fetch)') and
+                    line.startswith(BUILDOUT_ORIGIN)):
+                return line[len(BUILDOUT_ORIGIN):-7].strip()
 
     def offline_update(self, revision):
         target_dir = self.target_dir
@@ -201,19 +284,27 @@ class GitRepo(BaseRepo):
                             "Cannot update adresses in offline mode." % (
                                 self.target_dir, current_url, self.url))
         self.log_call(['git', 'checkout', revision],
-                      callwith=update_check_call,
-                      cwd=self.target_dir)
+                      callwith=update_check_call)
 
     def is_local_fixed_revision(self, refspec):
         """In Git, tags only are reproductible refspec."""
+        try:
+            with self.reader() as reader:
+                return reader.has_ref('refs/tags/' + refspec)
+        except gitreader.UnsupportedRepository:
+            pass
         tags = (t.strip()
                 for t in self.log_call(['git', 'tag'],
-                                       callwith=check_output,
-                                       cwd=self.target_dir).splitlines())
+                                       callwith=check_output).splitlines())
         return refspec in tags
 
     def has_commit(self, sha):
         """Return true if repo has specified commit"""
+        try:
+            with self.reader() as reader:
+                return reader.resolve_commit(sha) is not None
+        except gitreader.UnsupportedRepository:
+            pass
         try:
             objtype = check_output(['git', 'cat-file', '-t', sha],
                                    cwd=self.target_dir,
@@ -223,12 +314,17 @@ class GitRepo(BaseRepo):
 
         return objtype == 'commit'
 
-    def fetch_remote_sha(self, sha, checkout=True):
+    def fetch_remote_sha(self, sha, checkout=True,
+                         fetch_remote=BUILDOUT_ORIGIN):
         """Fetch a precise SHA from remote if necessary.
 
         SHA pinning is suboptimal, can't be guaranteed to work (see the
         warnings emitted in code for explanations). Still, many users
         people depend on it, for not having enough privileges to add tags.
+
+        :param fetch_remote: if it is a mirror (see :meth:`update_mirror`),
+                             the SHA is fetched from it first, and from the
+                             remote only if that fails.
         """
         if self.options.get('git-warn-sha-pins') not in ['False', 'false']:
             logger.warn("%s: pointing to a remote commit directly by its SHA "
@@ -241,6 +337,14 @@ class GitRepo(BaseRepo):
                         "to your buildout configuration",
                         self.target_dir)
         branch = self.options.get('branch')
+        if fetch_remote != BUILDOUT_ORIGIN and not self.has_commit(sha):
+            try:
+                self.log_call(['git', 'fetch', fetch_remote, sha],
+                              callwith=update_check_call)
+            except UpdateError:
+                logger.info("%s: commit %r not found in mirror %r, "
+                            "fetching from remote", self.target_dir, sha,
+                            fetch_remote)
         if not self.has_commit(sha):
             fetch_cmd = ['git', 'fetch', BUILDOUT_ORIGIN]
             if branch is None:
@@ -263,6 +367,11 @@ class GitRepo(BaseRepo):
         :return: ``sha`` the hash of a given ref if known to the local git repo
                 ``None`` if the ref is unkown
         """
+        try:
+            with self.reader() as reader:
+                return reader.resolve_commit(ref)
+        except gitreader.UnsupportedRepository:
+            pass
         if self.has_commit(ref):
             ref_hash = check_output(
                 ['git', 'show', '--pretty=format:%H', '-s', ref],
@@ -275,6 +384,9 @@ class GitRepo(BaseRepo):
     def query_remote_ref(self, remote, ref):
         """Query remote repo about given ref.
 
+        The references of the remote are listed once for all and kept
+        in memory for subsequent queries (see :meth:`remote_refs`).
+
         :return: ``('tag', sha)`` if ref is a tag in remote
                  ``('branch', sha)`` if ref is branch (aka "head") in remote
                  ``(None, ref)`` if ref does not exist in remote. This happens
@@ -284,17 +396,118 @@ class GitRepo(BaseRepo):
             # shortcut for commit hashes: if ref is a commit hash and git
             # already knows it as a commit, we can skip the remote querying
             return (None, ref)
-        out = self.log_call(['git', 'ls-remote', remote, ref],
-                            cwd=self.target_dir,
-                            callwith=check_output).strip()
-        for sha, fullref in (l.split() for l in out.splitlines()):
-            if fullref == 'refs/heads/' + ref:
-                return 'branch', sha
-            elif fullref == 'refs/tags/' + ref:
-                return 'tag', sha
-            elif fullref == ref and ref == 'HEAD':
-                return 'HEAD', sha
-        return None, ref
+        result = self._lookup_ref(self.remote_refs(remote), ref)
+        if result is None:
+            # the ref may have been created since the listing
+            result = self._lookup_ref(self.remote_refs(remote, refresh=True),
+                                      ref)
+        if result is None:
+            return None, ref
+        return result
+
+    @staticmethod
+    def _lookup_ref(refs, ref):
+        """Find ref in the given listing of remote references.
+
+        Branches have precedence over tags, as in the ordering of
+        ``git ls-remote`` output.
+
+        >>> refs = {'HEAD': 'c0', 'refs/heads/master': 'c0',
+        ...         'refs/tags/1.0': 'c1', 'refs/tags/1.0^{}': 'c2'}
+        >>> GitRepo._lookup_ref(refs, 'master')
+        ('branch', 'c0')
+        >>> GitRepo._lookup_ref(refs, '1.0')
+        ('tag', 'c1')
+        >>> GitRepo._lookup_ref(refs, 'HEAD')
+        ('HEAD', 'c0')
+        >>> GitRepo._lookup_ref(refs, 'unknown') is None
+        True
+        """
+        sha = refs.get('refs/heads/' + ref)
+        if sha is not None:
+            return 'branch', sha
+        sha = refs.get('refs/tags/' + ref)
+        if sha is not None:
+            return 'tag', sha
+        if ref == 'HEAD' and 'HEAD' in refs:
+            return 'HEAD', refs['HEAD']
+
+    def remote_url(self, remote):
+        """Return the URL of the given remote name.
+
+        Anything that is not the name of a remote of the local repository
+        (an URL, a path) is returned unchanged.
+
+        The answer is kept for the whole process; :meth:`get_update`
+        records the URL it sets for the buildout remote.
+        """
+        key = (self.target_dir, remote)
+        url = self._remote_urls.get(key)
+        if url is None:
+            try:
+                url = self.log_call(
+                    ['git', 'config', '--get', 'remote.%s.url' % remote],
+                    callwith=check_output, stderr=subprocess.PIPE,
+                    log_level=logging.DEBUG).strip()
+            except (subprocess.CalledProcessError, OSError):
+                url = remote
+            self._remote_urls[key] = url
+        return url
+
+    def remote_refs(self, remote, refresh=False):
+        """Return all references of the given remote, as a dict.
+
+        A single ``git ls-remote`` is issued per remote URL for the whole
+        process (i.e., the buildout run), unless ``refresh`` is ``True``.
+        The result is shared by all instances, so that merges, addons and
+        main software hosted at the same URL don't issue any more
+        network requests.
+
+        :return: a dict whose keys are full reference names (including
+                 ``HEAD``) and values the corresponding SHAs.
+        """
+        url = self.remote_url(remote)
+        cls = self.__class__
+        with self._keyed_lock(('ls-remote', url)):
+            refs = cls._remote_refs.get(url)
+            if refs is None or refresh:
+                out = self.log_call(['git', 'ls-remote', remote],
+                                    callwith=check_output)
+                refs = {}
+                for line in out.splitlines():
+                    sha, fullref = line.split()
+                    refs.setdefault(fullref, sha)
+                cls._remote_refs[url] = refs
+            return refs
+
+    @classmethod
+    def clear_remote_refs_cache(cls):
+        """Forget all the references and URLs of remotes seen so far."""
+        cls._remote_refs.clear()
+        cls._remote_urls.clear()
+
+    def is_at_fixed_revision(self, revision):
+        """True if the clone is already at the given fixed revision.
+
+        Fixed revisions are the local tags and the full commit SHAs (see
+        :meth:`is_local_fixed_revision`). The remote must also be unchanged.
+        This does not query the remote, and is meant to make updates of
+        pinned repositories free of any network operation.
+        """
+        if not self.is_versioned(self.target_dir):
+            return False
+        if not (len(revision) == 40 and ishex(revision) or
+                self.is_local_fixed_revision(revision)):
+            return False
+        if self.get_current_remote_fetch() != self.url:
+            return False
+        try:
+            head, wanted = check_output(
+                ['git', 'rev-parse', 'HEAD', revision + '^{commit}'],
+                cwd=self.target_dir, stderr=subprocess.PIPE).split()
+        except subprocess.CalledProcessError:
+            return False
+        return head == wanted
 
     dangerous_revisions = ('FETCH_HEAD', 'ORIG_HEAD', 'MERGE_HEAD',
                            'CHERRY_PICK_HEAD', 'REVERT_HEAD')
@@ -325,42 +538,242 @@ class GitRepo(BaseRepo):
         if self.offline:
             return self.offline_update(revision)
 
+        if self.is_at_fixed_revision(revision):
+            self.update_sparse_checkout()
+            logger.info("%s> already at fixed revision %r, nothing to do",
+                        self.target_dir, revision)
+            return
+
         target_dir = self.target_dir
         url = self.url
 
-        with working_directory_keeper:
-            is_new = not os.path.exists(target_dir)
-            if is_new:
-                self.log_call(['git', 'init', target_dir])
+        is_new = not os.path.exists(target_dir)
+        if is_new:
+            self.log_call(['git', 'init', target_dir], cwd=None)
+
+        self.log_call(['git', 'remote', 'add' if is_new else 'set-url',
+                       BUILDOUT_ORIGIN, url],
+                      log_level=logging.DEBUG)
+        self._remote_urls[(target_dir, BUILDOUT_ORIGIN)] = url
+        self.configure_partial_clone()
+        self.update_sparse_checkout()
+
+        fetch_remote = BUILDOUT_ORIGIN
+        if self.options.get('git-cache-dir'):
+            fetch_remote = self.update_mirror()
+            self.use_mirror_objects(fetch_remote)
+
+        rtype, sha = self.query_remote_ref(fetch_remote, revision)
+        if rtype is None and ishex(revision):
+            return self.fetch_remote_sha(revision, fetch_remote=fetch_remote)
+
+        fetch_cmd = ['git', 'fetch']
+        depth = self.options.get('depth')
+        if depth is not None:
+            fetch_cmd.extend(('--depth', str(depth)))
+        if rtype == 'tag':
+            fetch_refspec = '+refs/tags/%s:refs/tags/%s' % (revision,
+                                                            revision)
+        else:
+            fetch_refspec = revision
+        fetch_cmd.extend((fetch_remote, fetch_refspec))
+        self.log_call(fetch_cmd, callwith=update_check_call)
+
+        if rtype == 'tag':
+            self.log_call(['git', 'checkout', revision])
+        elif rtype in ('branch', 'HEAD'):
+            self.update_fetched_branch(revision)
+        else:
+            raise NotImplementedError(
+                "Unknown remote reference type %r" % rtype)
+
+    @property
+    def partial_clone_filter(self):
+        """The object filter for fetches, making this a partial clone.
+
+        This is the ``filter`` option. Otherwise, sparse checkouts don't
+        need the blobs (file contents) outside of their directories, they
+        are fetched on demand only.
+        """
+        filter_spec = self.options.get('filter')
+        if filter_spec is None and self.options.get('sparse'):
+            filter_spec = 'blob:none'
+        return filter_spec
 
-            os.chdir(target_dir)
-            self.log_call(['git', 'remote', 'add' if is_new else 'set-url',
-                           BUILDOUT_ORIGIN, url],
+    def is_shallow(self):
+        return os.path.exists(os.path.join(self.target_dir, '.git',
+                                           'shallow'))
+
+    def configure_partial_clone(self):
+        """Make the clone a partial clone, if a filter is wanted.
+
+        The full history is then available, with the filtered objects
+        fetched on demand, hence an existing shallow clone is converted,
+        unless the ``depth`` option is also set.
+        """
+        filter_spec = self.partial_clone_filter
+        if filter_spec is None:
+            return
+        if self.git_version < (2, 20):
+            raise UserError("Partial clones need Git >= 2.20, found %s" % (
+                '.'.join(str(v) for v in self.git_version)))
+        try:
+            current = self.log_call(
+                ['git', 'config', 'remote.%s.partialclonefilter' % (
+                    BUILDOUT_ORIGIN)],
+                callwith=check_output, log_level=logging.DEBUG).strip()
+        except subprocess.CalledProcessError:  # not set
+            current = None
+        if current != filter_spec:
+            self.set_partial_clone_filter(filter_spec)
+
+        # normalized in __init__, absent if explicitely set to 'None'
+        if self.options.get('depth') is None and self.is_shallow():
+            logger.info("%s> converting shallow clone to a partial clone "
+                        "with filter %r", self.target_dir, filter_spec)
+            self.log_call(['git', 'fetch', '--unshallow', BUILDOUT_ORIGIN],
+                          callwith=update_check_call)
+
+    def sparse_checkout_list(self):
+        """Return the sorted directories of the current sparse checkout.
+
+        :returns: ``None`` if the clone is not a sparse checkout.
+        """
+        if not os.path.exists(os.path.join(self.target_dir, '.git', 'info',
+                                           'sparse-checkout')):
+            return None
+        try:
+            enabled = self.log_call(
+                ['git', 'config', '--bool', 'core.sparseCheckout'],
+                callwith=check_output, log_level=logging.DEBUG).strip()
+        except subprocess.CalledProcessError:  # not set
+            return None
+        if enabled != 'true':
+            return None
+        return sorted(self.log_call(['git', 'sparse-checkout', 'list'],
+                                    callwith=check_output,
+                                    log_level=logging.DEBUG).split())
+
+    def update_sparse_checkout(self):
+        """Make the clone a sparse checkout of the wanted directories.
+
+        The ``sparse`` option lists the directories to check out, in
+        the so-called cone mode: files at the root of the repository are
+        always checked out, as well as everything below the directories.
+        The blobs are then fetched only for those
+        (see :attr:`partial_clone_filter`).
+
+        Without the ``sparse`` option, a previous sparse checkout is
+        disabled.
+        """
+        wanted = self.options.get('sparse')
+        current = self.sparse_checkout_list()
+        if wanted == current:
+            return
+        if wanted is None:
+            logger.info("%s> disabling sparse checkout", self.target_dir)
+            self.log_call(['git', 'sparse-checkout', 'disable'],
+                          callwith=update_check_call)
+            return
+
+        if self.git_version < (2, 25):
+            raise UserError("Sparse checkouts need Git >= 2.25, found %s" % (
+                '.'.join(str(v) for v in self.git_version)))
+        self.log_call(['git', 'sparse-checkout', 'set', '--cone'] + wanted,
+                      callwith=update_check_call)
+
+    def set_partial_clone_filter(self, filter_spec):
+        """Make the buildout remote a promisor remote, with given filter.
+
+        Subsequent fetches from it only get the objects that the filter
+        accepts, the other ones are fetched when needed.
+        """
+        for key, value in (('promisor', 'true'),
+                           ('partialclonefilter', filter_spec)):
+            self.log_call(['git', 'config',
+                           'remote.%s.%s' % (BUILDOUT_ORIGIN, key), value],
                           log_level=logging.DEBUG)
 
-            rtype, sha = self.query_remote_ref(BUILDOUT_ORIGIN, revision)
-            if rtype is None and ishex(revision):
-                return self.fetch_remote_sha(revision)
-
-            fetch_cmd = ['git', 'fetch']
-            depth = self.options.get('depth')
-            if depth is not None:
-                fetch_cmd.extend(('--depth', str(depth)))
-            if rtype == 'tag':
-                fetch_refspec = '+refs/tags/%s:refs/tags/%s' % (revision,
-                                                                revision)
-            else:
-                fetch_refspec = revision
-            fetch_cmd.extend((BUILDOUT_ORIGIN, fetch_refspec))
-            self.log_call(fetch_cmd, callwith=update_check_call)
+    @property
+    def mirror_dir(self):
+        """Path of the bare mirror of the remote URL in ``git-cache-dir``.
 
-            if rtype == 'tag':
-                self.log_call(['git', 'checkout', revision])
-            elif rtype in ('branch', 'HEAD'):
-                self.update_fetched_branch(revision)
-            else:
-                raise NotImplementedError(
-                    "Unknown remote reference type %r" % rtype)
+        The name is derived from a hash of the full URL, readability being
+        provided by a prefix taken from its last segment.
+        Is ``None`` if the ``git-cache-dir`` option is not set.
+        """
+        cache_dir = self.options.get('git-cache-dir')
+        if not cache_dir:
+            return None
+        url = self.url.rstrip('/')
+        name = url.rsplit('/', 1)[-1].rsplit(':', 1)[-1]
+        if name.endswith('.git'):
+            name = name[:-4]
+        digest = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(os.path.expanduser(cache_dir),
+                            '%s-%s.git' % (name, digest))
+
+    def _keyed_lock(self, key):
+        """Return a lock shared by all instances for the given key."""
+        cls = self.__class__
+        with cls._locks_lock:
+            return cls._locks.setdefault(key, threading.Lock())
+
+    def update_mirror(self):
+        """Create or update the bare mirror of the remote URL.
+
+        Creation is done in a temporary directory, and then renamed, so that
+        concurrent buildouts don't end up with an incomplete mirror.
+        Automatic garbage collection is disabled in the mirror, because
+        clones borrow its objects (see :meth:`use_mirror_objects`) and
+        could get corrupted by the loss of no longer referenced ones.
+
+        :returns: path to the mirror
+        """
+        mirror_dir = self.mirror_dir
+        with self._keyed_lock(('mirror', mirror_dir)):
+            if os.path.exists(mirror_dir):
+                self.log_call(['git', 'fetch'], cwd=mirror_dir,
+                              callwith=update_check_call)
+                return mirror_dir
+
+            cache_dir = os.path.dirname(mirror_dir)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_dir = tempfile.mkdtemp(
+                dir=cache_dir, prefix=os.path.basename(mirror_dir) + '.tmp')
+            try:
+                self.log_call(['git', 'clone', '--mirror', self.url, tmp_dir],
+                              cwd=None, callwith=clone_check_call)
+                self.log_call(['git', 'config', 'gc.auto', '0'], cwd=tmp_dir)
+                os.rename(tmp_dir, mirror_dir)
+            except OSError:
+                if not os.path.exists(mirror_dir):
+                    raise
+                logger.info("Mirror %s of %s has been concurrently created",
+                            mirror_dir, self.url)
+            finally:
+                if os.path.exists(tmp_dir):
+                    shutil.rmtree(tmp_dir)
+        return mirror_dir
+
+    def use_mirror_objects(self, mirror_dir):
+        """Register the objects of the mirror as alternates of the clone.
+
+        This is what ``git clone --reference`` does, and it means that
+        the objects fetched from the mirror are not copied in the clone.
+        """
+        mirror_objects = os.path.join(mirror_dir, 'objects')
+        alternates = os.path.join(self.target_dir, '.git', 'objects', 'info',
+                                  'alternates')
+        if os.path.exists(alternates):
+            with open(alternates) as f:
+                if mirror_objects in (line.strip() for line in f):
+                    return
+        elif not os.path.isdir(os.path.dirname(alternates)):
+            os.makedirs(os.path.dirname(alternates))
+        with open(alternates, 'a') as f:
+            f.write(mirror_objects + '\n')
 
     def update_fetched_branch(self, branch):
         # TODO: check what happens when there are local changes
@@ -407,53 +820,91 @@ class GitRepo(BaseRepo):
 
     def merge(self, revision):
         """Merge revision into current branch"""
-        with working_directory_keeper:
-            if not self.is_versioned(self.target_dir):
-                raise RuntimeError("Cannot merge into non existent "
-                                   "or non git local directory %s" %
-                                   self.target_dir)
-            os.chdir(self.target_dir)
-            rtype, sha = self.query_remote_ref(BUILDOUT_ORIGIN, revision)
-            if rtype is None and ishex(revision):
-                self.fetch_remote_sha(revision, checkout=False)
-            cmd = ['git', 'pull', self.url, revision]
-            if self.git_version >= (1, 7, 10):
-                # --edit and --no-edit appear with Git 1.7.10
-                # see Documentation/RelNotes/1.7.10.txt of Git
-                # (https://git.kernel.org/cgit/git/git.git/tree)
-                cmd.insert(2, '--no-edit')
-
-            self.log_call(cmd)
+        if not self.is_versioned(self.target_dir):
+            raise RuntimeError("Cannot merge into non existent "
+                               "or non git local directory %s" %
+                               self.target_dir)
+        # merging needs the history, and the filter to fetch anything
+        self.configure_partial_clone()
+        rtype, sha = self.query_remote_ref(BUILDOUT_ORIGIN, revision)
+        if rtype is None and ishex(revision):
+            self.fetch_remote_sha(revision, checkout=False)
+        cmd = ['git', 'pull', self.url, revision]
+        if self.git_version >= (1, 7, 10):
+            # --edit and --no-edit appear with Git 1.7.10
+            # see Documentation/RelNotes/1.7.10.txt of Git
+            # (https://git.kernel.org/cgit/git/git.git/tree)
+            cmd.insert(2, '--no-edit')
+
+        self.log_call(cmd)
 
     def archive(self, target_path):
+        """Export the current revision to target_path.
+
+        The output of ``git archive`` is extracted as it is produced, without
+        any intermediate file. An existing target_path is replaced once the
+        extraction is complete.
+        """
         # TODO: does this work with merge-ins?
         revision = self.parents()[0]
-        if not os.path.exists(target_path):
-            os.makedirs(target_path)
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
-            target_tar = tempfile.NamedTemporaryFile(
-                prefix=os.path.split(self.target_dir)[1] + '.tar')
-            target_tar.file.close()
-            subprocess.check_call(['git', 'archive', revision,
-                                   '-o', target_tar.name])
-            subprocess.check_call(['tar', '-x', '-f', target_tar.name,
-                                   '-C', target_path])
-            os.unlink(target_tar.name)
+        parent_dir, name = os.path.split(target_path.rstrip(os.sep))
+        if not os.path.exists(parent_dir):
+            os.makedirs(parent_dir)
+        cmd = ['git', 'archive', '--prefix=%s/' % name, revision]
+        sparse = self.sparse_checkout_list()
+        if sparse:
+            # same contents as the sparse checkout: root files and dirs
+            cmd.append('--')
+            cmd.extend(self.root_files(revision))
+            cmd.extend(sparse)
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                env=SUBPROCESS_ENV, cwd=self.target_dir)
+        try:
+            tarball.extract_stream(proc.stdout, parent_dir)
+        finally:
+            proc.stdout.close()
+            retcode = proc.wait()
+        if retcode:
+            raise subprocess.CalledProcessError(retcode, cmd)
+
+    def root_files(self, revision):
+        """Return the names of the files at the root of the revision tree.
+        """
+        out = self.log_call(['git', 'ls-tree', '-z', revision],
+                            callwith=check_output, log_level=logging.DEBUG)
+        return [entry.split('\t', 1)[1] for entry in out.split('\0')
+                if entry and entry.split(None, 2)[1] == 'blob']
+
+    def archive_tree_id(self):
+        """Return the hash of the tree of current revision.
+
+        For sparse checkouts, the directories are appended.
+        """
+        tree_id = self.log_call(['git', 'rev-parse', 'HEAD^{tree}'],
+                                callwith=check_output).strip()
+        sparse = self.sparse_checkout_list()
+        if sparse:
+            tree_id += ':' + ','.join(sparse)
+        return tree_id
 
     def revert(self, revision):
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
-            subprocess.check_call(['git', 'checkout', revision])
-            if self._is_a_branch(revision):
-                self.log_call(['git', 'reset', '--hard',
-                              BUILDOUT_ORIGIN + '/' + revision],
-                              callwith=update_check_call)
-            else:
-                self.log_call(['git', 'reset', '--hard', revision])
+        subprocess.check_call(['git', 'checkout', revision],
+                              cwd=self.target_dir)
+        if self._is_a_branch(revision):
+            self.log_call(['git', 'reset', '--hard',
+                          BUILDOUT_ORIGIN + '/' + revision],
+                          callwith=update_check_call)
+        else:
+            self.log_call(['git', 'reset', '--hard', revision])
 
     def _is_a_branch(self, revision):
+        try:
+            with self.reader() as reader:
+                return reader.has_ref('refs/heads/' + revision)
+        except gitreader.UnsupportedRepository:
+            pass
         # if this fails, we have a seriously corrupted repo
-        branches = update_check_output(["git", "branch"])
+        branches = update_check_output(["git", "branch"],
+                                       cwd=self.target_dir)
         branches = branches.split()
         return revision in branches
@@ -0,0 +1,327 @@
+"""Read-only access to Git repositories, without any subprocess.
+
+This reads references (loose ones and ``packed-refs``) and the types of
+objects (loose ones and in packs, through their version 2 ``.idx`` index
+files) directly from the repository files, which are memory-mapped.
+
+It is meant to answer the simple queries that :class:`GitRepo
+<anybox.recipe.odoo.vcs.git.GitRepo>` makes in large numbers during
+updates and freezes, saving a ``git`` process for each of them.
+Whenever an answer can't be given with certainty (unknown repository
+format, revision expressions, alternate object stores...),
+:class:`UnsupportedRepository` is raised, so that the caller can fall back
+to the ``git`` command line.
+"""
+import os
+import re
+import mmap
+import zlib
+import struct
+import binascii
+from bisect import bisect_left
+
+SHA_HEX = re.compile(r'^[0-9a-fA-F]{40}$')
+
+SHORT_SHA_HEX = re.compile(r'^[0-9a-fA-F]{4,39}$')
+
+SHA_LEN = 20
+
+IDX_V2_MAGIC = b'\xfftOc'
+
+OBJECT_TYPES = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+
+OFS_DELTA = 6
+
+REF_DELTA = 7
+
+MAX_SYMREF_DEPTH = 5
+
+REF_PREFIXES = ('', 'refs/', 'refs/tags/', 'refs/heads/', 'refs/remotes/')
+"""Prefixes to find full reference names from short ones, in the order of
+precedence of ``git rev-parse`` (see gitrevisions(7))."""
+
+UNSUPPORTED_CONFIG = re.compile(
+    r'^\s*(objectformat|refstorage)\s*=', re.M | re.I)
+
+
+class UnsupportedRepository(Exception):
+    """The query can't be answered reliably without the git command line."""
+
+
+def check_rev(rev):
+    """Raise :class:`UnsupportedRepository` unless rev is a plain ref name.
+
+    >>> check_rev('refs/tags/10.0')
+    >>> check_rev('HEAD~2')  # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    ...
+    UnsupportedRepository: Unsupported revision 'HEAD~2'
+    """
+    if (not rev or rev.startswith(('-', '/')) or '..' in rev or
+            any(c in rev for c in '~^:@{}?*[\\ ')):
+        raise UnsupportedRepository("Unsupported revision %r" % rev)
+
+
+class PackIndex(object):
+    """A version 2 pack index (``.idx`` file), and its pack."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:4] != IDX_V2_MAGIC or struct.unpack_from(
+                '>L', self.data, 4)[0] != 2:
+            self.close()
+            raise UnsupportedRepository("Unsupported pack index %r" % path)
+        self.count = struct.unpack_from('>L', self.data, 8 + 255 * 4)[0]
+        self.shas_start = 8 + 256 * 4
+        self.offsets_start = self.shas_start + self.count * (SHA_LEN + 4)
+        self.pack = None
+
+    def close(self):
+        self.data.close()
+        if self.pack is not None:
+            self.pack.close()
+
+    def sha_at(self, i):
+        start = self.shas_start + i * SHA_LEN
+        return self.data[start:start + SHA_LEN]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        # for bisect
+        return self.sha_at(i)
+
+    def find(self, sha):
+        """Return the offset of binary sha in the pack, or ``None``."""
+        first = bytearray(sha[:1])[0]
+        lo = 0
+        if first:
+            lo = struct.unpack_from('>L', self.data,
+                                    8 + (first - 1) * 4)[0]
+        hi = struct.unpack_from('>L', self.data, 8 + first * 4)[0]
+        i = bisect_left(self, sha, lo, hi)
+        if i == hi or self.sha_at(i) != sha:
+            return None
+        offset = struct.unpack_from('>L', self.data,
+                                    self.offsets_start + i * 4)[0]
+        if offset & 0x80000000:
+            large_start = self.offsets_start + self.count * 4
+            offset = struct.unpack_from(
+                '>Q', self.data, large_start + (offset & 0x7fffffff) * 8)[0]
+        return offset
+
+    def object_type(self, offset, reader):
+        """Return the type of the object at given offset in the pack.
+
+        Deltified objects have the type of their base object.
+        """
+        try:
+            return self._object_type(offset, reader)
+        except (IOError, OSError, ValueError, IndexError) as exc:
+            # missing, empty (can't be mapped) or truncated pack
+            raise UnsupportedRepository(
+                "Can't read the pack of %r: %s" % (self.path, exc))
+
+    def _object_type(self, offset, reader):
+        if self.pack is None:
+            with open(self.path[:-4] + '.pack', 'rb') as f:
+                self.pack = mmap.mmap(f.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+        pack = self.pack
+        while True:
+            pos = offset
+            c = bytearray(pack[pos:pos + 1])[0]
+            obj_type = (c >> 4) & 7
+            while c & 0x80:  # rest of the object size
+                pos += 1
+                c = bytearray(pack[pos:pos + 1])[0]
+            pos += 1
+            if obj_type in OBJECT_TYPES:
+                return OBJECT_TYPES[obj_type]
+            if obj_type == OFS_DELTA:
+                c = bytearray(pack[pos:pos + 1])[0]
+                rel = c & 0x7f
+                while c & 0x80:
+                    pos += 1
+                    c = bytearray(pack[pos:pos + 1])[0]
+                    rel = ((rel + 1) << 7) | (c & 0x7f)
+                offset -= rel
+            elif obj_type == REF_DELTA:
+                return reader.object_type(
+                    binascii.hexlify(pack[pos:pos + SHA_LEN]).decode())
+            else:
+                raise UnsupportedRepository(
+                    "Unknown object type %d in %r" % (obj_type, self.path))
+
+
+class GitReader(object):
+    """Read references and object types of the Git repository at path.
+
+    Instances are meant to be short lived, i.e., used for a few queries
+    in a row, since they don't notice changes in the packs. They can be
+    used as context managers, to release the memory mappings.
+    """
+
+    def __init__(self, path):
+        git_dir = os.path.join(path, '.git')
+        if os.path.isfile(git_dir):  # worktree or submodule
+            with open(git_dir) as f:
+                content = f.read().strip()
+            if not content.startswith('gitdir:'):
+                raise UnsupportedRepository(
+                    "Unrecognized .git file in %r" % path)
+            git_dir = os.path.join(path, content[7:].strip())
+        if not os.path.isdir(git_dir):
+            raise UnsupportedRepository("No Git directory for %r" % path)
+        self.git_dir = git_dir
+        self.common_dir = git_dir
+        commondir_path = os.path.join(git_dir, 'commondir')
+        if os.path.exists(commondir_path):
+            with open(commondir_path) as f:
+                self.common_dir = os.path.join(git_dir, f.read().strip())
+        try:
+            with open(os.path.join(self.common_dir, 'config')) as f:
+                config = f.read()
+        except IOError:
+            raise UnsupportedRepository("No config in %r" % self.common_dir)
+        if UNSUPPORTED_CONFIG.search(config):
+            raise UnsupportedRepository(
+                "Unsupported repository extensions in %r" % self.common_dir)
+        self.objects_dir = os.path.join(self.common_dir, 'objects')
+        self._packed_refs = None
+        self._packs = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for pack in self._packs or ():
+            pack.close()
+        self._packs = None
+
+    @property
+    def packed_refs(self):
+        """Dict of the references in the ``packed-refs`` file."""
+        if self._packed_refs is None:
+            refs = self._packed_refs = {}
+            try:
+                with open(os.path.join(self.common_dir, 'packed-refs')) as f:
+                    for line in f:
+                        if line.startswith(('#', '^')):
+                            continue
+                        sha, name = line.split()
+                        refs[name] = sha
+            except IOError:
+                pass
+        return self._packed_refs
+
+    def read_ref(self, name, depth=0):
+        """Return the SHA that the full reference name resolves to.
+
+        Symbolic references (such as ``HEAD`` usually) are followed.
+
+        :returns: ``None`` if there's no such reference.
+        """
+        if depth > MAX_SYMREF_DEPTH:
+            raise UnsupportedRepository("Too many symbolic references")
+        base_dir = self.git_dir if name == 'HEAD' else self.common_dir
+        try:
+            with open(os.path.join(base_dir, name)) as f:
+                content = f.read().strip()
+        except IOError:
+            return self.packed_refs.get(name)
+        if content.startswith('ref:'):
+            return self.read_ref(content[4:].strip(), depth=depth + 1)
+        if SHA_HEX.match(content) is None:
+            raise UnsupportedRepository(
+                "Unrecognized reference %r in %r" % (name, base_dir))
+        return content
+
+    def has_ref(self, name):
+        """True if the full reference name exists (not necessarily valid).
+        """
+        check_rev(name)
+        return (os.path.isfile(os.path.join(self.common_dir, name)) or
+                name in self.packed_refs)
+
+    def resolve(self, rev):
+        """Return the SHA that rev designates, as ``git rev-parse`` would.
+
+        Only full SHAs and reference names (possibly short) are supported.
+
+        :returns: ``None`` if rev is unknown.
+        """
+        if SHA_HEX.match(rev) is not None:
+            return rev.lower()
+        check_rev(rev)
+        for prefix in REF_PREFIXES:
+            sha = self.read_ref(prefix + rev)
+            if sha is not None:
+                return sha
+        sha = self.read_ref('refs/remotes/%s/HEAD' % rev)
+        if sha is None and SHORT_SHA_HEX.match(rev) is not None:
+            raise UnsupportedRepository(
+                "%r could be an abbreviated SHA" % rev)
+        return sha
+
+    @property
+    def packs(self):
+        if self._packs is None:
+            self._packs = []
+            pack_dir = os.path.join(self.objects_dir, 'pack')
+            if os.path.isdir(pack_dir):
+                for fname in sorted(os.listdir(pack_dir)):
+                    if not fname.endswith('.idx'):
+                        continue
+                    try:
+                        pack = PackIndex(os.path.join(pack_dir, fname))
+                    except (IOError, ValueError):  # e.g, concurrent gc
+                        raise UnsupportedRepository(
+                            "Could not read pack index %r" % fname)
+                    self._packs.append(pack)
+        return self._packs
+
+    def object_type(self, sha):
+        """Return the type of the object of given hexadecimal sha.
+
+        :returns: one of ``'commit'``, ``'tree'``, ``'blob'``, ``'tag'``, or
+                  ``None`` if the object is not in the repository.
+        """
+        sha = sha.lower()
+        loose = os.path.join(self.objects_dir, sha[:2], sha[2:])
+        try:
+            with open(loose, 'rb') as f:
+                header = zlib.decompressobj().decompress(f.read(64))
+            return header.split(b' ', 1)[0].decode()
+        except IOError:
+            pass
+        except zlib.error:
+            raise UnsupportedRepository("Could not read object %s" % sha)
+        bin_sha = binascii.unhexlify(sha)
+        for pack in self.packs:
+            offset = pack.find(bin_sha)
+            if offset is not None:
+                return pack.object_type(offset, self)
+
+        if os.path.exists(os.path.join(self.objects_dir, 'info',
+                                       'alternates')):
+            raise UnsupportedRepository(
+                "Object %s may be in alternate object stores" % sha)
+        return None
+
+    def resolve_commit(self, rev):
+        """Return the SHA of the commit that rev designates.
+
+        :returns: ``None`` if rev is unknown or not a commit. As with
+                  ``git cat-file -t``, annotated tags are not peeled.
+        """
+        sha = self.resolve(rev)
+        if sha is None or self.object_type(sha) != 'commit':
+            return None
+        return sha
@@ -2,7 +2,6 @@ import os
 import subprocess
 import logging
 
-from ..utils import working_directory_keeper
 from .base import BaseRepo
 
 logger = logging.getLogger(__name__)
@@ -26,30 +25,29 @@ class SvnCheckout(BaseRepo):
 
         rev_str = revision and '-r ' + revision or ''
 
-        with working_directory_keeper:
-            if not os.path.exists(target_dir):
-                # TODO case of local url ?
-                if offline:
-                    raise IOError(
-                        "svn checkout %s does not exist; cannot checkout "
-                        "from %s (offline mode)" % (target_dir, url))
-
-                os.chdir(os.path.split(target_dir)[0])
-                logger.info("Checkouting %s ...", url)
-                subprocess.check_call('svn checkout %s %s %s' % (
-                    rev_str, url, target_dir), shell=True)
+        if not os.path.exists(target_dir):
+            # TODO case of local url ?
+            if offline:
+                raise IOError(
+                    "svn checkout %s does not exist; cannot checkout "
+                    "from %s (offline mode)" % (target_dir, url))
+
+            logger.info("Checkouting %s ...", url)
+            subprocess.check_call('svn checkout %s %s %s' % (
+                rev_str, url, target_dir), shell=True,
+                cwd=os.path.split(target_dir)[0])
+        else:
+            # TODO what if remote repo is actually local fs ?
+            if offline:
+                logger.warning(
+                    "Offline mode: keeping checkout %s in its current rev",
+                    target_dir)
             else:
-                os.chdir(target_dir)
-                # TODO what if remote repo is actually local fs ?
-                if offline:
-                    logger.warning(
-                        "Offline mode: keeping checkout %s in its current rev",
-                        target_dir)
-                else:
-                    logger.info("Updating %s to location %s, revision %s...",
-                                target_dir, url, revision)
-                    # switch is necessary in order to move in tags
-                    # TODO support also change of svn root url
-                    subprocess.check_call('svn switch %s' % url, shell=True)
-                    subprocess.check_call('svn up %s' % rev_str,
-                                          shell=True)
+                logger.info("Updating %s to location %s, revision %s...",
+                            target_dir, url, revision)
+                # switch is necessary in order to move in tags
+                # TODO support also change of svn root url
+                subprocess.check_call('svn switch %s' % url, shell=True,
+                                      cwd=target_dir)
+                subprocess.check_call('svn up %s' % rev_str, shell=True,
+                                      cwd=target_dir)
@@ -6,7 +6,7 @@ from zc.buildout import UserError
 from ..testing import COMMIT_USER_FULL
 from ..testing import VcsTestCase
 from ..bzr import BzrBranch
-from ..bzr import working_directory_keeper
+from ...utils import working_directory_keeper
 from ..base import UpdateError
 from ..base import CloneError
 
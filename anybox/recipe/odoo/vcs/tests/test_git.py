@@ -48,6 +48,10 @@ def git_write_commit(repo_dir, filepath, contents, msg="Unit test commit"):
 class GitBaseTestCase(VcsTestCase):
     """Common utilities for Git test cases."""
 
+    def setUp(self):
+        GitRepo.clear_remote_refs_cache()
+        super(GitBaseTestCase, self).setUp()
+
     def create_src(self):
         os.chdir(self.src_dir)
         subprocess.call(['git', 'init', 'src-repo'])
@@ -74,6 +78,17 @@ class GitBaseTestCase(VcsTestCase):
             commits = check_output(['git', 'rev-list', 'HEAD'])
             self.assertEqual(len(commits.splitlines()), depth)
 
+    def record_calls(self, repo):
+        """Record the commands run through repo.log_call()."""
+        calls = []
+        log_call = repo.log_call
+
+        def recording_log_call(cmd, **kw):
+            calls.append(cmd)
+            return log_call(cmd, **kw)
+        repo.log_call = recording_log_call
+        return calls
+
 
 class GitTestCase(GitBaseTestCase):
 
@@ -127,6 +142,90 @@ class GitTestCase(GitBaseTestCase):
         with open(os.path.join(archive_dir, 'tracked')) as f:
             self.assertEquals(f.readlines()[0].strip(), 'last')
 
+    def test_archive_replace(self):
+        """Archive replaces a previous export, and tree id."""
+        repo = GitRepo(os.path.join(self.dst_dir, "My clone"), self.src_repo)
+        repo('master')
+
+        archive_dir = os.path.join(self.dst_dir, "archive")
+        os.mkdir(archive_dir)
+        with open(os.path.join(archive_dir, 'stale'), 'w') as f:
+            f.write('stale')
+        repo.archive(archive_dir)
+        self.assertEqual(sorted(os.listdir(archive_dir)), ['tracked'])
+        self.assertEqual(
+            repo.archive_tree_id(),
+            check_output(['git', 'rev-parse', 'HEAD^{tree}'],
+                         cwd=repo.target_dir).strip())
+
+    def test_sparse(self):
+        """Sparse checkout, then update with other directories, disable."""
+        if GitRepo.init_git_version(
+                check_output(['git', '--version'])) < (2, 25):
+            self.skipTest("Sparse checkouts need Git >= 2.25")
+        for path in ('mod1/f', 'mod2/f', 'other/f'):
+            os.makedirs(os.path.join(self.src_repo, os.path.dirname(path)))
+            git_write_commit(self.src_repo, path, path)
+        subprocess.check_call(['git', 'config', 'uploadpack.allowFilter',
+                               'true'], cwd=self.src_repo)
+
+        target_dir = os.path.join(self.dst_dir, "sparse")
+        repo = GitRepo(target_dir, self.src_repo, sparse='mod1')
+        repo('master')
+        self.assertEqual(sorted(os.listdir(target_dir)),
+                         ['.git', 'mod1', 'tracked'])
+        self.assertEqual(repo.sparse_checkout_list(), ['mod1'])
+        self.assertEqual(check_output(['git', 'config',
+                                       'remote.origin.partialclonefilter'],
+                                      cwd=target_dir).strip(), 'blob:none')
+
+        archive_dir = os.path.join(self.dst_dir, "archive")
+        repo.archive(archive_dir)
+        self.assertEqual(sorted(os.listdir(archive_dir)), ['mod1', 'tracked'])
+
+        repo = GitRepo(target_dir, self.src_repo, sparse='mod1,mod2/')
+        repo('master')
+        self.assertEqual(sorted(os.listdir(target_dir)),
+                         ['.git', 'mod1', 'mod2', 'tracked'])
+
+        repo = GitRepo(target_dir, self.src_repo)
+        repo('master')
+        self.assertEqual(sorted(os.listdir(target_dir)),
+                         ['.git', 'mod1', 'mod2', 'other', 'tracked'])
+        self.assertIsNone(repo.sparse_checkout_list())
+
+    def test_filter(self):
+        """Partial clone, converting a previous shallow clone."""
+        subprocess.check_call(['git', 'config', 'uploadpack.allowFilter',
+                               'true'], cwd=self.src_repo)
+        target_dir = os.path.join(self.dst_dir, "to_repo")
+        repo = GitRepo(target_dir, self.src_repo, depth='1')
+        repo('master')
+        self.assertTrue(repo.is_shallow())
+
+        repo = GitRepo(target_dir, self.src_repo, filter='blob:none')
+        repo('master')
+        self.assertFalse(repo.is_shallow())
+        self.assertTrue(repo.has_commit(self.commit_1_sha))
+        self.assertEqual(check_output(['git', 'config',
+                                       'remote.origin.partialclonefilter'],
+                                      cwd=target_dir).strip(), 'blob:none')
+
+        # a repository opting out of a global depth gets unshallowed too
+        target_dir = os.path.join(self.dst_dir, "opt_out")
+        GitRepo(target_dir, self.src_repo, depth='1')('master')
+        repo = GitRepo(target_dir, self.src_repo, filter='blob:none',
+                       depth='None', **{'git-depth': '1'})
+        repo('master')
+        self.assertFalse(repo.is_shallow())
+
+        # the per-repository option takes precedence over the global one
+        repo = GitRepo(target_dir, self.src_repo, filter='None',
+                       **{'git-filter': 'tree:0'})
+        self.assertIsNone(repo.partial_clone_filter)
+        self.assertRaises(UserError, GitRepo, target_dir, self.src_repo,
+                          filter='blob:limit')
+
     def test_clean(self):
         target_dir = os.path.join(self.dst_dir, "My clone")
         repo = GitRepo(target_dir, self.src_repo)
@@ -297,6 +396,51 @@ class GitTestCase(GitBaseTestCase):
         self.assertEqual(repo.query_remote_ref(BUILDOUT_ORIGIN, 'deadbeef'),
                          (None, 'deadbeef'))
 
+    def test_query_remote_ref_cache(self):
+        """Remote refs are listed once, and listed again for unknown refs.
+
+        This is an internal API test.
+        """
+        target_dir = os.path.join(self.dst_dir, "clone to query from")
+        repo = GitRepo(target_dir, self.src_repo)('master')
+        other = GitRepo(os.path.join(self.dst_dir, "other"), self.src_repo)
+        other('master')
+
+        new_sha = git_write_commit(self.src_repo, 'tracked',
+                                   "new", msg="new commit")
+        # the listing done by the first clone is reused
+        self.assertEqual(other.query_remote_ref(BUILDOUT_ORIGIN, 'master'),
+                         ('branch', self.commit_2_sha))
+        # a new ref triggers a new listing
+        subprocess.check_call(['git', 'tag', 'newtag'], cwd=self.src_repo)
+        self.assertEqual(repo.query_remote_ref(BUILDOUT_ORIGIN, 'newtag'),
+                         ('tag', new_sha))
+        self.assertEqual(other.query_remote_ref(BUILDOUT_ORIGIN, 'master'),
+                         ('branch', new_sha))
+
+    def test_remote_url(self):
+        """Remote URLs are looked up once, and updated by get_update().
+
+        This is an internal API test.
+        """
+        target_dir = os.path.join(self.dst_dir, "clone")
+        repo = GitRepo(target_dir, self.src_repo)('master')
+        calls = self.record_calls(repo)
+        self.assertEqual(repo.remote_url(BUILDOUT_ORIGIN), self.src_repo)
+        self.assertEqual(repo.remote_url('/some/path'), '/some/path')
+        self.assertEqual(repo.remote_url('/some/path'), '/some/path')
+        self.assertEqual(calls, [['git', 'config', '--get',
+                                  'remote./some/path.url']])
+
+        # another instance for the same clone (e.g., a merge)
+        other_url = os.path.join(self.src_dir, 'other')
+        subprocess.check_call(['git', 'clone', '-q', self.src_repo,
+                               other_url])
+        other = GitRepo(target_dir, other_url)
+        self.assertEqual(other.remote_url(BUILDOUT_ORIGIN), self.src_repo)
+        other('master')
+        self.assertEqual(repo.remote_url(BUILDOUT_ORIGIN), other_url)
+
     def test_clone_remote_HEAD(self):
         """Remote HEAD should be usable to clone onto."""
         target_dir = os.path.join(self.dst_dir, "clone to make on HEAD")
@@ -654,6 +798,45 @@ class GitTagTestCase(GitBaseTestCase):
         repo.revert('sometag')
         self.assertFalse(repo.uncommitted_changes())
 
+    def test_freeze_status(self):
+        target_dir = os.path.join(self.dst_dir, "to_repo")
+        repo = GitRepo(target_dir, self.src_repo)
+        repo('sometag')
+        self.assertEqual(repo.freeze_status(revspec='sometag'),
+                         (False, [self.commit_1_sha], True))
+        self.assertEqual(repo.freeze_status(),
+                         (False, [self.commit_1_sha], False))
+
+        with open(os.path.join(target_dir, 'untracked'), 'w') as f:
+            f.write("new file")
+        self.assertEqual(repo.freeze_status(revspec='master'),
+                         (True, [self.commit_1_sha], False))
+
+        # the tag doesn't point to HEAD any more
+        repo('master')
+        self.assertEqual(repo.freeze_status(revspec='sometag'),
+                         (True, [self.commit_2_sha], False))
+
+    def test_update_at_fixed_revision(self):
+        """Updating to the tag or SHA already checked out is offline."""
+        target_dir = os.path.join(self.dst_dir, "to_repo")
+        repo = GitRepo(target_dir, self.src_repo)
+        repo('sometag')
+        moved_src = self.src_repo + '-moved'
+        os.rename(self.src_repo, moved_src)
+
+        repo('sometag')
+        self.assertEqual(repo.parents(), [self.commit_1_sha])
+        repo(self.commit_1_sha)
+        self.assertEqual(repo.parents(), [self.commit_1_sha])
+
+        # branches are never considered to be fixed
+        self.assertRaises(subprocess.CalledProcessError, repo, 'master')
+        # neither are revisions from another remote
+        self.assertRaises(subprocess.CalledProcessError,
+                          GitRepo(target_dir, moved_src + '-other'),
+                          'sometag')
+
     def test_clone_to_tag_depth(self):
         self.test_clone_to_tag(depth='1')
 
@@ -719,3 +902,88 @@ class GitAnnotatedTagTestCase(GitTagTestCase):
         # that will be enough for now : there are also tests for
         # get_update(). This test is to fasten up debugging
         self.assertEqual(result[0], ('tag'))
+
+
+class GitCacheTestCase(GitBaseTestCase):
+    """Tests for the shared mirror cache (``git-cache-dir`` option)."""
+
+    def setUp(self):
+        super(GitCacheTestCase, self).setUp()
+        self.cache_dir = os.path.join(self.sandbox, 'cache')
+
+    def make_repo(self, name):
+        return GitRepo(os.path.join(self.dst_dir, name), self.src_repo,
+                       **{'git-cache-dir': self.cache_dir})
+
+    def assertUsesMirror(self, repo):
+        alternates = os.path.join(repo.target_dir,
+                                  '.git', 'objects', 'info', 'alternates')
+        with open(alternates) as f:
+            self.assertEqual(f.read().split(),
+                             [os.path.join(repo.mirror_dir, 'objects')])
+
+    def test_mirror_dir(self):
+        repo = self.make_repo('clone')
+        mirror_dir = repo.mirror_dir
+        self.assertEqual(os.path.dirname(mirror_dir), self.cache_dir)
+        self.assertTrue(os.path.basename(mirror_dir).startswith('src-repo-'))
+        self.assertEqual(self.make_repo('other clone').mirror_dir, mirror_dir)
+        self.assertIsNone(GitRepo('/some/target', self.src_repo).mirror_dir)
+
+    def test_clone(self):
+        repo = self.make_repo('clone')('master')
+        self.assertEqual(repo.parents(), [self.commit_2_sha])
+        self.assertEqual(repo.get_current_remote_fetch(), self.src_repo)
+        self.assertTrue(os.path.isdir(repo.mirror_dir))
+        self.assertUsesMirror(repo)
+
+        # the second clone of the same remote uses the same mirror
+        other = self.make_repo('other clone')(self.commit_1_sha)
+        self.assertEqual(other.parents(), [self.commit_1_sha])
+        self.assertUsesMirror(other)
+        self.assertEqual(os.listdir(self.cache_dir),
+                         [os.path.basename(repo.mirror_dir)])
+
+    def test_update(self):
+        repo = self.make_repo('clone')('master')
+        new_sha = git_write_commit(self.src_repo, 'tracked',
+                                   "new contents", msg="new commit")
+        repo('master')
+        self.assertEqual(repo.parents(), [new_sha])
+        self.assertUsesMirror(repo)
+
+    def test_unadvertised_sha(self):
+        """SHA pins missing in the clone are fetched from the mirror."""
+        repo = self.make_repo('clone')
+        calls = self.record_calls(repo)
+        # the alternates would give the commit right away: hide it until
+        # something gets fetched
+        has_commit = repo.has_commit
+        repo.has_commit = lambda sha: (
+            any(cmd[1] == 'fetch' for cmd in calls) and has_commit(sha))
+
+        repo(self.commit_1_sha)
+        self.assertEqual(repo.parents(), [self.commit_1_sha])
+        fetches = [cmd for cmd in calls if cmd[1] == 'fetch']
+        self.assertIn(['git', 'fetch', repo.mirror_dir, self.commit_1_sha],
+                      fetches)
+        self.assertNotIn(BUILDOUT_ORIGIN, (cmd[2] for cmd in fetches))
+
+    def test_unadvertised_sha_fallback(self):
+        """SHA pins missing in the mirror are fetched from the remote."""
+        repo = self.make_repo('clone')
+        calls = self.record_calls(repo)
+        sha = 'deadbeef' * 5
+        with self.assertRaises(subprocess.CalledProcessError):
+            repo(sha)
+        fetches = [cmd for cmd in calls if cmd[1] == 'fetch']
+        self.assertEqual(fetches[-2:], [['git', 'fetch', repo.mirror_dir, sha],
+                                        ['git', 'fetch', BUILDOUT_ORIGIN]])
+
+    def test_existing_clone(self):
+        """A clone made without the cache starts using it."""
+        target_dir = os.path.join(self.dst_dir, 'clone')
+        GitRepo(target_dir, self.src_repo)('master')
+        repo = self.make_repo('clone')('master')
+        self.assertUsesMirror(repo)
+        self.assertEqual(repo.parents(), [self.commit_2_sha])
@@ -0,0 +1,107 @@
+"""Tests for the pure Python reader of Git repositories."""
+
+import os
+import subprocess
+from ..testing import VcsTestCase
+from ..gitreader import GitReader
+from ..gitreader import UnsupportedRepository
+from ..git import GitRepo
+from ...utils import check_output
+from .test_git import git_write_commit
+
+
+class GitReaderTestCase(VcsTestCase):
+
+    def create_src(self):
+        os.chdir(self.src_dir)
+        subprocess.call(['git', 'init', 'src-repo'])
+        self.src_repo = os.path.join(self.src_dir, 'src-repo')
+        # big enough for the second version to be stored as a delta
+        contents = ''.join('line %d\n' % i for i in range(1000))
+        self.commit_1_sha = git_write_commit(self.src_repo, 'tracked',
+                                             contents, msg="initial commit")
+        self.commit_2_sha = git_write_commit(self.src_repo, 'tracked',
+                                             contents + "last\n",
+                                             msg="last commit")
+        self.git('tag', 'light', self.commit_1_sha)
+        self.git('tag', '-a', '-m', "annotated", 'annotated',
+                 self.commit_1_sha)
+        self.git('branch', 'other', self.commit_1_sha)
+
+    def git(self, *args):
+        return check_output(('git',) + args, cwd=self.src_repo).strip()
+
+    def assertQueries(self):
+        """Check the reader against the git command line."""
+        with GitReader(self.src_repo) as reader:
+            self.assertEqual(reader.read_ref('HEAD'), self.commit_2_sha)
+            self.assertEqual(reader.resolve('light'), self.commit_1_sha)
+            self.assertEqual(reader.resolve('other'), self.commit_1_sha)
+            self.assertEqual(reader.resolve('annotated'),
+                             self.git('rev-parse', 'annotated'))
+            self.assertEqual(reader.resolve_commit('annotated'), None)
+            self.assertEqual(reader.resolve_commit('light'),
+                             self.commit_1_sha)
+            self.assertEqual(reader.resolve_commit(self.commit_2_sha),
+                             self.commit_2_sha)
+            self.assertEqual(reader.resolve_commit('0' * 40), None)
+            self.assertEqual(reader.resolve('unknown'), None)
+            for obj in ('HEAD^{tree}', 'HEAD:tracked', 'annotated'):
+                sha = self.git('rev-parse', obj)
+                self.assertEqual(reader.object_type(sha),
+                                 self.git('cat-file', '-t', sha))
+            self.assertTrue(reader.has_ref('refs/heads/other'))
+            self.assertFalse(reader.has_ref('refs/heads/light'))
+            self.assertRaises(UnsupportedRepository, reader.resolve, 'HEAD~1')
+            self.assertRaises(UnsupportedRepository, reader.resolve,
+                              self.commit_1_sha[:8])
+
+    def test_loose(self):
+        self.assertQueries()
+
+    def test_packed(self):
+        self.git('gc', '--aggressive')  # packs refs and objects
+        self.assertFalse(os.listdir(os.path.join(self.src_repo, '.git',
+                                                 'refs', 'tags')))
+        # check that this tests the reading of deltified objects
+        pack_dir = os.path.join(self.src_repo, '.git', 'objects', 'pack')
+        idx = [f for f in os.listdir(pack_dir) if f.endswith('.idx')][0]
+        self.assertTrue('chain length = 1' in self.git(
+            'verify-pack', '-v', os.path.join(pack_dir, idx)))
+        self.assertQueries()
+
+    def test_broken_pack(self):
+        self.git('gc')
+        pack_dir = os.path.join(self.src_repo, '.git', 'objects', 'pack')
+        pack = [os.path.join(pack_dir, f) for f in os.listdir(pack_dir)
+                if f.endswith('.pack')][0]
+        with open(pack, 'rb') as f:
+            header = f.read(12)
+        for contents in (header, b''):  # truncated, then empty
+            with open(pack, 'wb') as f:
+                f.write(contents)
+            with GitReader(self.src_repo) as reader:
+                self.assertRaises(UnsupportedRepository, reader.object_type,
+                                  self.commit_1_sha)
+        os.unlink(pack)
+        with GitReader(self.src_repo) as reader:
+            self.assertRaises(UnsupportedRepository, reader.object_type,
+                              self.commit_1_sha)
+
+    def test_repo_methods(self):
+        self.git('pack-refs', '--all')
+        repo = GitRepo(self.src_repo, '')
+        self.assertEqual(repo.parents(), [self.commit_2_sha])
+        self.assertTrue(repo.has_commit(self.commit_1_sha))
+        self.assertTrue(repo.has_commit(self.commit_1_sha[:8]))  # CLI
+        self.assertFalse(repo.has_commit('annotated'))
+        self.assertEqual(repo.get_local_hash_for_ref('other'),
+                         self.commit_1_sha)
+        self.assertTrue(repo.is_local_fixed_revision('light'))
+        self.assertFalse(repo.is_local_fixed_revision('other'))
+        self.assertTrue(repo._is_a_branch('other'))
+        self.assertFalse(repo._is_a_branch('light'))
+
+    def test_unsupported_format(self):
+        self.git('config', 'extensions.refStorage', 'reftable')
+        self.assertRaises(UnsupportedRepository, GitReader, self.src_repo)